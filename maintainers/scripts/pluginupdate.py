@@ -11,30 +11,31 @@
 # $ nix run nixpkgs#python3.pkgs.flake8 -- --ignore E501,E265 maintainers/scripts/pluginupdate.py
 
 import argparse
+import asyncio
 import csv
-import functools
-import http
+import fcntl
+import hashlib
 import json
 import logging
 import os
 import re
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
 import traceback
-import urllib.error
 import urllib.parse
-import urllib.request
 import xml.etree.ElementTree as ET
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, replace
 from datetime import UTC, datetime
-from functools import wraps
-from multiprocessing.dummy import Pool
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from typing import Any, Dict, List, Optional, Tuple, Union
 from urllib.parse import urljoin, urlparse
 
+import aiohttp
 import git
 
 ATOM_ENTRY = "{http://www.w3.org/2005/Atom}entry"  # " vim gets confused here
@@ -48,49 +49,352 @@ LOG_LEVELS = {
 
 log = logging.getLogger()
 
+GITHUB_URL = "https://github.com"
+"""Where GitHub repositories are fetched from"""
 
-def retry(ExceptionToCheck: Any, tries: int = 4, delay: float = 3, backoff: float = 2):
-    """Retry calling the decorated function using an exponential backoff.
-    http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
-    original from: http://wiki.python.org/moin/PythonDecoratorLibrary#Retry
-    (BSD licensed)
-    :param ExceptionToCheck: the exception on which to retry
-    :param tries: number of times to try (not retry) before giving up
-    :param delay: initial delay between retries in seconds
-    :param backoff: backoff multiplier e.g. value of 2 will double the delay
-        each retry
-    """
-
-    def deco_retry(f: Callable) -> Callable:
-        @wraps(f)
-        def f_retry(*args: Any, **kwargs: Any) -> Any:
-            mtries, mdelay = tries, delay
-            while mtries > 1:
-                try:
-                    return f(*args, **kwargs)
-                except ExceptionToCheck as e:
-                    print(f"{str(e)}, Retrying in {mdelay} seconds...")
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
-            return f(*args, **kwargs)
+GITHUB_GRAPHQL = "https://api.github.com/graphql"
+"""GitHub's GraphQL API, used to look up many repositories at once"""
 
-        return f_retry  # true decorator
-
-    return deco_retry
+GITHUB_BATCH_SIZE = 100
+"""Number of repositories looked up per GraphQL query"""
 
 
 @dataclass
 class FetchConfig:
     proc: int
     github_token: str
+    connections_per_host: int = 16
+    git_mirrors: bool = True
+
+
+class FetchError(Exception):
+    pass
+
+
+@dataclass
+class Response:
+    status: int
+    url: str
+    """Url after following redirects"""
+    body: bytes
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise FetchError(f"HTTP Error {self.status} for {self.url}")
+
+
+def retry_after(headers: Any) -> Optional[float]:
+    """Seconds a rate limited client is asked to wait, if the server says so"""
+    value = headers.get("Retry-After")
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # GitHub's API sends the time its rate limit resets instead
+    reset = headers.get("X-RateLimit-Reset")
+    if reset is not None and headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            return max(0.0, float(reset) - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+class Fetcher:
+    """Runs the requests and prefetch commands of an update.
+
+    Requests share a pool of keep-alive connections with at most
+    `connections_per_host` connections to each host. When a host rate limits us, all
+    requests to it wait until the time it asked for instead of each backing off on
+    its own. At most `proc` prefetch commands run at once, independently of the
+    requests, so fetching metadata of some plugins overlaps with prefetching others.
+    """
+
+    tries = 4
+    delay = 3.0
+    backoff = 2.0
+
+    def __init__(self, config: FetchConfig) -> None:
+        self.config = config
+        self.processes = asyncio.Semaphore(config.proc)
+        self.blocked_until: Dict[str, float] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.git: Optional[GitMirrors] = None
+        if config.git_mirrors:
+            path = get_cache_path("nixpkgs-git-mirrors")
+            if path is not None:
+                self.git = GitMirrors(path)
+
+    async def __aenter__(self) -> "Fetcher":
+        connector = aiohttp.TCPConnector(
+            limit=0, limit_per_host=self.config.connections_per_host
+        )
+        # no total timeout, waiting for a free connection is expected
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        assert self._session is not None
+        await self._session.close()
+        self._session = None
+
+    async def _wait_for(self, host: str) -> None:
+        while (delay := self.blocked_until.get(host, 0.0) - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    def _block(self, host: str, seconds: float) -> None:
+        until = time.monotonic() + seconds
+        if until > self.blocked_until.get(host, 0.0):
+            print(
+                f"{host} is rate limiting us, pausing requests for {seconds:.0f} seconds..."
+            )
+            self.blocked_until[host] = until
+
+    async def request(
+        self,
+        url: str,
+        token: Optional[str] = None,
+        method: str = "GET",
+        payload: Any = None,
+    ) -> Response:
+        """Send a request with an optional JSON `payload`, retrying on connection
+        errors, server errors and rate limits. Other errors are left to the caller."""
+        assert self._session is not None, "Fetcher used outside of 'async with'"
+        headers = {}
+        if token is not None:
+            headers["Authorization"] = f"token {token}"
+        host = urlparse(url).netloc
+        delay = self.delay
+        for attempt in range(1, self.tries + 1):
+            await self._wait_for(host)
+            try:
+                async with self._session.request(
+                    method, url, headers=headers, json=payload
+                ) as resp:
+                    response = Response(resp.status, str(resp.url), await resp.read())
+                    # GitHub's secondary rate limits are a 403 with a Retry-After
+                    rate_limited = resp.status == 429 or (
+                        resp.status == 403
+                        and (
+                            resp.headers.get("X-RateLimit-Remaining") == "0"
+                            or "Retry-After" in resp.headers
+                        )
+                    )
+                    wait = retry_after(resp.headers) if rate_limited else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.tries:
+                    raise
+                print(f"{url}: {e!r}, Retrying in {delay} seconds...")
+                await asyncio.sleep(delay)
+            else:
+                if attempt == self.tries or not (
+                    rate_limited or response.status >= 500
+                ):
+                    return response
+                if rate_limited:
+                    self._block(host, delay if wait is None else wait)
+                else:
+                    print(
+                        f"{url}: HTTP Error {response.status}, Retrying in {delay} seconds..."
+                    )
+                    await asyncio.sleep(delay)
+            delay *= self.backoff
+        raise AssertionError("unreachable")
+
+    async def run(self, cmd: List[str], **kwargs: Any) -> bytes:
+        """Run a prefetch command and return its output"""
+        async with self.processes:
+            log.debug("Running %s", cmd)
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.PIPE, **kwargs
+            )
+            out, _ = await proc.communicate()
+            returncode = await proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, out)
+        return out
+
+
+def git_env() -> Dict[str, str]:
+    # like nix-prefetch-git, don't let the user's configuration change checkouts
+    return {
+        **os.environ,
+        "GIT_CONFIG_NOSYSTEM": "1",
+        "GIT_CONFIG_GLOBAL": os.devnull,
+        "GIT_TERMINAL_PROMPT": "0",
+    }
+
+
+class GitMirrors:
+    """Bare mirrors of the git repositories we prefetch, in `path`.
+
+    nix-prefetch-git clones into a new directory every time. Here new commits are
+    fetched into a mirror that is kept between runs, so an update only downloads
+    what changed since the last one. Prefetching checks out the commit and its
+    submodules, which have mirrors of their own, and hashes the checkout the same
+    way fetchgit does.
+    """
 
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.locks: Dict[Path, asyncio.Lock] = {}
 
-def make_request(url: str, token=None) -> urllib.request.Request:
-    headers = {}
-    if token is not None:
-        headers["Authorization"] = f"token {token}"
-    return urllib.request.Request(url, headers=headers)
+    def mirror(self, uri: str) -> Path:
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", uri.rstrip("/").split("/")[-1])
+        digest = hashlib.sha256(uri.encode()).hexdigest()[:16]
+        return self.path / f"{name[:40]}-{digest}.git"
+
+    async def git(self, fetcher: Fetcher, mirror: Path, *args: str, **kwargs: Any):
+        cmd = ["git", f"--git-dir={mirror}", *args]
+        return await fetcher.run(cmd, env=kwargs.pop("env", git_env()), **kwargs)
+
+    async def has(self, fetcher: Fetcher, mirror: Path, commit: str) -> bool:
+        try:
+            await self.git(
+                fetcher,
+                mirror,
+                "cat-file",
+                "-e",
+                f"{commit}^{{commit}}",
+                stderr=subprocess.DEVNULL,
+            )
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    async def fetch(
+        self, fetcher: Fetcher, uri: str, ref: Optional[str], commit: Optional[str]
+    ) -> Tuple[Path, str]:
+        """Fetch `ref` of `uri` into its mirror, unless the mirror already has
+        `commit`. Returns the mirror and the commit, which defaults to `ref`'s."""
+        mirror = self.mirror(uri)
+        ref = ref or "HEAD"
+        # other runs may use the same mirrors, git would fail to update refs
+        async with self.locks.setdefault(mirror, asyncio.Lock()):
+            os.makedirs(self.path, exist_ok=True)
+            with open(f"{mirror}.lock", "w") as lock:
+                await asyncio.to_thread(fcntl.flock, lock, fcntl.LOCK_EX)
+                if not mirror.exists():
+                    await fetcher.run(
+                        ["git", "init", "--quiet", "--bare", str(mirror)], env=git_env()
+                    )
+                if commit is not None and await self.has(fetcher, mirror, commit):
+                    return mirror, commit
+
+                # fetching a branch only downloads objects the mirror doesn't have
+                await self.git(
+                    fetcher,
+                    mirror,
+                    "fetch",
+                    "--quiet",
+                    "--no-tags",
+                    uri,
+                    f"+{ref}:refs/pluginupdate/{ref}",
+                )
+                if commit is None:
+                    out = await self.git(
+                        fetcher, mirror, "rev-parse", f"refs/pluginupdate/{ref}"
+                    )
+                    commit = out.decode().strip()
+                elif not await self.has(fetcher, mirror, commit):
+                    # not on the branch, e.g. a submodule pinned to another one
+                    await self.git(
+                        fetcher,
+                        mirror,
+                        "fetch",
+                        "--quiet",
+                        "--no-tags",
+                        uri,
+                        f"+{commit}:refs/pluginupdate/commits/{commit}",
+                    )
+        return mirror, commit
+
+    async def latest_commit(
+        self, fetcher: Fetcher, uri: str, ref: Optional[str]
+    ) -> Tuple[str, str]:
+        """The commit `ref` points to and its date, like nix-prefetch-git reports"""
+        mirror, commit = await self.fetch(fetcher, uri, ref, None)
+        date = await self.git(fetcher, mirror, "show", "-s", "--format=%cI", commit)
+        return commit, date.decode().strip()
+
+    async def checkout(
+        self,
+        fetcher: Fetcher,
+        uri: str,
+        mirror: Path,
+        commit: str,
+        dest: Path,
+        index: Path,
+    ) -> None:
+        """Check out `commit` and its submodules into `dest`, without .git
+
+        `index` is a scratch index file, it must be outside of `dest`.
+        """
+        env = {**git_env(), "GIT_INDEX_FILE": str(index)}
+        tree = ["--work-tree", str(dest)]
+        await self.git(fetcher, mirror, *tree, "read-tree", commit, env=env)
+        await self.git(fetcher, mirror, *tree, "checkout-index", "-a", "-f", env=env)
+        os.unlink(index)
+
+        out = await self.git(fetcher, mirror, "ls-tree", "-r", "-z", commit)
+        submodules = {}
+        for entry in out.decode().split("\0"):
+            if entry.startswith("160000 commit "):
+                info, path = entry.split("\t", 1)
+                submodules[path] = info.split()[2]
+        if not submodules:
+            return
+
+        urls: Dict[str, str] = {}
+        try:
+            out = await self.git(
+                fetcher,
+                mirror,
+                "config",
+                "--blob",
+                f"{commit}:.gitmodules",
+                "-z",
+                "--get-regexp",
+                r"^submodule\..*\.(path|url)$",
+                stderr=subprocess.DEVNULL,
+            )
+        except subprocess.CalledProcessError:
+            out = b""
+        paths: Dict[str, str] = {}
+        for entry in filter(None, out.decode().split("\0")):
+            key, value = entry.split("\n", 1)
+            name, _, attr = key[len("submodule.") :].rpartition(".")
+            (paths if attr == "path" else urls)[name] = value
+        urls = {paths[name]: url for name, url in urls.items() if name in paths}
+
+        for path, sub_commit in submodules.items():
+            os.makedirs(dest / path, exist_ok=True)
+            # git leaves submodules without an url empty
+            if (url := urls.get(path)) is None:
+                continue
+            if url.startswith(("./", "../")):
+                url = urljoin(uri.rstrip("/") + "/", url)
+            sub_mirror, _ = await self.fetch(fetcher, url, None, sub_commit)
+            await self.checkout(
+                fetcher, url, sub_mirror, sub_commit, dest / path, index
+            )
+
+    async def prefetch(self, fetcher: Fetcher, uri: str, ref: Optional[str]) -> str:
+        """The hash of `fetchgit { fetchSubmodules = true; }` at `ref`"""
+        mirror, commit = await self.fetch(fetcher, uri, ref, ref)
+        with TemporaryDirectory(prefix="pluginupdate-") as tmp:
+            dest = Path(tmp, "checkout")
+            os.mkdir(dest)
+            await self.checkout(fetcher, uri, mirror, commit, dest, Path(tmp, "index"))
+            out = await fetcher.run(
+                ["nix-hash", "--type", "sha256", "--base32", str(dest)]
+            )
+        return out.decode().strip()
 
 
 # a dictionary of plugins and their new repositories
@@ -120,30 +424,34 @@ class Repo:
     def __repr__(self) -> str:
         return f"Repo({self.name}, {self.uri})"
 
-    @retry(urllib.error.URLError, tries=4, delay=3, backoff=2)
-    def has_submodules(self) -> bool:
+    async def has_submodules(self, fetcher: Fetcher) -> bool:
         return True
 
-    @retry(urllib.error.URLError, tries=4, delay=3, backoff=2)
-    def latest_commit(self) -> Tuple[str, datetime]:
+    async def latest_commit(self, fetcher: Fetcher) -> Tuple[str, datetime]:
         log.debug("Latest commit")
-        loaded = self._prefetch(None)
-        updated = datetime.strptime(loaded["date"], "%Y-%m-%dT%H:%M:%S%z")
+        if fetcher.git is not None:
+            rev, date = await fetcher.git.latest_commit(fetcher, self.uri, None)
+        else:
+            loaded = await self._prefetch(fetcher, None)
+            rev, date = loaded["rev"], loaded["date"]
+        updated = datetime.strptime(date, "%Y-%m-%dT%H:%M:%S%z")
 
-        return loaded["rev"], updated
+        return rev, updated
 
-    def _prefetch(self, ref: Optional[str]):
+    async def _prefetch(self, fetcher: Fetcher, ref: Optional[str]):
         cmd = ["nix-prefetch-git", "--quiet", "--fetch-submodules", self.uri]
         if ref is not None:
             cmd.append(ref)
         log.debug(cmd)
-        data = subprocess.check_output(cmd)
+        data = await fetcher.run(cmd)
         loaded = json.loads(data)
         return loaded
 
-    def prefetch(self, ref: Optional[str]) -> str:
+    async def prefetch(self, fetcher: Fetcher, ref: Optional[str]) -> str:
         print("Prefetching")
-        loaded = self._prefetch(ref)
+        if fetcher.git is not None:
+            return await fetcher.git.prefetch(fetcher, self.uri, ref)
+        loaded = await self._prefetch(fetcher, ref)
         return loaded["sha256"]
 
     def as_nix(self, plugin: "Plugin") -> str:
@@ -159,6 +467,9 @@ class RepoGitHub(Repo):
         self.owner = owner
         self.repo = repo
         self.token = None
+        # filled in by fetch_github_metadata, or on first use
+        self._latest_commit: Optional[Tuple[str, datetime]] = None
+        self._has_submodules: Optional[bool] = None
         """Url to the repo"""
         super().__init__(self.url(""), branch)
         log.debug(
@@ -170,49 +481,47 @@ class RepoGitHub(Repo):
         return self.repo
 
     def url(self, path: str) -> str:
-        res = urljoin(f"https://github.com/{self.owner}/{self.repo}/", path)
+        res = urljoin(f"{GITHUB_URL}/{self.owner}/{self.repo}/", path)
         return res
 
-    @retry(urllib.error.URLError, tries=4, delay=3, backoff=2)
-    def has_submodules(self) -> bool:
-        try:
-            req = make_request(self.url(f"blob/{self.branch}/.gitmodules"), self.token)
-            urllib.request.urlopen(req, timeout=10).close()
-        except urllib.error.HTTPError as e:
-            if e.code == 404:
-                return False
-            else:
-                raise
-        return True
-
-    @retry(urllib.error.URLError, tries=4, delay=3, backoff=2)
-    def latest_commit(self) -> Tuple[str, datetime]:
+    async def has_submodules(self, fetcher: Fetcher) -> bool:
+        # asked before prefetching and again by prefetch, only send one request
+        if self._has_submodules is None:
+            url = self.url(f"blob/{self.branch}/.gitmodules")
+            response = await fetcher.request(url, self.token, method="HEAD")
+            if response.status != 404:
+                response.raise_for_status()
+            self._has_submodules = response.status != 404
+        return self._has_submodules
+
+    async def latest_commit(self, fetcher: Fetcher) -> Tuple[str, datetime]:
+        if self._latest_commit is not None:
+            return self._latest_commit
         commit_url = self.url(f"commits/{self.branch}.atom")
         log.debug("Sending request to %s", commit_url)
-        commit_req = make_request(commit_url, self.token)
-        with urllib.request.urlopen(commit_req, timeout=10) as req:
-            self._check_for_redirect(commit_url, req)
-            xml = req.read()
-
-            # Filter out illegal XML characters
-            illegal_xml_regex = re.compile(b"[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]")
-            xml = illegal_xml_regex.sub(b"", xml)
-
-            root = ET.fromstring(xml)
-            latest_entry = root.find(ATOM_ENTRY)
-            assert latest_entry is not None, f"No commits found in repository {self}"
-            commit_link = latest_entry.find(ATOM_LINK)
-            assert commit_link is not None, f"No link tag found feed entry {xml}"
-            url = urlparse(commit_link.get("href"))
-            updated_tag = latest_entry.find(ATOM_UPDATED)
-            assert (
-                updated_tag is not None and updated_tag.text is not None
-            ), f"No updated tag found feed entry {xml}"
-            updated = datetime.strptime(updated_tag.text, "%Y-%m-%dT%H:%M:%SZ")
-            return Path(str(url.path)).name, updated
-
-    def _check_for_redirect(self, url: str, req: http.client.HTTPResponse):
-        response_url = req.geturl()
+        response = await fetcher.request(commit_url, self.token)
+        response.raise_for_status()
+        self._check_for_redirect(commit_url, response.url)
+        xml = response.body
+
+        # Filter out illegal XML characters
+        illegal_xml_regex = re.compile(b"[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]")
+        xml = illegal_xml_regex.sub(b"", xml)
+
+        root = ET.fromstring(xml)
+        latest_entry = root.find(ATOM_ENTRY)
+        assert latest_entry is not None, f"No commits found in repository {self}"
+        commit_link = latest_entry.find(ATOM_LINK)
+        assert commit_link is not None, f"No link tag found feed entry {xml!r}"
+        url = urlparse(commit_link.get("href"))
+        updated_tag = latest_entry.find(ATOM_UPDATED)
+        assert (
+            updated_tag is not None and updated_tag.text is not None
+        ), f"No updated tag found feed entry {xml!r}"
+        updated = datetime.strptime(updated_tag.text, "%Y-%m-%dT%H:%M:%SZ")
+        return Path(str(url.path)).name, updated
+
+    def _check_for_redirect(self, url: str, response_url: str):
         if url != response_url:
             new_owner, new_name = (
                 urllib.parse.urlsplit(response_url).path.strip("/").split("/")[:2]
@@ -221,17 +530,17 @@ class RepoGitHub(Repo):
             new_repo = RepoGitHub(owner=new_owner, repo=new_name, branch=self.branch)
             self.redirect = new_repo
 
-    def prefetch(self, commit: str) -> str:
-        if self.has_submodules():
-            sha256 = super().prefetch(commit)
+    async def prefetch(self, fetcher: Fetcher, commit: Optional[str]) -> str:
+        assert commit is not None
+        if await self.has_submodules(fetcher):
+            sha256 = await super().prefetch(fetcher, commit)
         else:
-            sha256 = self.prefetch_github(commit)
+            sha256 = await self.prefetch_github(fetcher, commit)
         return sha256
 
-    def prefetch_github(self, ref: str) -> str:
+    async def prefetch_github(self, fetcher: Fetcher, ref: str) -> str:
         cmd = ["nix-prefetch-url", "--unpack", self.url(f"archive/{ref}.tar.gz")]
-        log.debug("Running %s", cmd)
-        data = subprocess.check_output(cmd)
+        data = await fetcher.run(cmd)
         return data.strip().decode("utf-8")
 
     def as_nix(self, plugin: "Plugin") -> str:
@@ -248,6 +557,62 @@ class RepoGitHub(Repo):
     }}"""
 
 
+async def fetch_github_metadata(
+    fetcher: Fetcher, repos: List[RepoGitHub], token: str
+) -> None:
+    """Look up the latest commit, whether there are submodules and where the
+    repository moved to for all `repos` with one GraphQL query.
+
+    Repositories the query has no answer for are left alone and fall back to
+    fetching their commit feed.
+    """
+    params: List[str] = []
+    fields: List[str] = []
+    variables: Dict[str, str] = {}
+    for n, repo in enumerate(repos):
+        params.append(f"$o{n}: String!, $r{n}: String!, $c{n}: String!, $g{n}: String!")
+        fields.append(
+            f"""
+  r{n}: repository(owner: $o{n}, name: $r{n}) {{
+    nameWithOwner
+    commit: object(expression: $c{n}) {{ ... on Commit {{ oid committedDate }} }}
+    gitmodules: object(expression: $g{n}) {{ __typename }}
+  }}"""
+        )
+        variables[f"o{n}"] = repo.owner
+        variables[f"r{n}"] = repo.repo
+        variables[f"c{n}"] = repo.branch
+        variables[f"g{n}"] = f"{repo.branch}:.gitmodules"
+    query = f"query({', '.join(params)}) {{{''.join(fields)}\n}}"
+
+    try:
+        response = await fetcher.request(
+            GITHUB_GRAPHQL,
+            token,
+            method="POST",
+            payload={"query": query, "variables": variables},
+        )
+        response.raise_for_status()
+        data = json.loads(response.body).get("data") or {}
+    except Exception as e:
+        log.warning("GraphQL query failed, fetching commit feeds instead: %s", e)
+        return
+
+    for n, repo in enumerate(repos):
+        result = data.get(f"r{n}")
+        if result is None or result.get("commit") is None:
+            # e.g. the repository or branch doesn't exist, the commit feed will
+            # report that
+            continue
+        commit = result["commit"]
+        updated = datetime.strptime(commit["committedDate"], "%Y-%m-%dT%H:%M:%SZ")
+        repo._latest_commit = (commit["oid"], updated)
+        repo._has_submodules = result["gitmodules"] is not None
+        owner, name = result["nameWithOwner"].split("/")
+        if f"{owner}/{name}".lower() != f"{repo.owner}/{repo.repo}".lower():
+            repo.redirect = RepoGitHub(owner=owner, repo=name, branch=repo.branch)
+
+
 @dataclass(frozen=True)
 class PluginDesc:
     repo: Repo
@@ -372,13 +737,15 @@ class Editor:
         self.default_in = default_in or root.joinpath(f"{name}-plugin-names")
         self.default_out = default_out or root.joinpath("generated.nix")
         self.deprecated = deprecated or root.joinpath("deprecated.json")
-        self.cache_file = cache_file or f"{name}-plugin-cache.json"
+        self.cache_file = cache_file or f"{name}-plugin-cache.sqlite"
         self.nixpkgs_repo = None
 
     def add(self, args):
         """CSV spec"""
         log.debug("called the 'add' command")
-        fetch_config = FetchConfig(args.proc, args.github_token)
+        fetch_config = FetchConfig(
+            args.proc, args.github_token, args.connections_per_host, args.git_mirrors
+        )
         editor = self
         for plugin_line in args.add_plugins:
             log.debug("using plugin_line", plugin_line)
@@ -426,16 +793,16 @@ class Editor:
 
     def get_update(self, input_file: str, outfile: str, config: FetchConfig):
         cache: Cache = Cache(self.get_current_plugins(self.nixpkgs), self.cache_file)
-        _prefetch = functools.partial(prefetch, cache=cache)
 
         def update() -> dict:
             plugins = self.load_plugin_spec(config, input_file)
 
+            # update is run a second time to resolve redirects
+            cache.connect()
             try:
-                pool = Pool(processes=config.proc)
-                results = pool.map(_prefetch, plugins)
+                results = asyncio.run(prefetch_plugins(plugins, cache, config))
             finally:
-                cache.store()
+                cache.close()
 
             plugins, redirects = check_results(results)
 
@@ -492,14 +859,26 @@ class Editor:
             dest="proc",
             type=int,
             default=30,
-            help="Number of concurrent processes to spawn. Setting --github-token allows higher values.",
+            help="Number of concurrent prefetch processes to spawn.",
+        )
+        common.add_argument(
+            "--connections-per-host",
+            type=int,
+            default=16,
+            help="Number of concurrent connections to each host. Setting --github-token allows higher values.",
+        )
+        common.add_argument(
+            "--no-git-mirrors",
+            dest="git_mirrors",
+            action="store_false",
+            help="Clone repositories with nix-prefetch-git instead of fetching them into mirrors in $XDG_CACHE_HOME/nixpkgs-git-mirrors.",
         )
         common.add_argument(
             "--github-token",
             "-t",
             type=str,
             default=os.getenv("GITHUB_API_TOKEN"),
-            help="""Allows to set --proc to higher values.
+            help="""Allows to set --connections-per-host to higher values.
             Uses GITHUB_API_TOKEN environment variables as the default value.""",
         )
         common.add_argument(
@@ -586,30 +965,49 @@ class CleanEnvironment(object):
         self.empty_config.close()
 
 
-def prefetch_plugin(
+async def fetch_plugin(
     p: PluginDesc,
+    fetcher: Fetcher,
     cache: "Optional[Cache]" = None,
 ) -> Tuple[Plugin, Optional[Repo]]:
     repo, branch, alias = p.repo, p.branch, p.alias
     name = alias or p.repo.name
     commit = None
     log.info(f"Fetching last commit for plugin {name} from {repo.uri}@{branch}")
-    commit, date = repo.latest_commit()
-    cached_plugin = cache[commit] if cache else None
+    commit, date = await repo.latest_commit(fetcher)
+    cached_plugin = cache.get(repo.uri, commit) if cache else None
     if cached_plugin is not None:
         log.debug("Cache hit !")
         cached_plugin.name = name
         cached_plugin.date = date
+        if cache and repo.redirect is not None:
+            # the next run, after resolving the redirect, looks for the new uri
+            cache.add(repo.redirect.uri, cached_plugin)
         return cached_plugin, repo.redirect
 
-    has_submodules = repo.has_submodules()
+    has_submodules = await repo.has_submodules(fetcher)
     log.debug(f"prefetch {name}")
-    sha256 = repo.prefetch(commit)
+    sha256 = await repo.prefetch(fetcher, commit)
 
-    return (
-        Plugin(name, commit, has_submodules, sha256, date=date),
-        repo.redirect,
-    )
+    plugin = Plugin(name, commit, has_submodules, sha256, date=date)
+    if cache:
+        cache.add(repo.uri, plugin)
+        if repo.redirect is not None:
+            cache.add(repo.redirect.uri, plugin)
+    return plugin, repo.redirect
+
+
+def prefetch_plugin(
+    p: PluginDesc,
+    cache: "Optional[Cache]" = None,
+) -> Tuple[Plugin, Optional[Repo]]:
+    """Prefetch a single plugin, outside of an update of all plugins"""
+
+    async def run() -> Tuple[Plugin, Optional[Repo]]:
+        async with Fetcher(FetchConfig(1, p.repo.token)) as fetcher:
+            return await fetch_plugin(p, fetcher, cache)
+
+    return asyncio.run(run())
 
 
 def print_download_error(plugin: PluginDesc, ex: Exception):
@@ -676,58 +1074,171 @@ def get_cache_path(cache_file_name: str) -> Optional[Path]:
 
 
 class Cache:
+    """Prefetch results by repository, commit and whether submodules are fetched.
+
+    Results are kept in an SQLite database and committed as soon as they are known,
+    so an interrupted update keeps what it has prefetched. SQLite's locking lets
+    several updaters use the same database at once. Entries unused for `max_age`
+    seconds are dropped when the cache is opened, at most every `compact_interval`.
+
+    The plugins currently in nixpkgs are only known by commit, they are looked up
+    after the database.
+    """
+
+    max_age = 90 * 24 * 3600
+    compact_interval = 24 * 3600
+
     def __init__(self, initial_plugins: List[Plugin], cache_file_name: str) -> None:
         self.cache_file = get_cache_path(cache_file_name)
+        self.initial = {plugin.commit: plugin for plugin in initial_plugins}
+        self.lock = threading.Lock()
+        # hits only update the time an entry was last used, that is written at once
+        # when closing
+        self.used: Dict[Tuple[str, str, bool], float] = {}
+        # plugins added by this process, also when there is no database
+        self.added: Dict[Tuple[str, str], Plugin] = {}
+        self.db: Optional[sqlite3.Connection] = None
+        self.connect()
+        if self.db is not None:
+            self.compact()
+
+    def connect(self) -> None:
+        """Open the database, also to use the cache again after close()"""
+        if self.db is None and self.cache_file is not None:
+            self.db = self.open(self.cache_file)
 
-        downloads = {}
-        for plugin in initial_plugins:
-            downloads[plugin.commit] = plugin
-        downloads.update(self.load())
-        self.downloads = downloads
-
-    def load(self) -> Dict[str, Plugin]:
-        if self.cache_file is None or not self.cache_file.exists():
-            return {}
-
-        downloads: Dict[str, Plugin] = {}
-        with open(self.cache_file) as f:
-            data = json.load(f)
-            for attr in data.values():
-                p = Plugin(
-                    attr["name"], attr["commit"], attr["has_submodules"], attr["sha256"]
-                )
-                downloads[attr["commit"]] = p
-        return downloads
+    @staticmethod
+    def open(path: Path) -> sqlite3.Connection:
+        os.makedirs(path.parent, exist_ok=True)
+        db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS plugins (
+                uri TEXT NOT NULL,
+                rev TEXT NOT NULL,
+                has_submodules INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                used REAL NOT NULL,
+                PRIMARY KEY (uri, rev, has_submodules)
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+            """
+        )
+        return db
 
-    def store(self) -> None:
-        if self.cache_file is None:
+    def compact(self) -> None:
+        assert self.db is not None
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(
+                    "SELECT value FROM meta WHERE key = 'compacted'"
+                ).fetchone()
+                if row is not None and now - row[0] < self.compact_interval:
+                    return
+                deleted = self.db.execute(
+                    "DELETE FROM plugins WHERE used < ?", (now - self.max_age,)
+                ).rowcount
+                self.db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('compacted', ?)", (now,)
+                )
+            finally:
+                self.db.execute("COMMIT")
+            if deleted:
+                log.debug("Dropped %d unused cache entries", deleted)
+                self.db.execute("VACUUM")
+
+    def get(self, uri: str, commit: str) -> Optional[Plugin]:
+        """A prefetched plugin, the caller may modify it"""
+        if (uri, commit) in self.added:
+            return replace(self.added[(uri, commit)])
+        if self.db is not None:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT name, has_submodules, sha256 FROM plugins"
+                    " WHERE uri = ? AND rev = ? ORDER BY used DESC LIMIT 1",
+                    (uri, commit),
+                ).fetchone()
+            if row is not None:
+                name, has_submodules, sha256 = row
+                self.used[(uri, commit, bool(has_submodules))] = time.time()
+                return Plugin(name, commit, bool(has_submodules), sha256)
+        plugin = self.initial.get(commit)
+        return replace(plugin) if plugin is not None else None
+
+    def add(self, uri: str, plugin: Plugin) -> None:
+        self.added[(uri, plugin.commit)] = replace(plugin)
+        if self.db is None:
             return
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO plugins VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    uri,
+                    plugin.commit,
+                    plugin.has_submodules,
+                    plugin.name,
+                    plugin.sha256,
+                    time.time(),
+                ),
+            )
 
-        os.makedirs(self.cache_file.parent, exist_ok=True)
-        with open(self.cache_file, "w+") as f:
-            data = {}
-            for name, attr in self.downloads.items():
-                data[name] = attr.as_json()
-            json.dump(data, f, indent=4, sort_keys=True)
-
-    def __getitem__(self, key: str) -> Optional[Plugin]:
-        return self.downloads.get(key, None)
-
-    def __setitem__(self, key: str, value: Plugin) -> None:
-        self.downloads[key] = value
+    def close(self) -> None:
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.executemany(
+                "UPDATE plugins SET used = ?"
+                " WHERE uri = ? AND rev = ? AND has_submodules = ?",
+                [(used, *key) for key, used in self.used.items()],
+            )
+            self.used.clear()
+            self.db.close()
+            self.db = None
 
 
-def prefetch(
-    pluginDesc: PluginDesc, cache: Cache
+async def prefetch(
+    pluginDesc: PluginDesc, cache: Cache, fetcher: Fetcher
 ) -> Tuple[PluginDesc, Union[Exception, Plugin], Optional[Repo]]:
     try:
-        plugin, redirect = prefetch_plugin(pluginDesc, cache)
-        cache[plugin.commit] = plugin
+        plugin, redirect = await fetch_plugin(pluginDesc, fetcher, cache)
         return (pluginDesc, plugin, redirect)
     except Exception as e:
         return (pluginDesc, e, None)
 
 
+async def prefetch_plugins(
+    plugins: List[PluginDesc], cache: Cache, config: FetchConfig
+) -> List[Tuple[PluginDesc, Union[Exception, Plugin], Optional[Repo]]]:
+    """Prefetch all plugins concurrently, within the limits of `config`.
+
+    With a GitHub token, plugins are looked up in batches with GraphQL, each batch
+    is prefetched as soon as its query returns."""
+
+    async def prefetch_batch(batch: List[PluginDesc]):
+        repos = [p.repo for p in batch if isinstance(p.repo, RepoGitHub)]
+        if config.github_token and repos:
+            await fetch_github_metadata(fetcher, repos, config.github_token)
+        return await asyncio.gather(
+            *(prefetch(plugin, cache, fetcher) for plugin in batch)
+        )
+
+    async with Fetcher(config) as fetcher:
+        batches = await asyncio.gather(
+            *(
+                prefetch_batch(plugins[i : i + GITHUB_BATCH_SIZE])
+                for i in range(0, len(plugins), GITHUB_BATCH_SIZE)
+            )
+        )
+    return [result for batch in batches for result in batch]
+
+
 def rewrite_input(
     config: FetchConfig,
     input_file: Path,
@@ -785,7 +1296,9 @@ def update_plugins(editor: Editor, args):
     All input arguments are grouped in the `Editor`."""
 
     log.info("Start updating plugins")
-    fetch_config = FetchConfig(args.proc, args.github_token)
+    fetch_config = FetchConfig(
+        args.proc, args.github_token, args.connections_per_host, args.git_mirrors
+    )
     update = editor.get_update(args.input_file, args.outfile, fetch_config)
 
     redirects = update()
@@ -5,9 +5,9 @@ from abc import ABC, abstractclassmethod, abstractmethod
 from contextlib import contextmanager
 from pathlib import Path
 from structlog.contextvars import bound_contextvars as log_context
-from typing import ClassVar, List, Tuple
+from typing import ClassVar, Iterator, List, Optional, Tuple
 
-import hashlib, re, structlog
+import hashlib, os, re, structlog
 
 
 logger = structlog.getLogger("sha-to-SRI")
@@ -126,8 +126,12 @@ _DEF_RE = re.compile("|".join(
 ))
 
 
-def defToSRI(s: str) -> str:
+def defsToSRI(s: str) -> Tuple[str, int]:
+    """Like `defToSRI`, also returns the number of hashes converted."""
+    converted = 0
+
     def f(m: re.Match[str]) -> str:
+        nonlocal converted
         try:
             for h, encodings in ENCODINGS.items():
                 if m.group(h) is None:
@@ -136,7 +140,9 @@ def defToSRI(s: str) -> str:
                 for e in encodings:
                     s = m.group(f"{h}_{e.name}")
                     if s is not None:
-                        return f'hash = "{e.toSRI(s)}";'
+                        sri = e.toSRI(s)
+                        converted += 1
+                        return f'hash = "{sri}";'
 
                 raise ValueError(f"Match with '{h}' but no subgroup")
             raise ValueError("Match with no hash")
@@ -148,7 +154,11 @@ def defToSRI(s: str) -> str:
             )
             return m.group()
 
-    return _DEF_RE.sub(f, s)
+    return _DEF_RE.sub(f, s), converted
+
+
+def defToSRI(s: str) -> str:
+    return defsToSRI(s)[0]
 
 
 @contextmanager
@@ -185,44 +195,121 @@ def atomicFileUpdate(target: Path):
         raise
 
 
-def fileToSRI(p: Path):
-    with atomicFileUpdate(p) as (og, new):
-        for i, line in enumerate(og):
-            with log_context(line=i):
-                new.write(defToSRI(line))
-
+# Every definition `_DEF_RE` can match contains one of these, and checking for them
+# is much cheaper than running the regex over every line of every file.
+_PREFILTER = tuple(f"{h} = " for h in ENCODINGS)
 
 _SKIP_RE = re.compile(
     "(generated by)|(do not edit)",
     re.IGNORECASE
 )
+_FIRST_LINE_RE = re.compile(r"\s*(.*)")
+
+
+def fileToSRI(p: Path, text: Optional[str] = None) -> int:
+    """Convert all hashes in `p`, returns the number of hashes converted.
+
+    `text` is the current content of `p`, if the caller has already read it.
+    The file is only rewritten if anything was converted."""
+    if text is None:
+        text = p.read_text()
+    if not any(s in text for s in _PREFILTER):
+        return 0
+
+    converted = 0
+    lines = []
+    for i, line in enumerate(text.splitlines(keepends = True)):
+        with log_context(line=i):
+            line, n = defsToSRI(line)
+            lines.append(line)
+            converted += n
+
+    if converted > 0:
+        with atomicFileUpdate(p) as (_, new):
+            new.writelines(lines)
+
+    return converted
+
+
+def looksGenerated(text: str) -> bool:
+    """Whether the first non-blank line of `text` marks it as autogenerated."""
+    firstLine = _FIRST_LINE_RE.match(text)
+    return firstLine is not None and _SKIP_RE.search(firstLine.group(1)) is not None
+
+
+def processFile(p: Path) -> Tuple[str, int]:
+    """Process a single file, returns its status and the number of hashes converted.
+
+    Runs in worker processes, and never raises."""
+    with log_context(path=str(p)):
+        try:
+            if p.name == "yarn.nix" or p.name.find("generated") != -1:
+                logger.warning("File looks autogenerated, skipping!")
+                return "generated", 0
+
+            text = p.read_text()
+            if looksGenerated(text):
+                logger.warning("File looks autogenerated, skipping!")
+                return "generated", 0
+
+            converted = fileToSRI(p, text)
+        except Exception as exn:
+            logger.error(
+                "Unhandled exception, skipping file!",
+                exc_info = exn,
+            )
+            return "failed", 0
+        else:
+            if converted > 0:
+                logger.info("Finished processing file", converted=converted)
+                return "changed", converted
+            return "unchanged", 0
+
+
+def walk(paths: List[Path]) -> Iterator[Path]:
+    """Yield all files in `paths`, and all `.nix` files below directories in them."""
+    for p in paths:
+        if not p.is_dir():
+            yield p
+            continue
+
+        for root, dirs, files in os.walk(p):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if name.endswith(".nix"):
+                    yield Path(root, name)
+
 
 if __name__ == "__main__":
-    from sys import argv, stderr
-    logger.info("Starting!")
+    from argparse import ArgumentParser
+    from collections import Counter
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = ArgumentParser(description = "Convert sha256/sha512 hashes in Nix files to SRI hashes.")
+    parser.add_argument(
+        "-j", "--jobs", type = int, default = os.cpu_count(),
+        help = "Number of files processed in parallel",
+    )
+    parser.add_argument(
+        "paths", nargs = "+", type = Path, metavar = "PATH",
+        help = "Files to convert, or directories to search for .nix files",
+    )
+    args = parser.parse_args()
 
-    for arg in argv[1:]:
-        p = Path(arg)
-        with log_context(path=str(p)):
-            try:
-                if p.name == "yarn.nix" or p.name.find("generated") != -1:
-                    logger.warning("File looks autogenerated, skipping!")
-                    continue
+    logger.info("Starting!")
 
-                with p.open() as f:
-                    for line in f:
-                        if line.strip():
-                            break
-
-                    if _SKIP_RE.search(line):
-                        logger.warning("File looks autogenerated, skipping!")
-                        continue
-
-                fileToSRI(p)
-            except Exception as exn:
-                logger.error(
-                    "Unhandled exception, skipping file!",
-                    exc_info = exn,
-                )
-            else:
-                logger.info("Finished processing file")
+    files: Counter[str] = Counter()
+    hashes = 0
+    with ProcessPoolExecutor(max_workers = args.jobs) as pool:
+        for status, converted in pool.map(processFile, walk(args.paths), chunksize = 64):
+            files[status] += 1
+            hashes += converted
+
+    logger.info(
+        "Done!",
+        files = sum(files.values()),
+        changed = files["changed"],
+        generated = files["generated"],
+        failed = files["failed"],
+        hashes = hashes,
+    )
@@ -0,0 +1,483 @@
+# Tests for the fetching engine of pluginupdate.py. Not used by the build.
+#
+# A local server stands in for GitHub and the prefetch commands are replaced by
+# scripts in a temporary PATH, so this runs offline:
+#
+#   python maintainers/scripts/test-pluginupdate.py
+
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pluginupdate
+
+FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <entry>
+    <updated>2024-01-02T03:04:05Z</updated>
+    <link rel="alternate" type="text/html" href="https://github.com/{owner}/{repo}/commit/{rev}"/>
+  </entry>
+</feed>
+"""
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves commit feeds and .gitmodules of fake repositories.
+
+    `old/moved` redirects to `new/moved`, `with/submodules` has submodules, and
+    `busy/repo` answers its first request with a 429. `missing` repositories don't
+    exist.
+
+    POST /graphql answers GraphQL queries about these repositories, or fails with
+    `graphql_status` if that is set.
+    """
+
+    protocol_version = "HTTP/1.1"
+    requests: list = []
+    connections: set = set()
+    limited: set = set()
+    graphql_status = None
+
+    def respond(self, status, body=b"", headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        Handler.requests.append((self.command, self.path, time.monotonic()))
+        Handler.connections.add(self.client_address)
+        owner, repo, kind, rest = self.path.strip("/").split("/", 3)
+        if owner == "old":
+            self.respond(301, headers={"Location": self.path.replace("/old/", "/new/", 1)})
+        elif owner == "busy" and self.path not in Handler.limited:
+            Handler.limited.add(self.path)
+            self.respond(429, headers={"Retry-After": "1"})
+        elif repo == "missing":
+            self.respond(404)
+        elif kind == "commits":
+            rev = f"{owner}-{repo}-rev"
+            self.respond(200, FEED.format(owner=owner, repo=repo, rev=rev).encode())
+        elif kind == "blob":
+            self.respond(200 if owner == "with" else 404)
+        else:
+            self.respond(404)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        Handler.requests.append((self.command, self.path, time.monotonic()))
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path != "/graphql" or Handler.graphql_status is not None:
+            self.respond(Handler.graphql_status or 404)
+            return
+        variables = request["variables"]
+        data, errors, n = {}, [], 0
+        while f"o{n}" in variables:
+            owner, repo = variables[f"o{n}"], variables[f"r{n}"]
+            # every repository needs its own alias and variables in the query
+            assert f"r{n}: repository(owner: $o{n}, name: $r{n})" in request["query"]
+            if repo == "missing":
+                data[f"r{n}"] = None
+                errors.append({"type": "NOT_FOUND", "path": [f"r{n}"]})
+            else:
+                if owner == "old":
+                    owner = "new"
+                data[f"r{n}"] = {
+                    "nameWithOwner": f"{owner}/{repo}",
+                    "commit": {
+                        "oid": f"{owner}-{repo}-rev",
+                        "committedDate": "2024-01-02T03:04:05Z",
+                    },
+                    "gitmodules": {"__typename": "Blob"} if owner == "with" else None,
+                }
+            n += 1
+        body = {"data": data}
+        if errors:
+            body["errors"] = errors
+        self.respond(200, json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+PREFETCH_URL = """#!/bin/sh
+echo "$@" >> "$PREFETCH_LOG"
+sleep 0.2
+echo 0000000000000000000000000000000000000000000000000000
+"""
+
+PREFETCH_GIT = """#!/bin/sh
+echo "$@" >> "$PREFETCH_LOG"
+echo '{"sha256": "1111111111111111111111111111111111111111111111111111"}'
+"""
+
+# keeps the last checkout that was hashed, for inspection
+NIX_HASH = """#!/bin/sh
+for dir; do :; done
+rm -rf "$CHECKOUT_COPY"
+cp -a "$dir" "$CHECKOUT_COPY"
+cd "$dir" && find . | sort | sha256sum | cut -c1-52
+"""
+
+
+tools = tempfile.TemporaryDirectory()
+
+
+def setUpModule():
+    for name, script in [
+        ("nix-prefetch-url", PREFETCH_URL),
+        ("nix-prefetch-git", PREFETCH_GIT),
+        ("nix-hash", NIX_HASH),
+    ]:
+        path = os.path.join(tools.name, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = tools.name + os.pathsep + os.environ["PATH"]
+
+
+def tearDownModule():
+    tools.cleanup()
+
+
+class Server(ThreadingHTTPServer):
+    # the default backlog of 5 delays concurrent connections by a second
+    request_queue_size = 64
+
+
+class FetcherTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        pluginupdate.GITHUB_URL = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        pluginupdate.GITHUB_GRAPHQL = f"{pluginupdate.GITHUB_URL}/graphql"
+
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.environ["PREFETCH_LOG"] = os.path.join(cls.tmp.name, "log")
+        os.environ["XDG_CACHE_HOME"] = cls.tmp.name
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        Handler.requests = []
+        Handler.connections = set()
+        Handler.limited = set()
+        Handler.graphql_status = None
+        os.environ["XDG_CACHE_HOME"] = self.tmp.name
+        for name in ["log", "cache.sqlite"]:
+            if os.path.exists(os.path.join(self.tmp.name, name)):
+                os.unlink(os.path.join(self.tmp.name, name))
+
+    def prefetch(self, names, config, initial=[]):
+        # the stand-in server doesn't speak git
+        config = pluginupdate.FetchConfig(*config, git_mirrors=False)
+        plugins = [
+            pluginupdate.PluginDesc.load_from_string(config, name) for name in names
+        ]
+        cache = pluginupdate.Cache(initial, "cache.sqlite")
+        try:
+            return asyncio.run(pluginupdate.prefetch_plugins(plugins, cache, config))
+        finally:
+            cache.close()
+
+    def prefetched(self):
+        if not os.path.exists(os.environ["PREFETCH_LOG"]):
+            return 0
+        with open(os.environ["PREFETCH_LOG"]) as f:
+            return len(f.readlines())
+
+    def test_prefetch(self):
+        [(_, plugin, redirect)] = self.prefetch(["owner/plain"], (1, None))
+        self.assertEqual(plugin.commit, "owner-plain-rev")
+        self.assertEqual(plugin.version, "2024-01-02")
+        self.assertFalse(plugin.has_submodules)
+        self.assertEqual(plugin.sha256, "0" * 52)
+        self.assertIsNone(redirect)
+        # .gitmodules is only asked for once
+        self.assertEqual(
+            [(m, p) for m, p, _ in Handler.requests],
+            [
+                ("GET", "/owner/plain/commits/HEAD.atom"),
+                ("HEAD", "/owner/plain/blob/HEAD/.gitmodules"),
+            ],
+        )
+
+    def test_submodules(self):
+        [(_, plugin, _)] = self.prefetch(["with/submodules"], (1, None))
+        self.assertTrue(plugin.has_submodules)
+        self.assertEqual(plugin.sha256, "1" * 52)
+        self.assertEqual(self.prefetched(), 1)
+        with open(os.environ["PREFETCH_LOG"]) as f:
+            self.assertIn("--fetch-submodules", f.read())
+
+    def test_redirect(self):
+        [(_, plugin, redirect)] = self.prefetch(["old/moved"], (1, None))
+        self.assertEqual(plugin.commit, "new-moved-rev")
+        self.assertEqual((redirect.owner, redirect.repo), ("new", "moved"))
+
+    def test_connections_are_reused(self):
+        names = [f"owner/plugin{n}" for n in range(40)]
+        results = self.prefetch(names, (8, None, 4))
+        self.assertTrue(all(isinstance(r, pluginupdate.Plugin) for _, r, _ in results))
+        self.assertEqual(len(Handler.requests), 80)
+        self.assertLessEqual(len(Handler.connections), 4)
+
+    def test_prefetch_overlaps_requests(self):
+        # with one prefetch process at a time, 10 prefetches take 2s. The requests
+        # for all plugins must not wait for them.
+        names = [f"owner/plugin{n}" for n in range(10)]
+        start = time.monotonic()
+        self.prefetch(names, (1, None))
+        feeds = [t for m, p, t in Handler.requests if p.endswith(".atom")]
+        self.assertLess(max(feeds) - start, 1.0)
+
+    def test_rate_limit(self):
+        start = time.monotonic()
+        [(_, plugin, _)] = self.prefetch(["busy/repo"], (1, None))
+        self.assertEqual(plugin.commit, "busy-repo-rev")
+        self.assertGreaterEqual(time.monotonic() - start, 1.0)
+        # the second request waited for Retry-After, not the default backoff
+        times = [t for _, p, t in Handler.requests if p.endswith(".atom")]
+        self.assertEqual(len(times), 2)
+        self.assertLess(times[1] - times[0], 2.0)
+
+    def test_cache(self):
+        [(_, first, _)] = self.prefetch(["owner/plain"], (1, None))
+        [(_, second, _)] = self.prefetch(["owner/plain"], (1, None))
+        self.assertEqual(first, second)
+        self.assertEqual(self.prefetched(), 1)
+        # the same commit in another repository is prefetched again
+        self.prefetch(["owner/plain as alias", "fork/plain"], (1, None))
+        self.assertEqual(self.prefetched(), 2)
+
+    def test_cache_across_redirect_pass(self):
+        # like Editor.get_update, which runs again after resolving redirects
+        config = pluginupdate.FetchConfig(1, None, git_mirrors=False)
+        cache = pluginupdate.Cache([], "cache.sqlite")
+        for name in ["old/moved", "new/moved"]:
+            plugins = [pluginupdate.PluginDesc.load_from_string(config, name)]
+            cache.connect()
+            try:
+                [(_, plugin, _)] = asyncio.run(
+                    pluginupdate.prefetch_plugins(plugins, cache, config)
+                )
+            finally:
+                cache.close()
+            self.assertEqual(plugin.commit, "new-moved-rev")
+        self.assertEqual(self.prefetched(), 1)
+
+    def test_initial_plugins(self):
+        current = pluginupdate.Plugin("plain", "owner-plain-rev", False, "2" * 52)
+        [(_, plugin, _)] = self.prefetch(["owner/plain"], (1, None), [current])
+        self.assertEqual(plugin.sha256, "2" * 52)
+        self.assertEqual(self.prefetched(), 0)
+
+    def test_cache_keeps_results_of_failed_runs(self):
+        cache = pluginupdate.Cache([], "cache.sqlite")
+        plugin = pluginupdate.Plugin("a", "rev", True, "3" * 52)
+        cache.add("https://example.org/a", plugin)
+        # no close(), as if the updater crashed
+        other = pluginupdate.Cache([], "cache.sqlite")
+        self.assertEqual(other.get("https://example.org/a", "rev"), plugin)
+        self.assertIsNone(other.get("https://example.org/b", "rev"))
+        other.close()
+        cache.close()
+
+    def test_concurrent_writers(self):
+        caches = [pluginupdate.Cache([], "cache.sqlite") for _ in range(4)]
+
+        def write(n, cache):
+            for i in range(50):
+                cache.add(f"uri{n}", pluginupdate.Plugin("p", f"rev{i}", False, ""))
+
+        threads = [
+            threading.Thread(target=write, args=(n, cache))
+            for n, cache in enumerate(caches)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for cache in caches:
+            cache.close()
+
+        cache = pluginupdate.Cache([], "cache.sqlite")
+        [count] = cache.db.execute("SELECT count(*) FROM plugins").fetchone()
+        self.assertEqual(count, 200)
+        cache.close()
+
+    def test_compaction(self):
+        cache = pluginupdate.Cache([], "cache.sqlite")
+        cache.add("old", pluginupdate.Plugin("old", "rev", False, ""))
+        cache.add("new", pluginupdate.Plugin("new", "rev", False, ""))
+        cache.db.execute(
+            "UPDATE plugins SET used = used - ? WHERE uri = 'old'",
+            (cache.max_age + 1,),
+        )
+        cache.db.execute("UPDATE meta SET value = 0 WHERE key = 'compacted'")
+        cache.close()
+
+        cache = pluginupdate.Cache([], "cache.sqlite")
+        self.assertIsNone(cache.get("old", "rev"))
+        self.assertIsNotNone(cache.get("new", "rev"))
+        cache.close()
+
+    def test_graphql(self):
+        names = ["owner/plain", "with/submodules", "old/moved", "owner/missing"]
+        results = self.prefetch(names, (1, "token"))
+        [plain, submodules, moved, missing] = [result for _, result, _ in results]
+        self.assertEqual(plain.commit, "owner-plain-rev")
+        self.assertEqual(plain.version, "2024-01-02")
+        self.assertFalse(plain.has_submodules)
+        self.assertTrue(submodules.has_submodules)
+        self.assertEqual(moved.commit, "new-moved-rev")
+        redirect = results[2][2]
+        self.assertEqual((redirect.owner, redirect.repo), ("new", "moved"))
+        self.assertNotIsInstance(missing, pluginupdate.Plugin)
+        # one query, only the missing repository falls back to its feed
+        self.assertEqual(
+            [(m, p) for m, p, _ in Handler.requests],
+            [("POST", "/graphql"), ("GET", "/owner/missing/commits/HEAD.atom")],
+        )
+
+    def test_graphql_batches(self):
+        names = [f"owner/plugin{n}" for n in range(250)]
+        results = self.prefetch(names, (32, "token"))
+        self.assertEqual(
+            [r.commit for _, r, _ in results],
+            [f"owner-plugin{n}-rev" for n in range(250)],
+        )
+        self.assertEqual([p for _, p, _ in Handler.requests], ["/graphql"] * 3)
+
+    def test_graphql_failure(self):
+        Handler.graphql_status = 401
+        [(_, plugin, _)] = self.prefetch(["owner/plain"], (1, "token"))
+        self.assertEqual(plugin.commit, "owner-plain-rev")
+        self.assertEqual(
+            [p for _, p, _ in Handler.requests],
+            [
+                "/graphql",
+                "/owner/plain/commits/HEAD.atom",
+                "/owner/plain/blob/HEAD/.gitmodules",
+            ],
+        )
+
+    def test_errors(self):
+        [(_, result, _)] = self.prefetch(["owner/missing"], (1, None))
+        self.assertNotIsInstance(result, pluginupdate.Plugin)
+
+
+def git(cwd, *args):
+    env = {**os.environ, **pluginupdate.git_env()}
+    env.update(GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@example.org")
+    env.update(GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@example.org")
+    return subprocess.run(
+        ["git", *args], cwd=cwd, env=env, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+class GitMirrorsTest(unittest.TestCase):
+    """Prefetches repositories with file:// remotes through mirrors"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        os.environ["XDG_CACHE_HOME"] = str(self.root / "cache")
+        os.environ["CHECKOUT_COPY"] = str(self.root / "checkout")
+
+        # lib is used as a submodule of plugin, with a relative url
+        for name in ["lib", "plugin"]:
+            (self.root / name).mkdir()
+            git(self.root / name, "init", "-q", "-b", "main")
+            (self.root / name / f"{name}.vim").write_text(f"{name} 1\n")
+            git(self.root / name, "add", ".")
+            git(self.root / name, "commit", "-q", "-m", "init")
+        git(
+            self.root / "plugin",
+            "-c",
+            "protocol.file.allow=always",
+            "submodule",
+            "add",
+            "-q",
+            "../lib",
+            "deps/lib",
+        )
+        git(self.root / "plugin", "commit", "-q", "-m", "add lib")
+        self.repo = pluginupdate.Repo(f"file://{self.root}/plugin", "")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_fetcher(self, f):
+        async def run():
+            async with pluginupdate.Fetcher(pluginupdate.FetchConfig(2, None)) as fetcher:
+                return await f(fetcher)
+
+        return asyncio.run(run())
+
+    def latest_commit(self):
+        return self.run_fetcher(self.repo.latest_commit)
+
+    def prefetch(self, commit):
+        return self.run_fetcher(lambda fetcher: self.repo.prefetch(fetcher, commit))
+
+    def test_prefetch(self):
+        commit, date = self.latest_commit()
+        self.assertEqual(commit, git(self.root / "plugin", "rev-parse", "HEAD"))
+        self.assertIsNotNone(date.tzinfo)
+        self.prefetch(commit)
+
+        checkout = self.root / "checkout"
+        self.assertEqual((checkout / "plugin.vim").read_text(), "plugin 1\n")
+        self.assertEqual((checkout / "deps/lib/lib.vim").read_text(), "lib 1\n")
+        self.assertFalse((checkout / ".git").exists())
+        self.assertFalse((checkout / "deps/lib/.git").exists())
+
+    def test_file_named_like_index(self):
+        # the scratch index of a submodule must not clobber files of its parent
+        (self.root / "plugin/deps/lib.index").write_text("not an index\n")
+        git(self.root / "plugin", "add", "deps/lib.index")
+        git(self.root / "plugin", "commit", "-q", "-m", "add lib.index")
+        self.prefetch(self.latest_commit()[0])
+        checkout = self.root / "checkout"
+        self.assertEqual((checkout / "deps/lib.index").read_text(), "not an index\n")
+        self.assertEqual(list(checkout.glob("*.index")), [])
+
+    def test_incremental(self):
+        self.prefetch(self.latest_commit()[0])
+        [mirror] = (self.root / "cache/nixpkgs-git-mirrors").glob("plugin-*.git")
+        inode = mirror.stat().st_ino
+
+        (self.root / "plugin/plugin.vim").write_text("plugin 2\n")
+        git(self.root / "plugin", "commit", "-q", "-a", "-m", "update")
+        commit, _ = self.latest_commit()
+        self.assertEqual(commit, git(self.root / "plugin", "rev-parse", "HEAD"))
+        self.prefetch(commit)
+        self.assertEqual(mirror.stat().st_ino, inode)
+        self.assertEqual((self.root / "checkout/plugin.vim").read_text(), "plugin 2\n")
+
+        # everything needed is in the mirrors now
+        os.rename(self.root / "plugin", self.root / "gone")
+        os.rename(self.root / "lib", self.root / "gone-lib")
+        first = self.prefetch(commit)
+        self.assertEqual(first, self.prefetch(commit))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,9 +10,11 @@
 , predicate ? null
 , path ? null
 , max-workers ? null
+, max-heavy-workers ? null
 , include-overlays ? false
 , keep-going ? null
 , commit ? null
+, batch-commits ? null
 }:
 
 let
@@ -176,6 +178,11 @@ let
 
     to increase the number of jobs in parallel, or
 
+        --argstr max-heavy-workers 2
+
+    to limit how many slow updates (those that took more than five minutes
+    last time, e.g. because they build something) run at once, or
+
         --argstr keep-going true
 
     to continue running when a single update fails.
@@ -184,6 +191,14 @@ let
     that support it by adding
 
         --argstr commit true
+
+    With many packages, adding
+
+        --argstr batch-commits true
+
+    as well builds the commits without touching your checkout and
+    fast-forwards the current branch to all of them at the end, which is
+    much faster than committing and cherry-picking each update.
   '';
 
   /* Transform a matched package into an object for update.py.
@@ -203,8 +218,10 @@ let
 
   optionalArgs =
     lib.optional (max-workers != null) "--max-workers=${max-workers}"
+    ++ lib.optional (max-heavy-workers != null) "--max-heavy-workers=${max-heavy-workers}"
     ++ lib.optional (keep-going == "true") "--keep-going"
-    ++ lib.optional (commit == "true") "--commit";
+    ++ lib.optional (commit == "true") "--commit"
+    ++ lib.optional (batch-commits == "true") "--batch-commits";
 
   args = [ packagesJson ] ++ optionalArgs;
 
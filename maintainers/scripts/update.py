@@ -6,9 +6,23 @@ import contextlib
 import json
 import os
 import re
+import shutil
+import statistics
 import subprocess
 import sys
 import tempfile
+import time
+
+# Updates that took longer than this last time are "heavy", they usually build
+# something or download large sources and only a few of them run at once.
+HEAVY_UPDATE_SECONDS = 300
+
+# Settings for the git commands run in worktrees with --batch-commits. This
+# enables the untracked cache and a smaller index format, which makes the
+# checks before and after each update cheaper on a tree the size of nixpkgs.
+WORKTREE_GIT_CONFIG = {
+    'feature.manyFiles': 'true',
+}
 
 class CalledProcessError(Exception):
     process: asyncio.subprocess.Process
@@ -16,8 +30,182 @@ class CalledProcessError(Exception):
 class UpdateFailedException(Exception):
     pass
 
+class MergeConflictException(Exception):
+    pass
+
+class CommitBatch:
+    """
+    Commits made with --batch-commits. They are stacked on top of the commit
+    the run started from without touching the index or working tree of the
+    main checkout, which is fast-forwarded to them once at the end.
+    """
+    def __init__(self, base: str) -> None:
+        self.base = base
+        self.tip = base
+        self.count = 0
+
+def worktree_git_env(index_file: Optional[str] = None) -> Dict[str, str]:
+    env = dict(os.environ)
+    env['GIT_CONFIG_COUNT'] = str(len(WORKTREE_GIT_CONFIG))
+    for i, (key, value) in enumerate(WORKTREE_GIT_CONFIG.items()):
+        env[f'GIT_CONFIG_KEY_{i}'] = key
+        env[f'GIT_CONFIG_VALUE_{i}'] = value
+    if index_file is not None:
+        env['GIT_INDEX_FILE'] = index_file
+    return env
+
+class Timings:
+    """
+    How long earlier updates of each attribute path took, kept across runs in
+    $XDG_CACHE_HOME/nixpkgs-update/timings.json.
+    """
+    def __init__(self, path: Optional[str]) -> None:
+        self.path = path
+        self.durations: Dict[str, float] = self.load()
+        # Packages we know nothing about are assumed to be typical ones.
+        self.default = statistics.median(self.durations.values()) if self.durations else 60.0
+
+    def load(self) -> Dict[str, float]:
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)['durations']
+        except (OSError, ValueError, KeyError):
+            # Without timings, updates just run in the given order.
+            return {}
+
+    def estimate(self, package: Dict) -> float:
+        return self.durations.get(package['attrPath'], self.default)
+
+    def record(self, package: Dict, seconds: float) -> None:
+        attr_path = package['attrPath']
+        old = self.durations.get(attr_path)
+        self.durations[attr_path] = seconds if old is None else (old + seconds) / 2
+        if self.path is None:
+            return
+        # Merge with what other runs have recorded in the meantime.
+        durations = self.load()
+        durations[attr_path] = self.durations[attr_path]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.path), delete=False) as f:
+            json.dump({'version': 1, 'durations': durations}, f, indent=2, sort_keys=True)
+        os.replace(f.name, self.path)
+
+def default_timings_path() -> Optional[str]:
+    cache = os.environ.get('XDG_CACHE_HOME') or (os.path.join(os.environ['HOME'], '.cache') if 'HOME' in os.environ else None)
+    return os.path.join(cache, 'nixpkgs-update', 'timings.json') if cache is not None else None
+
+class Scheduler:
+    """
+    Hands out packages to the workers, those expected to take longest first, so
+    slow updates don't start last and hold up the end of the run. At most
+    `max_heavy` heavy updates run at once, the other workers take lighter ones
+    meanwhile.
+    """
+    def __init__(self, packages: List[Dict], timings: Timings, workers: int, max_heavy: int) -> None:
+        self.timings = timings
+        self.workers = workers
+        self.max_heavy = max_heavy
+        self.queued = sorted(packages, key=timings.estimate, reverse=True)
+        self.running: Dict[int, Tuple[Dict, float]] = {}
+        self.done = 0
+        self.failed = 0
+        self.changed = asyncio.Condition()
+
+    def is_heavy(self, package: Dict) -> bool:
+        return package['attrPath'] in self.timings.durations and self.timings.estimate(package) >= HEAVY_UPDATE_SECONDS
+
+    def heavy_running(self) -> int:
+        return sum(1 for package, _ in self.running.values() if self.is_heavy(package))
+
+    async def next(self) -> Optional[Dict]:
+        async with self.changed:
+            while self.queued:
+                heavy_allowed = self.heavy_running() < self.max_heavy
+                for i, package in enumerate(self.queued):
+                    if heavy_allowed or not self.is_heavy(package):
+                        del self.queued[i]
+                        self.running[id(package)] = (package, time.monotonic())
+                        return package
+                await self.changed.wait()
+            return None
+
+    async def finish(self, package: Dict, success: bool) -> None:
+        async with self.changed:
+            _, started = self.running.pop(id(package))
+            if success:
+                # A failed update may have stopped early, its time says
+                # little about how long the next run takes.
+                self.timings.record(package, time.monotonic() - started)
+                self.done += 1
+            else:
+                self.failed += 1
+            self.changed.notify_all()
+
+    def eta(self) -> float:
+        now = time.monotonic()
+        remaining = sum(map(self.timings.estimate, self.queued))
+        remaining += sum(max(0.0, self.timings.estimate(package) - (now - started)) for package, started in self.running.values())
+        return remaining / self.workers
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02}s'
+    return f'{seconds}s'
+
+class StatusView:
+    """
+    Live summary of the update below the log, redrawn every second when stderr
+    is a terminal.
+    """
+    def __init__(self, scheduler: Scheduler) -> None:
+        self.scheduler = scheduler
+        self.lines = 0
+
+    def render(self) -> List[str]:
+        s = self.scheduler
+        now = time.monotonic()
+        width = shutil.get_terminal_size().columns
+        lines = [f'[{len(s.running)} running, {len(s.queued)} queued, {s.done} done, {s.failed} failed, ETA {format_duration(s.eta())}]']
+        for package, started in sorted(s.running.values(), key=lambda r: r[1]):
+            elapsed = now - started
+            expected = s.timings.estimate(package)
+            remaining = f'~{format_duration(expected - elapsed)} left' if expected > elapsed else 'overdue'
+            lines.append(f"  {package['name']}: {format_duration(elapsed)}, {remaining}"[:width - 1])
+        return lines
+
+    def clear(self) -> None:
+        if self.lines:
+            sys.stderr.write(f'\x1b[{self.lines}F\x1b[J')
+            self.lines = 0
+
+    def draw(self) -> None:
+        lines = self.render()
+        sys.stderr.write(''.join(line + '\n' for line in lines))
+        sys.stderr.flush()
+        self.lines = len(lines)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                self.clear()
+                self.draw()
+                await asyncio.sleep(1)
+        finally:
+            self.clear()
+
+status_view: Optional[StatusView] = None
+
 def eprint(*args, **kwargs):
+    if status_view is not None:
+        status_view.clear()
     print(*args, file=sys.stderr, **kwargs)
+    if status_view is not None:
+        status_view.draw()
 
 async def check_subprocess(*args, **kwargs):
     """
@@ -34,7 +222,11 @@ async def check_subprocess(*args, **kwargs):
 
     return process
 
-async def run_update_script(nixpkgs_root: str, merge_lock: asyncio.Lock, temp_dir: Optional[Tuple[str, str]], package: Dict, keep_going: bool):
+async def git_output(*args, **kwargs) -> str:
+    process = await check_subprocess('git', *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **kwargs)
+    return (await process.stdout.read()).decode('utf-8').strip()
+
+async def run_update_script(nixpkgs_root: str, merge_lock: asyncio.Lock, temp_dir: Optional[Tuple[str, str]], batch: Optional[CommitBatch], package: Dict, keep_going: bool) -> bool:
     worktree: Optional[str] = None
 
     update_script_command = package['updateScript']
@@ -43,7 +235,7 @@ async def run_update_script(nixpkgs_root: str, merge_lock: asyncio.Lock, temp_di
         worktree, _branch = temp_dir
 
         # Ensure the worktree is clean before update.
-        await check_subprocess('git', 'reset', '--hard', '--quiet', 'HEAD', cwd=worktree)
+        await check_subprocess('git', 'reset', '--hard', '--quiet', 'HEAD', cwd=worktree, env=worktree_git_env() if batch is not None else None)
 
         # Update scripts can use $(dirname $0) to get their location but we want to run
         # their clones in the git worktree, not in the main nixpkgs repo.
@@ -65,7 +257,8 @@ async def run_update_script(nixpkgs_root: str, merge_lock: asyncio.Lock, temp_di
         )
         update_info = await update_process.stdout.read()
 
-        await merge_changes(merge_lock, package, update_info, temp_dir)
+        await merge_changes(merge_lock, package, update_info, temp_dir, batch)
+        return True
     except KeyboardInterrupt as e:
         eprint('Cancelling…')
         raise asyncio.exceptions.CancelledError()
@@ -83,6 +276,13 @@ async def run_update_script(nixpkgs_root: str, merge_lock: asyncio.Lock, temp_di
 
         if not keep_going:
             raise UpdateFailedException(f"The update script for {package['name']} failed with exit code {e.process.returncode}")
+        return False
+    except MergeConflictException as e:
+        eprint(f" - {package['name']}: ERROR, {e}")
+
+        if not keep_going:
+            raise UpdateFailedException(f"The changes of {package['name']} could not be committed")
+        return False
 
 @contextlib.contextmanager
 def make_worktree() -> Generator[Tuple[str, str], None, None]:
@@ -100,15 +300,68 @@ async def commit_changes(name: str, merge_lock: asyncio.Lock, worktree: str, bra
         # Git can only handle a single index operation at a time
         async with merge_lock:
             await check_subprocess('git', 'add', *change['files'], cwd=worktree)
-            commit_message = '{attrPath}: {oldVersion} -> {newVersion}'.format(**change)
-            if 'commitMessage' in change:
-                commit_message = change['commitMessage']
-            elif 'commitBody' in change:
-                commit_message = commit_message + '\n\n' + change['commitBody']
-            await check_subprocess('git', 'commit', '--quiet', '-m', commit_message, cwd=worktree)
+            await check_subprocess('git', 'commit', '--quiet', '-m', commit_message(change), cwd=worktree)
             await check_subprocess('git', 'cherry-pick', branch)
 
-async def check_changes(package: Dict, worktree: str, update_info: str):
+def commit_message(change: Dict) -> str:
+    commit_message = '{attrPath}: {oldVersion} -> {newVersion}'.format(**change)
+    if 'commitMessage' in change:
+        commit_message = change['commitMessage']
+    elif 'commitBody' in change:
+        commit_message = commit_message + '\n\n' + change['commitBody']
+    return commit_message
+
+async def commit_changes_batched(name: str, merge_lock: asyncio.Lock, worktree: str, batch: CommitBatch, changes: List[Dict]) -> None:
+    # Build the commits on top of the base in a scratch index of our own, so
+    # neither the index of the worktree nor the one of the main checkout
+    # has to be refreshed, and no lock is needed.
+    env = worktree_git_env(f'{worktree}.index')
+    await check_subprocess('git', 'read-tree', batch.base, cwd=worktree, env=env)
+    parent = batch.base
+    commits = []
+    for change in changes:
+        await check_subprocess('git', 'add', '--all', '--', *change['files'], cwd=worktree, env=env)
+        tree = await git_output('write-tree', cwd=worktree, env=env)
+        message = commit_message(change)
+        parent = await git_output('commit-tree', tree, '-p', parent, '-m', message, cwd=worktree)
+        commits.append((parent, message))
+
+    async with merge_lock:
+        if batch.tip == batch.base:
+            # Nothing landed yet, the commits can be taken as they are.
+            batch.tip = parent
+            batch.count += len(commits)
+            return
+
+        # Otherwise replay them onto the updates landed so far. This only
+        # touches objects, so it takes milliseconds even on nixpkgs.
+        tip = batch.tip
+        for commit, message in commits:
+            merge = await asyncio.create_subprocess_exec('git', 'merge-tree', '--write-tree', '--no-messages', '--name-only', tip, commit, stdout=asyncio.subprocess.PIPE, cwd=worktree)
+            output, _ = await merge.communicate()
+            lines = output.decode('utf-8').splitlines()
+            if merge.returncode == 1:
+                raise MergeConflictException(f"conflicts with an earlier update in {', '.join(lines[1:])}")
+            elif merge.returncode != 0:
+                error = CalledProcessError()
+                error.process = merge
+                raise error
+            tip = await git_output('commit-tree', lines[0], '-p', tip, '-m', message, cwd=worktree)
+        batch.tip = tip
+        batch.count += len(commits)
+
+async def land_batch(nixpkgs_root: str, batch: CommitBatch) -> None:
+    if batch.count == 0:
+        return
+
+    eprint()
+    eprint(f'Fast-forwarding to {batch.count} new commits ...')
+    try:
+        await check_subprocess('git', 'merge', '--ff-only', '--quiet', batch.tip, cwd=nixpkgs_root)
+    except CalledProcessError:
+        eprint(f'Could not fast-forward, the commits end at {batch.tip}, run `git merge {batch.tip}` to get them.')
+
+async def check_changes(package: Dict, worktree: str, update_info: str, env: Optional[Dict[str, str]] = None):
     if 'commit' in package['supportedFeatures']:
         changes = json.loads(update_info)
     else:
@@ -131,7 +384,7 @@ async def check_changes(package: Dict, worktree: str, update_info: str):
             changes[0]['newVersion'] = json.loads((await obtain_new_version_process.stdout.read()).decode('utf-8'))
 
         if 'files' not in changes[0]:
-            changed_files_process = await check_subprocess('git', 'diff', '--name-only', 'HEAD', stdout=asyncio.subprocess.PIPE, cwd=worktree)
+            changed_files_process = await check_subprocess('git', 'diff', '--name-only', 'HEAD', stdout=asyncio.subprocess.PIPE, cwd=worktree, env=env)
             changed_files = (await changed_files_process.stdout.read()).splitlines()
             changes[0]['files'] = changed_files
 
@@ -140,33 +393,39 @@ async def check_changes(package: Dict, worktree: str, update_info: str):
 
     return changes
 
-async def merge_changes(merge_lock: asyncio.Lock, package: Dict, update_info: str, temp_dir: Optional[Tuple[str, str]]) -> None:
+async def merge_changes(merge_lock: asyncio.Lock, package: Dict, update_info: str, temp_dir: Optional[Tuple[str, str]], batch: Optional[CommitBatch]) -> None:
     if temp_dir is not None:
         worktree, branch = temp_dir
-        changes = await check_changes(package, worktree, update_info)
+        changes = await check_changes(package, worktree, update_info, env=worktree_git_env() if batch is not None else None)
 
-        if len(changes) > 0:
+        if len(changes) > 0 and batch is not None:
+            await commit_changes_batched(package['name'], merge_lock, worktree, batch, changes)
+        elif len(changes) > 0:
             await commit_changes(package['name'], merge_lock, worktree, branch, changes)
         else:
             eprint(f" - {package['name']}: DONE, no changes.")
     else:
         eprint(f" - {package['name']}: DONE.")
 
-async def updater(nixpkgs_root: str, temp_dir: Optional[Tuple[str, str]], merge_lock: asyncio.Lock, packages_to_update: asyncio.Queue[Optional[Dict]], keep_going: bool, commit: bool):
+async def updater(nixpkgs_root: str, temp_dir: Optional[Tuple[str, str]], batch: Optional[CommitBatch], merge_lock: asyncio.Lock, scheduler: Scheduler, keep_going: bool, commit: bool):
     while True:
-        package = await packages_to_update.get()
+        package = await scheduler.next()
         if package is None:
-            # A sentinel received, we are done.
+            # Nothing left to start, we are done.
             return
 
         if not ('commit' in package['supportedFeatures'] or 'attrPath' in package):
             temp_dir = None
 
-        await run_update_script(nixpkgs_root, merge_lock, temp_dir, package, keep_going)
+        success = False
+        try:
+            success = await run_update_script(nixpkgs_root, merge_lock, temp_dir, batch, package, keep_going)
+        finally:
+            await scheduler.finish(package, success)
 
-async def start_updates(max_workers: int, keep_going: bool, commit: bool, packages: List[Dict]):
+async def start_updates(max_workers: int, max_heavy_workers: Optional[int], keep_going: bool, commit: bool, batch_commits: bool, packages: List[Dict]):
+    global status_view
     merge_lock = asyncio.Lock()
-    packages_to_update: asyncio.Queue[Optional[Dict]] = asyncio.Queue()
 
     with contextlib.ExitStack() as stack:
         temp_dirs: List[Optional[Tuple[str, str]]] = []
@@ -177,23 +436,26 @@ async def start_updates(max_workers: int, keep_going: bool, commit: bool, packag
         nixpkgs_root_process = await check_subprocess('git', 'rev-parse', '--show-toplevel', stdout=asyncio.subprocess.PIPE)
         nixpkgs_root = (await nixpkgs_root_process.stdout.read()).decode('utf-8').strip()
 
+        batch = CommitBatch(await git_output('rev-parse', 'HEAD', cwd=nixpkgs_root)) if commit and batch_commits else None
+
         # Set up temporary directories when using auto-commit.
         for i in range(num_workers):
             temp_dir = stack.enter_context(make_worktree()) if commit else None
             temp_dirs.append(temp_dir)
 
-        # Fill up an update queue,
-        for package in packages:
-            await packages_to_update.put(package)
-
-        # Add sentinels, one for each worker.
-        # A workers will terminate when it gets sentinel from the queue.
-        for i in range(num_workers):
-            await packages_to_update.put(None)
+        if max_heavy_workers is None:
+            max_heavy_workers = max(1, num_workers // 4)
+        scheduler = Scheduler(packages, Timings(default_timings_path()), num_workers, max_heavy_workers)
 
         # Prepare updater workers for each temp_dir directory.
         # At most `num_workers` instances of `run_update_script` will be running at one time.
-        updaters = asyncio.gather(*[updater(nixpkgs_root, temp_dir, merge_lock, packages_to_update, keep_going, commit) for temp_dir in temp_dirs])
+        updaters = asyncio.gather(*[updater(nixpkgs_root, temp_dir, batch, merge_lock, scheduler, keep_going, commit) for temp_dir in temp_dirs])
+
+        status_task = None
+        if sys.stderr.isatty():
+            status_view = StatusView(scheduler)
+            status_task = asyncio.create_task(status_view.run())
+            stack.callback(status_task.cancel)
 
         try:
             # Start updater workers.
@@ -206,8 +468,18 @@ async def start_updates(max_workers: int, keep_going: bool, commit: bool, packag
             updaters.cancel()
             eprint(e)
             sys.exit(1)
-
-def main(max_workers: int, keep_going: bool, commit: bool, packages_path: str) -> None:
+        finally:
+            if status_task is not None:
+                status_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await status_task
+            status_view = None
+
+            # Land what was committed so far, also when stopping after a failure.
+            if batch is not None:
+                await land_batch(nixpkgs_root, batch)
+
+def main(max_workers: int, max_heavy_workers: Optional[int], keep_going: bool, commit: bool, batch_commits: bool, packages_path: str) -> None:
     with open(packages_path) as f:
         packages = json.load(f)
 
@@ -222,7 +494,7 @@ def main(max_workers: int, keep_going: bool, commit: bool, packages_path: str) -
         eprint()
         eprint('Running update for:')
 
-        asyncio.run(start_updates(max_workers, keep_going, commit, packages))
+        asyncio.run(start_updates(max_workers, max_heavy_workers, keep_going, commit, batch_commits, packages))
 
         eprint()
         eprint('Packages updated!')
@@ -233,15 +505,20 @@ def main(max_workers: int, keep_going: bool, commit: bool, packages_path: str) -
 
 parser = argparse.ArgumentParser(description='Update packages')
 parser.add_argument('--max-workers', '-j', dest='max_workers', type=int, help='Number of updates to run concurrently', nargs='?', default=4)
+parser.add_argument('--max-heavy-workers', dest='max_heavy_workers', type=int, help=f'Number of heavy updates, which took more than {HEAVY_UPDATE_SECONDS} seconds last time, to run concurrently (default: a quarter of the workers)', default=None)
 parser.add_argument('--keep-going', '-k', dest='keep_going', action='store_true', help='Do not stop after first failure')
 parser.add_argument('--commit', '-c', dest='commit', action='store_true', help='Commit the changes')
+parser.add_argument('--batch-commits', dest='batch_commits', action='store_true', help='With --commit, build the commits without git commit and cherry-pick and fast-forward the current branch to all of them at the end')
 parser.add_argument('packages', help='JSON file containing the list of package names and their update scripts')
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    if args.max_heavy_workers is not None and args.max_heavy_workers < 1:
+        # Otherwise the run would hang once only heavy updates are left.
+        parser.error('--max-heavy-workers must be at least 1')
 
     try:
-        main(args.max_workers, args.keep_going, args.commit, args.packages)
+        main(args.max_workers, args.max_heavy_workers, args.keep_going, args.commit, args.batch_commits, args.packages)
     except KeyboardInterrupt as e:
         # Let’s cancel outside of the main loop too.
         sys.exit(130)
@@ -0,0 +1,105 @@
+# Benchmark for mergeJSON.py. Not used by the build.
+#
+# Runs one or more versions of mergeJSON.py on the same inputs, reports wall time and
+# peak memory of each run and checks that all versions produce the same output. Inputs
+# are either real options.json files, e.g. from
+#
+#   nix-build nixos/release.nix -A options
+#
+# or generated with the same shape and size as the NixOS options (~20k options, loc
+# paths that share many components, most options declared by one module).
+#
+#   python bench-mergeJSON.py [--options N] [--base BASE.json --overrides OVERRIDES.json] \
+#     [--rounds N] mergeJSON.py [old/mergeJSON.py ...]
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+def generate(count, seed=0):
+    rng = random.Random(seed)
+    parts = ["services", "programs", "networking", "boot", "hardware", "security",
+             "systemd", "users", "environment", "virtualisation"]
+    words = [f"w{n}" for n in range(400)] + ["enable", "package", "settings", "extraConfig"]
+    base, overrides = {}, {}
+    while len(base) < count:
+        loc = [rng.choice(parts)] + [rng.choice(words) for _ in range(rng.randint(1, 4))]
+        # a good share of paths are permutations of other paths, which is what made
+        # the old Key hash degrade.
+        if rng.random() < 0.2 and len(loc) > 2:
+            loc[1], loc[2] = loc[2], loc[1]
+        name = ".".join(loc)
+        if name in base:
+            continue
+        decl = f"{loc[0]}/{loc[1]}.nix"
+        base[name] = {
+            "loc": loc,
+            "declarations": [decl],
+            "description": { "_type": "mdDoc", "text": f"Description of {name}." },
+            "type": "boolean",
+            "readOnly": False,
+        }
+        # the override file is the lazy options eval, which repeats most options and
+        # often adds declarations.
+        if rng.random() < 0.9:
+            overrides[name] = {
+                "loc": loc,
+                "declarations": [f"nixos/modules/{decl}"]
+                  + [{ "name": f"<extra/{n}.nix>", "url": f"https://example.org/{n}" }
+                     for n in range(rng.randint(0, 3))],
+                "description": None,
+                "type": "_unspecified",
+            }
+    return base, overrides
+
+def run(script, base, overrides, out):
+    start = time.monotonic()
+    with open(out, "w") as f:
+        proc = subprocess.Popen([sys.executable, script, base, overrides], stdout=f)
+        (_, status, usage) = os.wait4(proc.pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise Exception(f"{script} failed")
+    return time.monotonic() - start, usage.ru_maxrss // 1024
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--options", type=int, default=20000)
+    parser.add_argument("--base")
+    parser.add_argument("--overrides")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("scripts", nargs="+")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.base and args.overrides:
+            base, overrides = args.base, args.overrides
+        else:
+            base, overrides = os.path.join(tmp, "base.json"), os.path.join(tmp, "overrides.json")
+            b, o = generate(args.options)
+            with open(base, "w") as f:
+                json.dump(b, f)
+            with open(overrides, "w") as f:
+                json.dump(o, f)
+
+        digests = set()
+        for script in args.scripts:
+            out = os.path.join(tmp, "out.json")
+            results = [run(script, base, overrides, out) for _ in range(args.rounds)]
+            with open(out, "rb") as f:
+                digests.add(hashlib.sha256(f.read()).hexdigest())
+            best = min(t for t, _ in results)
+            peak = max(m for _, m in results)
+            print(f"{script}: best {best:.3f}s of {args.rounds}, peak rss {peak}M")
+
+        if len(digests) != 1:
+            print("outputs differ!", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,45 +2,57 @@ import collections
 import json
 import os
 import sys
-from typing import Any, Dict, List
+from typing import Any, Dict, List, TextIO, Tuple
 
 JSON = Dict[str, Any]
 
-class Key:
-    def __init__(self, path: List[str]):
-        self.path = path
-    def __hash__(self):
-        result = 0
-        for id in self.path:
-            result ^= hash(id)
-        return result
-    def __eq__(self, other):
-        return type(self) is type(other) and self.path == other.path
+# option paths as tuples. these hash all components in order, unlike a xor of the
+# component hashes that made permutations (and repeated components) of a path collide.
+Key = Tuple[str, ...]
 
 Option = collections.namedtuple('Option', ['name', 'value'])
 
 # pivot a dict of options keyed by their display name to a dict keyed by their path
 def pivot(options: Dict[str, JSON]) -> Dict[Key, Option]:
-    result: Dict[Key, Option] = dict()
-    for (name, opt) in options.items():
-        result[Key(opt['loc'])] = Option(name, opt)
-    return result
+    return { tuple(opt['loc']): Option(name, opt) for (name, opt) in options.items() }
 
-# pivot back to indexed-by-full-name
+# pivot back to indexed-by-full-name and write the result as we go. the output is
+# identical to json.dump() of the unpivoted dict, but never holds all of it in memory.
 # like the docbook build we'll just fail if multiple options with differing locs
-# render to the same option name.
-def unpivot(options: Dict[Key, Option]) -> Dict[str, JSON]:
-    result: Dict[str, Dict] = dict()
-    for (key, opt) in options.items():
-        if opt.name in result:
+# render to the same option name. this is checked before anything is written.
+def dumpUnpivoted(options: Dict[Key, Option], out: TextIO) -> None:
+    seen: Dict[str, JSON] = dict()
+    for opt in options.values():
+        if opt.name in seen:
             raise RuntimeError(
                 'multiple options with colliding ids found',
                 opt.name,
-                result[opt.name]['loc'],
+                seen[opt.name]['loc'],
                 opt.value['loc'],
             )
-        result[opt.name] = opt.value
-    return result
+        seen[opt.name] = opt.value
+    del seen
+
+    sep = '{'
+    for opt in options.values():
+        out.write(sep)
+        out.write(json.dumps(opt.name))
+        out.write(': ')
+        out.write(json.dumps(opt.value))
+        sep = ', '
+    out.write('{}' if sep == '{' else '}')
+
+# declarations are either paths or { name, url } attrsets, which aren't hashable
+def declKey(d: Any) -> Any:
+    return tuple(sorted(d.items())) if isinstance(d, dict) else d
+
+def mergeDeclarations(decls: List[Any], new: List[Any]) -> None:
+    seen = set(map(declKey, decls))
+    for d in new:
+        k = declKey(d)
+        if k not in seen:
+            seen.add(k)
+            decls.append(d)
 
 warningsAreErrors = False
 optOffset = 0
@@ -63,10 +75,7 @@ for (k, v) in overrides.items():
     cur = options.setdefault(k, v).value
     for (ok, ov) in v.value.items():
         if ok == 'declarations':
-            decls = cur[ok]
-            for d in ov:
-                if d not in decls:
-                    decls += [d]
+            mergeDeclarations(cur[ok], ov)
         elif ok == "type":
             # ignore types of placeholder options
             if ov != "_unspecified" or cur[ok] == "_unspecified":
@@ -101,4 +110,4 @@ if hasWarnings and warningsAreErrors:
         file=sys.stderr)
     sys.exit(1)
 
-json.dump(unpivot(options), fp=sys.stdout)
+dumpUnpivoted(options, sys.stdout)
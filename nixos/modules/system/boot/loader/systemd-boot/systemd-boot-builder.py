@@ -3,16 +3,20 @@ import argparse
 import ctypes
 import datetime
 import errno
+import functools
 import glob
+import hashlib
 import os
 import os.path
 import re
 import shutil
 import subprocess
 import sys
+import threading
 import warnings
 import json
-from typing import NamedTuple, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, NamedTuple, Dict, List
 from dataclasses import dataclass
 
 # These values will be replaced with actual values during the package build
@@ -25,12 +29,11 @@ EDITOR = "@editor@" == "1"
 CONSOLE_MODE = "@consoleMode@"
 BOOTSPEC_TOOLS = "@bootspecTools@"
 DISTRO_NAME = "@distroName@"
-NIX = "@nix@"
 SYSTEMD = "@systemd@"
 CONFIGURATION_LIMIT = int("@configurationLimit@")
 CAN_TOUCH_EFI_VARIABLES = "@canTouchEfiVariables@"
 GRACEFUL = "@graceful@"
-COPY_EXTRA_FILES = "@copyExtraFiles@"
+EXTRA_FILES = "@extraFiles@"
 CHECK_MOUNTPOINTS = "@checkMountpoints@"
 
 @dataclass
@@ -47,7 +50,7 @@ class BootSpec:
     initrdSecrets: str | None = None
 
 
-libc = ctypes.CDLL("libc.so.6")
+libc = ctypes.CDLL("libc.so.6", use_errno=True)
 
 class SystemIdentifier(NamedTuple):
     profile: str | None
@@ -55,9 +58,156 @@ class SystemIdentifier(NamedTuple):
     specialisation: str | None
 
 
-def copy_if_not_exists(source: str, dest: str) -> None:
-    if not os.path.exists(dest):
-        shutil.copyfile(source, dest)
+class Manifest:
+    """Files installed on the boot partition by previous runs.
+
+    The manifest lives on the boot partition and maps every file we installed,
+    relative to BOOT_MOUNT_POINT, to its size, SHA-256 and, for copies, the
+    file it was copied from. Files are only written when they changed, and
+    files that are no longer needed are removed by diffing against it instead
+    of globbing the whole partition.
+    """
+
+    path = f"{BOOT_MOUNT_POINT}/{NIXOS_DIR}/.manifest.json"
+
+    def __init__(self) -> None:
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.exists = False
+        self.bytes_written = 0
+        self.added = 0
+        self.replaced = 0
+        self.removed = 0
+        # kernels and initrds are copied concurrently
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.files = json.load(f)["files"]
+            self.exists = True
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"ignoring invalid {self.path}: {e}", file=sys.stderr)
+
+    def is_current(self, rel: str, sha256: str | None = None, source: str | None = None) -> bool:
+        """Whether `rel` exists and is the file we recorded, with the given hash or source."""
+        entry = self.files.get(rel)
+        if entry is None:
+            return False
+        if sha256 is not None and entry["sha256"] != sha256:
+            return False
+        if source is not None and entry.get("source") != source:
+            return False
+        try:
+            return os.path.getsize(f"{BOOT_MOUNT_POINT}/{rel}") == entry["size"]
+        except OSError:
+            return False
+
+    def record(self, rel: str, size: int, sha256: str, source: str | None, written: bool) -> None:
+        with self.lock:
+            if written:
+                self.bytes_written += size
+                if rel in self.files:
+                    self.replaced += 1
+                else:
+                    self.added += 1
+            self.files[rel] = {"size": size, "sha256": sha256}
+            if source is not None:
+                self.files[rel]["source"] = source
+
+    def write(self, rel: str, content: bytes) -> str | None:
+        """Write `content` to a temporary file next to `rel`, unless it is unchanged.
+
+        Returns the temporary file, which the caller has to move into place.
+        """
+        sha256 = hashlib.sha256(content).hexdigest()
+        if self.is_current(rel, sha256=sha256):
+            return None
+        tmp_path = f"{BOOT_MOUNT_POINT}/{rel}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        self.record(rel, len(content), sha256, None, written=True)
+        return tmp_path
+
+    def copy(self, source: str, rel: str, replace: bool) -> None:
+        """Copy `source` to `rel`, unless it was already copied from there.
+
+        Without `replace`, files that exist but aren't recorded are assumed to
+        be complete, which holds for files named after their store path.
+        """
+        dest = f"{BOOT_MOUNT_POINT}/{rel}"
+        if self.is_current(rel, source=source):
+            return
+        if not replace and rel not in self.files and os.path.exists(dest):
+            # installed by a run without a manifest, record it once
+            with open(dest, "rb") as f:
+                digest = hashlib.file_digest(f, "sha256")
+            self.record(rel, os.path.getsize(dest), digest.hexdigest(), source, written=False)
+            return
+        # Copy to a temporary file first so an interrupted copy is never
+        # mistaken for a complete one by later runs.
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = f"{dest}.tmp"
+        hash = hashlib.sha256()
+        size = 0
+        with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+            while chunk := src.read(1 << 20):
+                hash.update(chunk)
+                size += len(chunk)
+                dst.write(chunk)
+        os.rename(tmp_path, dest)
+        self.record(rel, size, hash.hexdigest(), source, written=True)
+
+    def copy_modified(self, source: str, rel: str, modify: Callable[[str], None]) -> None:
+        """Copy `source` to `rel`, changed by `modify` before it is moved into place.
+
+        What `modify` does can't be known beforehand, so the copy is always made
+        again from `source` instead of being skipped when it is recorded.
+        """
+        dest = f"{BOOT_MOUNT_POINT}/{rel}"
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = f"{dest}.tmp"
+        shutil.copyfile(source, tmp_path)
+        try:
+            modify(tmp_path)
+            with open(tmp_path, "rb") as f:
+                digest = hashlib.file_digest(f, "sha256")
+            size = os.path.getsize(tmp_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        os.rename(tmp_path, dest)
+        self.record(rel, size, digest.hexdigest(), source, written=True)
+
+    def remove(self, rel: str) -> None:
+        path = f"{BOOT_MOUNT_POINT}/{rel}"
+        if os.path.exists(path):
+            os.unlink(path)
+            self.removed += 1
+        self.files.pop(rel, None)
+
+    def remove_stale(self, needed: set[str]) -> None:
+        for rel in sorted(set(self.files) - needed):
+            self.remove(rel)
+        # Files copied by a run that failed before saving the manifest are not
+        # in it, look for those where kernels and initrds are kept.
+        for path in glob.iglob(f"{BOOT_MOUNT_POINT}/{NIXOS_DIR}/*"):
+            rel = boot_relative(os.path.relpath(path, BOOT_MOUNT_POINT))
+            if rel not in self.files and rel not in needed and os.path.isfile(path):
+                os.unlink(path)
+                self.removed += 1
+
+    def save(self) -> None:
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump({"version": 1, "files": self.files}, f, sort_keys=True)
+        os.rename(f"{self.path}.tmp", self.path)
+
+    def report(self) -> None:
+        print(f"wrote {self.bytes_written} bytes to {BOOT_MOUNT_POINT} "
+              f"({self.added} files added, {self.replaced} replaced, {self.removed} removed)")
+
+
+def boot_relative(path: str) -> str:
+    return os.path.normpath(path).lstrip("/")
 
 
 def generation_dir(profile: str | None, generation: int) -> str:
@@ -92,19 +242,35 @@ def generation_conf_filename(profile: str | None, generation: int, specialisatio
     return "-".join(p for p in pieces if p) + ".conf"
 
 
-def write_loader_conf(profile: str | None, generation: int, specialisation: str | None) -> None:
+def write_loader_conf(profile: str | None, generation: int, specialisation: str | None,
+                      manifest: Manifest) -> None:
+    content = ""
+    if TIMEOUT != "":
+        content += f"timeout {TIMEOUT}\n"
+    content += "default %s\n" % generation_conf_filename(profile, generation, specialisation)
+    if not EDITOR:
+        content += "editor 0\n"
+    content += f"console-mode {CONSOLE_MODE}\n"
+
+    # The loader configuration is always on the ESP, compare it directly
+    # instead of recording it in the manifest of the boot partition.
+    try:
+        with open(LOADER_CONF) as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+
     with open(f"{LOADER_CONF}.tmp", 'w') as f:
-        if TIMEOUT != "":
-            f.write(f"timeout {TIMEOUT}\n")
-        f.write("default %s\n" % generation_conf_filename(profile, generation, specialisation))
-        if not EDITOR:
-            f.write("editor 0\n")
-        f.write(f"console-mode {CONSOLE_MODE}\n")
+        f.write(content)
         f.flush()
         os.fsync(f.fileno())
     os.rename(f"{LOADER_CONF}.tmp", LOADER_CONF)
+    manifest.bytes_written += len(content.encode())
 
 
+# Generations don't change, and each one is needed several times per run.
+@functools.cache
 def get_bootspec(profile: str | None, generation: int) -> BootSpec:
     system_directory = system_dir(profile, generation, None)
     boot_json_path = os.path.realpath("%s/%s" % (system_directory, "boot.json"))
@@ -134,21 +300,57 @@ def bootspec_from_json(bootspec_json: Dict) -> BootSpec:
     )
 
 
-def copy_from_file(file: str, dry_run: bool = False) -> str:
+def copy_from_file(file: str, manifest: Manifest | None = None) -> str:
+    """Copy a kernel or initrd to the boot partition, and return its path there.
+
+    Only returns the path if `manifest` is None.
+    """
     store_file_path = os.path.realpath(file)
     suffix = os.path.basename(store_file_path)
     store_dir = os.path.basename(os.path.dirname(store_file_path))
     efi_file_path = f"{NIXOS_DIR}/{store_dir}-{suffix}.efi"
-    if not dry_run:
-        copy_if_not_exists(store_file_path, f"{BOOT_MOUNT_POINT}{efi_file_path}")
+    if manifest is not None:
+        manifest.copy(store_file_path, boot_relative(efi_file_path), replace=False)
     return efi_file_path
 
+def copy_boot_files(gens: list[SystemIdentifier], manifest: Manifest) -> None:
+    """Copy the kernels and initrds of all generations to the boot partition.
+
+    Files are copied concurrently, and files that are already there are
+    skipped. Errors are ignored here, copying is retried and errors are
+    handled by write_entry for the entry that needs the file.
+    """
+    files = set()
+    for gen in gens:
+        bootspec = get_bootspec(gen.profile, gen.generation)
+        for spec in [bootspec, *bootspec.specialisations.values()]:
+            files.add(spec.kernel)
+            # initrds with secrets are copied by write_entry
+            if spec.initrdSecrets is None:
+                files.add(spec.initrd)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for future in [pool.submit(copy_from_file, file, manifest) for file in sorted(files)]:
+            future.exception()
+
+
+def entry_path(profile: str | None, generation: int, specialisation: str | None) -> str:
+    """The path of an entry, relative to BOOT_MOUNT_POINT"""
+    return "loader/entries/%s" % generation_conf_filename(profile, generation, specialisation)
+
+
 def write_entry(profile: str | None, generation: int, specialisation: str | None,
-                machine_id: str, bootspec: BootSpec, current: bool) -> None:
+                machine_id: str, bootspec: BootSpec, current: bool,
+                manifest: Manifest) -> tuple[str, str] | None:
+    """Write the entry for a generation to a temporary file, unless it is unchanged.
+
+    Returns the temporary file and its final location, see commit_entries.
+    """
     if specialisation:
         bootspec = bootspec.specialisations[specialisation]
-    kernel = copy_from_file(bootspec.kernel)
-    initrd = copy_from_file(bootspec.initrd)
+    kernel = copy_from_file(bootspec.kernel, manifest)
+    # Initrds with secrets are installed below
+    initrd = copy_from_file(bootspec.initrd, manifest if bootspec.initrdSecrets is None else None)
 
     title = "{name}{profile}{specialisation}".format(
         name=DISTRO_NAME,
@@ -157,8 +359,16 @@ def write_entry(profile: str | None, generation: int, specialisation: str | None
 
     try:
         if bootspec.initrdSecrets is not None:
-            subprocess.check_call([bootspec.initrdSecrets, f"{BOOT_MOUNT_POINT}%s" % (initrd)])
+            # The secrets are appended to the initrd, so start from the one in
+            # the store every time instead of appending to the installed one.
+            manifest.copy_modified(
+                os.path.realpath(bootspec.initrd),
+                boot_relative(initrd),
+                lambda path: subprocess.check_call([bootspec.initrdSecrets, path]),
+            )
     except subprocess.CalledProcessError:
+        # keep an initrd for the entry, without the secrets
+        copy_from_file(bootspec.initrd, manifest)
         if current:
             print("failed to create initrd secrets!", file=sys.stderr)
             sys.exit(1)
@@ -167,48 +377,77 @@ def write_entry(profile: str | None, generation: int, specialisation: str | None
                   f'for "{title} - Configuration {generation}", an older generation', file=sys.stderr)
             print("note: this is normal after having removed "
                   "or renamed a file in `boot.initrd.secrets`", file=sys.stderr)
-    entry_file = f"{BOOT_MOUNT_POINT}/loader/entries/%s" % (
-        generation_conf_filename(profile, generation, specialisation))
-    tmp_path = "%s.tmp" % (entry_file)
+    entry_rel = entry_path(profile, generation, specialisation)
+    entry_file = f"{BOOT_MOUNT_POINT}/{entry_rel}"
     kernel_params = "init=%s " % bootspec.init
 
     kernel_params = kernel_params + " ".join(bootspec.kernelParams)
     build_time = int(os.path.getctime(system_dir(profile, generation, specialisation)))
     build_date = datetime.datetime.fromtimestamp(build_time).strftime('%F')
 
-    with open(tmp_path, 'w') as f:
-        f.write(BOOT_ENTRY.format(title=title,
-                    sort_key=bootspec.sortKey,
-                    generation=generation,
-                    kernel=kernel,
-                    initrd=initrd,
-                    kernel_params=kernel_params,
-                    description=f"{bootspec.label}, built on {build_date}"))
-        if machine_id is not None:
-            f.write("machine-id %s\n" % machine_id)
-        f.flush()
-        os.fsync(f.fileno())
-    os.rename(tmp_path, entry_file)
+    content = BOOT_ENTRY.format(title=title,
+                sort_key=bootspec.sortKey,
+                generation=generation,
+                kernel=kernel,
+                initrd=initrd,
+                kernel_params=kernel_params,
+                description=f"{bootspec.label}, built on {build_date}")
+    if machine_id is not None:
+        content += "machine-id %s\n" % machine_id
+    tmp_path = manifest.write(entry_rel, content.encode())
+    if tmp_path is None:
+        return None
+    return tmp_path, entry_file
+
+
+def sync_fs(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc.syncfs(fd) != 0:
+            raise OSError(ctypes.get_errno(), f"could not sync {path}")
+    finally:
+        os.close(fd)
+
+
+def commit_entries(entries: list[tuple[str, str] | None]) -> None:
+    """Move entries written by write_entry into place.
+
+    Instead of syncing every entry on its own, the contents of all of them are
+    flushed with a single syncfs before they are renamed, and the renames are
+    flushed by syncing the entries directory once.
+    """
+    changed = [e for e in entries if e is not None]
+    if not changed:
+        return
+    sync_fs(BOOT_MOUNT_POINT)
+    for tmp_path, entry_file in changed:
+        os.rename(tmp_path, entry_file)
+    fd = os.open(f"{BOOT_MOUNT_POINT}/loader/entries", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def get_generations(profile: str | None = None) -> list[SystemIdentifier]:
-    gen_list = subprocess.check_output([
-        f"{NIX}/bin/nix-env",
-        "--list-generations",
-        "-p",
-        "/nix/var/nix/profiles/%s" % ("system-profiles/" + profile if profile else "system")],
-        universal_newlines=True)
-    gen_lines = gen_list.split('\n')
-    gen_lines.pop()
+    # Read the generations from the generation links next to the profile, like
+    # `nix-env --list-generations` does, without running it for every profile.
+    profile_dir = os.path.dirname(generation_dir(profile, 0))
+    rex_link = re.compile(r"^" + re.escape(profile or "system") + r"-([0-9]+)-link$")
+    generations = sorted(
+        int(m.group(1))
+        for m in map(rex_link.match, os.listdir(profile_dir))
+        if m is not None
+    )
 
     configurationLimit = CONFIGURATION_LIMIT
     configurations = [
         SystemIdentifier(
             profile=profile,
-            generation=int(line.split()[0]),
+            generation=generation,
             specialisation=None
         )
-        for line in gen_lines
+        for generation in generations
     ]
     return configurations[-configurationLimit:]
 
@@ -216,11 +455,11 @@ def get_generations(profile: str | None = None) -> list[SystemIdentifier]:
 def remove_old_entries(gens: list[SystemIdentifier]) -> None:
     rex_profile = re.compile(r"^" + re.escape(BOOT_MOUNT_POINT) + "/loader/entries/nixos-(.*)-generation-.*\.conf$")
     rex_generation = re.compile(r"^" + re.escape(BOOT_MOUNT_POINT) + "/loader/entries/nixos.*-generation-([0-9]+)(-specialisation-.*)?\.conf$")
-    known_paths = []
+    known_paths = set()
     for gen in gens:
         bootspec = get_bootspec(gen.profile, gen.generation)
-        known_paths.append(copy_from_file(bootspec.kernel, True))
-        known_paths.append(copy_from_file(bootspec.initrd, True))
+        known_paths.add(os.path.normpath(f"{BOOT_MOUNT_POINT}/{copy_from_file(bootspec.kernel)}"))
+        known_paths.add(os.path.normpath(f"{BOOT_MOUNT_POINT}/{copy_from_file(bootspec.initrd)}"))
     for path in glob.iglob(f"{BOOT_MOUNT_POINT}/loader/entries/nixos*-generation-[1-9]*.conf"):
         if rex_profile.match(path):
             prof = rex_profile.sub(r"\1", path)
@@ -233,10 +472,64 @@ def remove_old_entries(gens: list[SystemIdentifier]) -> None:
         if not (prof, gen_number, None) in gens:
             os.unlink(path)
     for path in glob.iglob(f"{BOOT_MOUNT_POINT}/{NIXOS_DIR}/*"):
-        if not path in known_paths and not os.path.isdir(path):
+        if not os.path.normpath(path) in known_paths and not os.path.isdir(path):
             os.unlink(path)
 
 
+def needed_files(gens: list[SystemIdentifier]) -> set[str]:
+    """The entries, kernels and initrds of all generations, relative to BOOT_MOUNT_POINT"""
+    needed = set()
+    for gen in gens:
+        bootspec = get_bootspec(gen.profile, gen.generation)
+        needed.add(entry_path(gen.profile, gen.generation, None))
+        needed.update(entry_path(gen.profile, gen.generation, s) for s in bootspec.specialisations)
+        for spec in [bootspec, *bootspec.specialisations.values()]:
+            needed.add(boot_relative(copy_from_file(spec.kernel)))
+            needed.add(boot_relative(copy_from_file(spec.initrd)))
+    return needed
+
+
+def install_extra_files(manifest: Manifest) -> set[str]:
+    """Install the extra files and entries, and return their paths.
+
+    Installed files are also marked in the .extra-files directory, which is
+    how previous versions of this script found them to remove them again.
+    """
+    with open(EXTRA_FILES) as f:
+        # Keys may be given as absolute paths, e.g. "/efi/foo.efi", they are still
+        # relative to the boot mount point.
+        extra_files: Dict[str, str] = {
+            boot_relative(rel): source for rel, source in json.load(f).items()
+        }
+    markers = f"{BOOT_MOUNT_POINT}/{NIXOS_DIR}/.extra-files"
+
+    for root, _, files in os.walk(markers, topdown=False):
+        relative_root = root.removeprefix(markers).removeprefix("/")
+        actual_root = os.path.join(f"{BOOT_MOUNT_POINT}", relative_root)
+
+        for file in files:
+            rel = os.path.join(relative_root, file)
+            if rel in extra_files:
+                continue
+            manifest.remove(rel)
+            os.unlink(os.path.join(root, file))
+
+        if os.path.isdir(actual_root) and not len(os.listdir(actual_root)):
+            os.rmdir(actual_root)
+        if not len(os.listdir(root)):
+            os.rmdir(root)
+
+    os.makedirs(markers, exist_ok=True)
+    for rel, source in sorted(extra_files.items()):
+        manifest.copy(source, rel, replace=True)
+        marker = os.path.join(markers, rel)
+        if not os.path.exists(marker):
+            os.makedirs(os.path.dirname(marker), exist_ok=True)
+            open(marker, "w").close()
+
+    return set(extra_files)
+
+
 def cleanup_esp() -> None:
     for path in glob.iglob(f"{EFI_SYS_MOUNT_POINT}/loader/entries/nixos*"):
         os.unlink(path)
@@ -320,17 +613,23 @@ def install_bootloader(args: argparse.Namespace) -> None:
     for profile in get_profiles():
         gens += get_generations(profile)
 
-    remove_old_entries(gens)
+    manifest = Manifest()
+    # Without a manifest, fall back to looking for old files
+    if not manifest.exists:
+        remove_old_entries(gens)
+    copy_boot_files(gens, manifest)
 
+    entries: list[tuple[str, str] | None] = []
+    default_gen = None
     for gen in gens:
         try:
             bootspec = get_bootspec(gen.profile, gen.generation)
             is_default = os.path.dirname(bootspec.init) == args.default_config
-            write_entry(*gen, machine_id, bootspec, current=is_default)
+            entries.append(write_entry(*gen, machine_id, bootspec, current=is_default, manifest=manifest))
             for specialisation in bootspec.specialisations.keys():
-                write_entry(gen.profile, gen.generation, specialisation, machine_id, bootspec, current=is_default)
+                entries.append(write_entry(gen.profile, gen.generation, specialisation, machine_id, bootspec, current=is_default, manifest=manifest))
             if is_default:
-                write_loader_conf(*gen)
+                default_gen = gen
         except OSError as e:
             # See https://github.com/NixOS/nixpkgs/issues/114552
             if e.errno == errno.EINVAL:
@@ -339,30 +638,22 @@ def install_bootloader(args: argparse.Namespace) -> None:
             else:
                 raise e
 
+    commit_entries(entries)
+    # The loader configuration refers to the default entry, so write it once the
+    # entries are in place.
+    if default_gen is not None:
+        write_loader_conf(*default_gen, manifest)
+
     if BOOT_MOUNT_POINT != EFI_SYS_MOUNT_POINT:
         # Cleanup any entries in ESP if xbootldrMountPoint is set.
         # If the user later unsets xbootldrMountPoint, entries in XBOOTLDR will not be cleaned up
         # automatically, as we don't have information about the mount point anymore.
         cleanup_esp()
 
-    for root, _, files in os.walk(f"{BOOT_MOUNT_POINT}/{NIXOS_DIR}/.extra-files", topdown=False):
-        relative_root = root.removeprefix(f"{BOOT_MOUNT_POINT}/{NIXOS_DIR}/.extra-files").removeprefix("/")
-        actual_root = os.path.join(f"{BOOT_MOUNT_POINT}", relative_root)
-
-        for file in files:
-            actual_file = os.path.join(actual_root, file)
-
-            if os.path.exists(actual_file):
-                os.unlink(actual_file)
-            os.unlink(os.path.join(root, file))
-
-        if not len(os.listdir(actual_root)):
-            os.rmdir(actual_root)
-        os.rmdir(root)
-
-    os.makedirs(f"{BOOT_MOUNT_POINT}/{NIXOS_DIR}/.extra-files", exist_ok=True)
-
-    subprocess.check_call(COPY_EXTRA_FILES)
+    needed = needed_files(gens) | install_extra_files(manifest)
+    manifest.remove_stale(needed)
+    manifest.save()
+    manifest.report()
 
 
 def main() -> None:
@@ -32,8 +32,6 @@ let
 
     bootspecTools = pkgs.bootspec;
 
-    nix = config.nix.package.out;
-
     timeout = optionalString (config.boot.loader.timeout != null) config.boot.loader.timeout;
 
     configurationLimit = if cfg.configurationLimit == null then 0 else cfg.configurationLimit;
@@ -65,19 +63,11 @@ let
         "${pkgs.util-linuxMinimal}/bin/findmnt ${cfg.xbootldrMountPoint} > /dev/null || fail xbootldrMountPoint ${cfg.xbootldrMountPoint}"}
     '';
 
-    copyExtraFiles = pkgs.writeShellScript "copy-extra-files" ''
-      empty_file=$(${pkgs.coreutils}/bin/mktemp)
-
-      ${concatStrings (mapAttrsToList (n: v: ''
-        ${pkgs.coreutils}/bin/install -Dp "${v}" "${bootMountPoint}/"${escapeShellArg n}
-        ${pkgs.coreutils}/bin/install -D $empty_file "${bootMountPoint}/${nixosDir}/.extra-files/"${escapeShellArg n}
-      '') cfg.extraFiles)}
-
-      ${concatStrings (mapAttrsToList (n: v: ''
-        ${pkgs.coreutils}/bin/install -Dp "${pkgs.writeText n v}" "${bootMountPoint}/loader/entries/"${escapeShellArg n}
-        ${pkgs.coreutils}/bin/install -D $empty_file "${bootMountPoint}/${nixosDir}/.extra-files/loader/entries/"${escapeShellArg n}
-      '') cfg.extraEntries)}
-    '';
+    # Files to install on the boot partition, by their path relative to it
+    extraFiles = pkgs.writeText "extra-files.json" (builtins.toJSON (
+      mapAttrs (n: v: "${v}") cfg.extraFiles
+      // mapAttrs' (n: v: nameValuePair "loader/entries/${n}" "${pkgs.writeText n v}") cfg.extraEntries
+    ));
   };
 
   finalSystemdBootBuilder = pkgs.writeScript "install-systemd-boot.sh" ''
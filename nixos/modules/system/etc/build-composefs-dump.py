@@ -10,10 +10,15 @@ Ensure to check the file with the check script when you make changes to it:
 ./check-build-composefs-dump.sh ./build-composefs_dump.py
 """
 
+import argparse
 import glob
+import hashlib
 import json
 import os
+import stat
+import struct
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 from typing import Any
@@ -127,13 +132,156 @@ def add_leading_directories(
         paths[component] = composefs_path
 
 
+FSVERITY_BLOCK_SIZE = 4096
+
+
+def fsverity_digest(path: str) -> str:
+    """Compute the fs-verity digest of a file
+
+    This is the digest `fsverity measure` prints for a file with the default
+    parameters (SHA-256, 4096 byte blocks, no salt) and what composefs expects
+    in the digest field of a dump. It is the SHA-256 of the fs-verity
+    descriptor, which contains the file size and the root hash of the Merkle
+    tree over the file contents.
+    """
+    block_size = FSVERITY_BLOCK_SIZE
+    size = 0
+    level = bytearray()
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            size += len(block)
+            level += hashlib.sha256(block.ljust(block_size, b"\0")).digest()
+
+    if size == 0:
+        root_hash = bytes(32)
+    else:
+        # Hash each level block by block until only the root hash is left
+        while len(level) > hashlib.sha256().digest_size:
+            level = bytearray().join(
+                hashlib.sha256(
+                    level[i : i + block_size].ljust(block_size, b"\0")
+                ).digest()
+                for i in range(0, len(level), block_size)
+            )
+        root_hash = bytes(level)
+
+    # struct fsverity_descriptor: version 1, hash algorithm 1 (SHA-256), log2
+    # of the block size, salt size, reserved, data size, root hash, salt, and
+    # reserved padding
+    descriptor = struct.pack("<BBBBIQ64s32s144x", 1, 1, 12, 0, 0, size, root_hash, b"")
+    return hashlib.sha256(descriptor).hexdigest()
+
+
+class DigestCache:
+    """A persistent cache of file digests
+
+    Only files in the Nix store are cached. Their contents never change, so
+    their digests can be cached by path forever.
+    """
+
+    def __init__(self, path: str | None) -> None:
+        self.path = path
+        self.store_dir = os.environ.get("NIX_STORE", "/nix/store") + "/"
+        self.digests: dict[str, str] = {}
+        self.changed = False
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as f:
+                self.digests = json.load(f)["digests"]
+
+    def get(self, source: str) -> str:
+        digest = self.digests.get(source)
+        if digest is None:
+            digest = fsverity_digest(source)
+            if self.path is not None and source.startswith(self.store_dir):
+                self.digests[source] = digest
+                self.changed = True
+        return digest
+
+    def save(self) -> None:
+        if self.path is None or not self.changed:
+            return
+        tmp = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "digests": self.digests}, f, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class MetadataCollector:
+    """Collect the metadata of all sources up front
+
+    Sources mostly live in the Nix store, which may be slow (e.g. on network
+    filesystems or a cold cache). Instead of looking up each source while
+    walking the config, all lookups are submitted to a thread pool at once and
+    their results are consumed in config order. Errors are raised when the
+    result of the failing lookup is consumed, as they would be when looking up
+    sources one by one.
+    """
+
+    def __init__(self, config: list[Attrs], digests: DigestCache | None) -> None:
+        self._pool = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+        self._digests = digests
+        self._stats: dict[str, Future[tuple[os.stat_result, str]]] = {}
+        self._globs: dict[str, Future[list[str]]] = {}
+        for attrs in config:
+            source = attrs["source"]
+            if "*" in source:
+                if source not in self._globs:
+                    self._globs[source] = self._pool.submit(glob.glob, source)
+            elif (
+                attrs["mode"] not in ("symlink", "direct-symlink")
+                and source not in self._stats
+            ):
+                self._stats[source] = self._pool.submit(self._lookup, source)
+
+    def _lookup(self, source: str) -> tuple[os.stat_result, str]:
+        st = os.stat(source)
+        digest = "-"
+        # hashlib releases the GIL while hashing, so files are hashed in parallel
+        if self._digests is not None and stat.S_ISREG(st.st_mode):
+            digest = self._digests.get(source)
+        return st, digest
+
+    def stat(self, source: str) -> os.stat_result:
+        return self._stats[source].result()[0]
+
+    def digest(self, source: str) -> str:
+        """The digest of a regular file source, `-` if digests are disabled"""
+        return self._stats[source].result()[1]
+
+    def glob(self, source: str) -> list[str]:
+        return self._globs[source].result()
+
+    def close(self) -> None:
+        self._pool.shutdown(cancel_futures=True)
+
+
 def main() -> None:
     """Build a composefs dump from a Json config
 
     This config describes the files that the final composefs image is supposed
     to contain.
     """
-    config_file = sys.argv[1]
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("config_file")
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="do not print every path on stderr",
+    )
+    parser.add_argument(
+        "--digests",
+        action="store_true",
+        help="add the fs-verity digests of regular files to the dump",
+    )
+    parser.add_argument(
+        "--digest-cache",
+        metavar="PATH",
+        help="cache the digests of files in the Nix store in PATH",
+    )
+    args = parser.parse_args()
+
+    config_file = args.config_file
     if not config_file:
         eprint("No config file was supplied.")
         sys.exit(1)
@@ -145,8 +293,31 @@ def main() -> None:
         eprint("Config is empty.")
         sys.exit(1)
 
-    eprint("Building composefs dump...")
+    if not args.quiet:
+        eprint("Building composefs dump...")
 
+    digests = DigestCache(args.digest_cache) if args.digests else None
+    metadata = MetadataCollector(config, digests)
+    try:
+        paths = collect_paths(config, metadata)
+    finally:
+        metadata.close()
+    if digests is not None:
+        digests.save()
+
+    out = sys.stdout
+    out.write("/ 4096 40755 1 0 0 0 0.0 - - -\n")  # Root directory
+    for key in sorted(paths):
+        composefs_path = paths[key]
+        if not args.quiet:
+            eprint(composefs_path.path)
+        out.write(composefs_path.write_line())
+        out.write("\n")
+
+
+def collect_paths(
+    config: list[Attrs], metadata: MetadataCollector
+) -> dict[str, ComposefsPath]:
     paths: dict[str, ComposefsPath] = {}
     for attrs in config:
         # Normalize the target path to work around issues in how targets are
@@ -158,7 +329,7 @@ def main() -> None:
         mode = attrs["mode"]
 
         if "*" in source:  # Path with globbing
-            glob_sources = glob.glob(source)
+            glob_sources = metadata.glob(source)
             for glob_source in glob_sources:
                 basename = os.path.basename(glob_source)
                 glob_target = f"{target}/{basename}"
@@ -184,33 +355,29 @@ def main() -> None:
                     mode="0777",
                     payload=source,
                 )
-            elif os.path.isdir(source):
-                composefs_path = ComposefsPath(
-                    attrs,
-                    size=4096,
-                    filetype=FileType.directory,
-                    mode=mode,
-                    payload=source,
-                )
             else:
-                composefs_path = ComposefsPath(
-                    attrs,
-                    size=os.stat(source).st_size,
-                    filetype=FileType.file,
-                    mode=mode,
-                    # payload needs to be relative path in this case
-                    payload=target.lstrip("/"),
-                )
+                st = metadata.stat(source)
+                if stat.S_ISDIR(st.st_mode):
+                    composefs_path = ComposefsPath(
+                        attrs,
+                        size=4096,
+                        filetype=FileType.directory,
+                        mode=mode,
+                        payload=source,
+                    )
+                else:
+                    composefs_path = ComposefsPath(
+                        attrs,
+                        size=st.st_size,
+                        filetype=FileType.file,
+                        mode=mode,
+                        # payload needs to be relative path in this case
+                        payload=target.lstrip("/"),
+                    )
+                    composefs_path.digest = metadata.digest(source)
             paths[target] = composefs_path
             add_leading_directories(target, attrs, paths)
-
-    composefs_dump = ["/ 4096 40755 1 0 0 0 0.0 - - -"]  # Root directory
-    for key in sorted(paths):
-        composefs_path = paths[key]
-        eprint(composefs_path.path)
-        composefs_dump.append(composefs_path.write_line())
-
-    print("\n".join(composefs_dump))
+    return paths
 
 
 if __name__ == "__main__":
@@ -295,7 +295,7 @@ in
     system.build.etcMetadataImage =
       let
         etcJson = pkgs.writeText "etc-json" (builtins.toJSON etc');
-        etcDump = pkgs.runCommand "etc-dump" { } "${build-composefs-dump} ${etcJson} > $out";
+        etcDump = pkgs.runCommand "etc-dump" { } "${build-composefs-dump} --quiet ${etcJson} > $out";
       in
       pkgs.runCommand "etc-metadata.erofs" {
         nativeBuildInputs = [ pkgs.composefs pkgs.erofs-utils ];
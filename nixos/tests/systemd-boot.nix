@@ -341,6 +341,35 @@ in
     '';
   };
 
+  initrdSecrets = makeTest {
+    name = "systemd-boot-initrd-secrets";
+    meta.maintainers = with pkgs.lib.maintainers; [ julienmalka ];
+
+    nodes.machine = { pkgs, ... }: {
+      imports = [ common ];
+      boot.initrd.secrets."/etc/secret" = pkgs.writeText "secret" "hello";
+    };
+
+    testScript = ''
+      initrd = machine.succeed(
+          "sed -n 's/^initrd //p' /boot/loader/entries/nixos-generation-1.conf"
+      ).strip()
+
+      with subtest("secrets are not appended again on every switch"):
+          before = machine.succeed(f"sha256sum /boot{initrd}")
+          machine.succeed("/run/current-system/bin/switch-to-configuration boot")
+          machine.succeed("/run/current-system/bin/switch-to-configuration boot")
+          after = machine.succeed(f"sha256sum /boot{initrd}")
+          assert before == after, "initrd changed between switches"
+
+      with subtest("files missing from the manifest are removed"):
+          machine.succeed("touch /boot/EFI/nixos/orphan.efi")
+          machine.succeed("/run/current-system/bin/switch-to-configuration boot")
+          machine.fail("test -e /boot/EFI/nixos/orphan.efi")
+          machine.succeed(f"test -e /boot{initrd}")
+    '';
+  };
+
   switch-test = makeTest {
     name = "systemd-boot-switch-test";
     meta.maintainers = with pkgs.lib.maintainers; [ Enzime julienmalka ];
@@ -2,7 +2,7 @@
 
 with pkgs;
 let
-  pyEnv = python3.withPackages (ps: [ ps.gitpython ]);
+  pyEnv = python3.withPackages (ps: [ ps.aiohttp ps.gitpython ]);
 in
 
 mkShell {
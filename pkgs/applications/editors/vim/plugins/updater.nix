@@ -21,6 +21,7 @@ buildPythonApplication {
   ];
 
   pythonPath = [
+    python3Packages.aiohttp
     python3Packages.gitpython
   ];
 
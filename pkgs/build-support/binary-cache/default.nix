@@ -1,4 +1,4 @@
-{ lib, stdenv, coreutils, jq, python3, nix, xz }:
+{ lib, stdenv, coreutils, jq, python3, nix, xz, zstd }:
 
 # This function is for creating a flat-file binary cache, i.e. the kind created by
 # nix copy --to file:///some/path and usable as a substituter (with the file:// prefix).
@@ -8,10 +8,17 @@
 
 { name ? "binary-cache"
 , rootPaths
+  # Compression used for the NAR files, either "xz" or "zstd"
+, compression ? "xz"
+  # A cache previously built by this function. NARs of paths whose NAR hash did not
+  # change are reused from it instead of being dumped and compressed again.
+, seedCache ? null
 }:
 
+assert lib.elem compression [ "xz" "zstd" ];
+
 stdenv.mkDerivation {
-  inherit name;
+  inherit name compression seedCache;
 
   __structuredAttrs = true;
 
@@ -19,7 +26,7 @@ stdenv.mkDerivation {
 
   preferLocalBuild = true;
 
-  nativeBuildInputs = [ coreutils jq python3 nix xz ];
+  nativeBuildInputs = [ coreutils jq python3 nix xz zstd ];
 
   buildCommand = ''
     mkdir -p $out/nar
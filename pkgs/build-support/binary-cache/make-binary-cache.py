@@ -1,10 +1,28 @@
 
+import hashlib
 import json
 import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 with open(os.environ["NIX_ATTRS_JSON_FILE"], "r") as f:
-  closures = json.load(f)["closure"]
+  attrs = json.load(f)
+  closures = attrs["closure"]
+
+compression = attrs.get("compression", "xz")
+seedCache = attrs.get("seedCache")
+jobs = int(os.environ.get("NIX_BUILD_CORES", "0")) or os.cpu_count() or 1
+
+# Paths are compressed concurrently by the worker pool, so each compressor runs on a
+# single thread. Multithreaded compressors on top of that would start jobs times cores
+# threads, and xz would keep a multithreaded working set per worker.
+compressors = {
+  "xz": (["xz", "-c", "-T1"], "xz"),
+  "zstd": (["zstd", "-c", "-q", "-T1"], "zst"),
+}
+if compression not in compressors:
+  raise Exception("unsupported compression: " + compression)
+compressCommand, compressExtension = compressors[compression]
 
 os.chdir(os.environ["out"])
 
@@ -16,28 +34,139 @@ with open("nix-cache-info", "w") as f:
 def dropPrefix(path):
   return path[len(nixPrefix + "/"):]
 
-for item in closures:
+# Nix's base32 variant, as printed by `nix-hash --base32`
+nixBase32Alphabet = "0123456789abcdfghijklmnpqrsvwxyz"
+
+def toNixBase32(digest):
+  length = (len(digest) * 8 - 1) // 5 + 1
+  chars = []
+  for n in range(length - 1, -1, -1):
+    b = n * 5
+    i, j = b // 8, b % 8
+    c = digest[i] >> j
+    if i + 1 < len(digest):
+      c |= digest[i + 1] << (8 - j)
+    chars.append(nixBase32Alphabet[c & 0x1f])
+  return "".join(chars)
+
+def parseNarInfo(path):
+  with open(path, "r") as f:
+    return dict(line.rstrip("\n").split(": ", 1) for line in f if ": " in line)
+
+# Entries of a previous cache, keyed by store path. We use the manifest written by an
+# earlier run if there is one and fall back to reading every narinfo file otherwise.
+seedEntries = {}
+if seedCache is not None:
+  manifestPath = os.path.join(seedCache, "manifest.json")
+  if os.path.exists(manifestPath):
+    with open(manifestPath, "r") as f:
+      seedEntries = json.load(f)["entries"]
+  else:
+    for name in os.listdir(seedCache):
+      if name.endswith(".narinfo"):
+        entry = parseNarInfo(os.path.join(seedCache, name))
+        seedEntries[entry["StorePath"]] = {
+          "url": entry["URL"],
+          "compression": entry["Compression"],
+          "fileHash": entry["FileHash"],
+          "fileSize": int(entry["FileSize"]),
+          "narHash": entry["NarHash"],
+        }
+
+# NARs don't contain their store path, so any entry with the same NAR hash will do if the
+# store path itself isn't in the previous cache.
+seedByNarHash = { entry["narHash"]: entry for entry in seedEntries.values() }
+
+def narInfoLines(item, url, fileHash, fileSize):
+  return [
+    "StorePath: " + item["path"],
+    "URL: " + url,
+    "Compression: " + compression,
+    "FileHash: " + fileHash,
+    "FileSize: " + str(fileSize),
+    "NarHash: " + item["narHash"],
+    "NarSize: " + str(item["narSize"]),
+    "References: " + " ".join(dropPrefix(ref) for ref in sorted(item["references"])),
+  ]
+
+def reuseNar(item):
+  entry = seedEntries.get(item["path"])
+  if entry is None or entry["narHash"] != item["narHash"]:
+    entry = seedByNarHash.get(item["narHash"])
+  if entry is None or entry["compression"] != compression:
+    return None
+  src = os.path.join(seedCache, entry["url"])
+  if not os.path.exists(src):
+    return None
+  # Copy rather than link, the file belongs to another store path. The hash and size
+  # are taken from the copy, not from the previous cache, which may have been made by
+  # an older version of this script.
+  tmpFile = "nar/" + dropPrefix(item["path"]).split("-")[0] + ".nar." + compressExtension + ".tmp"
+  fileHash = hashlib.sha256()
+  fileSize = 0
+  with open(src, "rb") as fsrc, open(tmpFile, "wb") as fdst:
+    while chunk := fsrc.read(1 << 20):
+      fileHash.update(chunk)
+      fileSize += len(chunk)
+      fdst.write(chunk)
+  fileHash = toNixBase32(fileHash.digest())
+  finalFile = "nar/" + fileHash + ".nar." + compressExtension
+  os.rename(tmpFile, finalFile)
+  return finalFile, "sha256:" + fileHash, fileSize
+
+def makeNar(item):
   narInfoHash = dropPrefix(item["path"]).split("-")[0]
 
-  xzFile = "nar/" + narInfoHash + ".nar.xz"
-  with open(xzFile, "w") as f:
-    subprocess.run("nix-store --dump %s | xz -c" % item["path"], stdout=f, shell=True)
+  if reused := reuseNar(item):
+    return narInfoHash, True, narInfoLines(item, *reused)
+
+  tmpFile = "nar/" + narInfoHash + ".nar." + compressExtension + ".tmp"
+
+  # Dump the path once and hash the compressed stream while writing it out, instead of
+  # dumping it again for a separate hashing pass.
+  fileHash = hashlib.sha256()
+  fileSize = 0
+  dump = subprocess.Popen(["nix-store", "--dump", item["path"]], stdout=subprocess.PIPE)
+  compress = subprocess.Popen(compressCommand, stdin=dump.stdout, stdout=subprocess.PIPE)
+  dump.stdout.close()
+  with open(tmpFile, "wb") as f:
+    while chunk := compress.stdout.read(1 << 20):
+      fileHash.update(chunk)
+      fileSize += len(chunk)
+      f.write(chunk)
+  compress.stdout.close()
+  if compress.wait() != 0 or dump.wait() != 0:
+    raise Exception("failed to dump and compress " + item["path"])
 
-  fileHash = subprocess.run(["nix-hash", "--base32", "--type", "sha256", item["path"]], capture_output=True).stdout.decode().strip()
-  fileSize = os.path.getsize(xzFile)
+  # Name the compressed file after its own hash to match "nix copy" behavior
+  fileHash = toNixBase32(fileHash.digest())
+  finalFile = "nar/" + fileHash + ".nar." + compressExtension
+  os.rename(tmpFile, finalFile)
 
-  # Rename the .nar.xz file to its own hash to match "nix copy" behavior
-  finalXzFile = "nar/" + fileHash + ".nar.xz"
-  os.rename(xzFile, finalXzFile)
+  return narInfoHash, False, narInfoLines(item, finalFile, "sha256:" + fileHash, fileSize)
 
+with ThreadPoolExecutor(max_workers=jobs) as pool:
+  narInfos = list(pool.map(makeNar, closures))
+
+# Write narinfos in a fixed order so the output does not depend on scheduling.
+manifest = {}
+for narInfoHash, _reused, lines in sorted(narInfos):
   with open(narInfoHash + ".narinfo", "w") as f:
-    f.writelines((x + "\n" for x in [
-      "StorePath: " + item["path"],
-      "URL: " + finalXzFile,
-      "Compression: xz",
-      "FileHash: sha256:" + fileHash,
-      "FileSize: " + str(fileSize),
-      "NarHash: " + item["narHash"],
-      "NarSize: " + str(item["narSize"]),
-      "References: " + " ".join(dropPrefix(ref) for ref in item["references"]),
-    ]))
+    f.writelines((x + "\n" for x in lines))
+  entry = dict(line.split(": ", 1) for line in lines)
+  manifest[entry["StorePath"]] = {
+    "url": entry["URL"],
+    "compression": entry["Compression"],
+    "fileHash": entry["FileHash"],
+    "fileSize": int(entry["FileSize"]),
+    "narHash": entry["NarHash"],
+  }
+
+# A single index of all entries, so later runs seeded from this cache don't have to
+# read every narinfo file.
+with open("manifest.json", "w") as f:
+  json.dump({ "version": 1, "entries": manifest }, f, sort_keys=True, separators=(",", ":"))
+
+if seedCache is not None:
+  reusedCount = sum(1 for _, reused, _ in narInfos if reused)
+  print("reused %d of %d NARs from %s" % (reusedCount, len(narInfos), seedCache))
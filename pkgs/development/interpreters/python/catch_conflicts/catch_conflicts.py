@@ -1,24 +1,37 @@
 from importlib.metadata import PathDistribution
 from pathlib import Path
 import collections
+import re
 import sys
 import os
-from typing import Dict, List, Set, Tuple
+from typing import Deque, Dict, List, Optional, Tuple
 do_abort: bool = False
-packages: Dict[str, Dict[str, Dict[str, List[str]]]] = collections.defaultdict(dict)
-found_paths: Set[Path] = set()
+# the .dist-info directories of each package name, by store path
+packages: Dict[str, Dict[Path, Path]] = collections.defaultdict(dict)
+# each store path that was found, and the store path it was first found from
+found_paths: Dict[Path, Optional[Path]] = {}
 out_path: Path = Path(os.getenv("out"))
 version: Tuple[int, int] = sys.version_info
 site_packages_path: str = f'lib/python{version[0]}.{version[1]}/site-packages'
 
 
-def get_name(dist: PathDistribution) -> str:
-    return dist.metadata['name'].lower().replace('-', '_')
+def normalize_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
+# the name of the distribution in a .dist-info directory. Directories are
+# named "{name}-{version}.dist-info", only fall back to reading the metadata
+# if that name can't be split.
+def get_name(dist_info: Path) -> str:
+    name, sep, _version = dist_info.stem.partition("-")
+    if not sep:
+        name = PathDistribution(dist_info).metadata['name']
+    return normalize_name(name)
 
 
 # pretty print a package
 def describe_package(dist: PathDistribution) -> str:
-    return f"{get_name(dist)} {dist.version} ({dist._path})"
+    return f"{normalize_name(dist.metadata['name'])} {dist.version} ({dist._path})"
 
 
 # pretty print a list of parents (dependency chain)
@@ -30,49 +43,56 @@ def describe_parents(parents: List[str]) -> str:
         + str(f"\n      ...depending on: ".join(parents))
 
 
-# inserts an entry into 'packages'
-def add_entry(name: str, version: str, store_path: str, parents: List[str]) -> None:
-    packages[name][store_path] = dict(
-        version=version,
-        parents=parents,
-    )
-
-
-# transitively discover python dependencies and store them in 'packages'
-def find_packages(store_path: Path, site_packages_path: str, parents: List[str]) -> None:
-    site_packages: Path = (store_path / site_packages_path)
-    propagated_build_inputs: Path = (store_path / "nix-support/propagated-build-inputs")
-
-    # only visit each path once, to avoid exponential complexity with highly
-    # connected dependency graphs
-    if store_path in found_paths:
-        return
-    found_paths.add(store_path)
-
-    # add the current package to the list
-    if site_packages.exists():
-        for dist_info in site_packages.glob("*.dist-info"):
-            dist: PathDistribution = PathDistribution(dist_info)
-            add_entry(get_name(dist), dist.version, store_path, parents)
-
-    # recursively add dependencies
-    if propagated_build_inputs.exists():
-        with open(propagated_build_inputs, "r") as f:
-            build_inputs: List[str] = f.read().split()
-            for build_input in build_inputs:
-                find_packages(Path(build_input), site_packages_path, parents + [build_input])
-
-
-find_packages(out_path, site_packages_path, [f"this derivation: {out_path}"])
+# the dependency chain from this derivation to store_path, following the
+# parent pointers set by find_packages
+def get_parents(store_path: Path) -> List[str]:
+    chain: List[str] = []
+    path: Optional[Path] = store_path
+    while path is not None and path != out_path:
+        chain.append(str(path))
+        path = found_paths[path]
+    chain.append(f"this derivation: {out_path}")
+    chain.reverse()
+    return chain
+
+
+# transitively discover python dependencies and store them in 'packages'.
+# This is a breadth first search which only records the package each store
+# path was first found from, dependency chains are only put together for
+# the packages that are reported.
+def find_packages(root: Path, site_packages_path: str) -> None:
+    found_paths[root] = None
+    queue: Deque[Path] = collections.deque([root])
+    while queue:
+        store_path = queue.popleft()
+        site_packages: Path = (store_path / site_packages_path)
+        propagated_build_inputs: Path = (store_path / "nix-support/propagated-build-inputs")
+
+        # add the current package to the list
+        if site_packages.exists():
+            for dist_info in site_packages.glob("*.dist-info"):
+                packages[get_name(dist_info)][store_path] = dist_info
+
+        # queue dependencies, only visiting each path once, to avoid
+        # exponential complexity with highly connected dependency graphs
+        if propagated_build_inputs.exists():
+            with open(propagated_build_inputs, "r") as f:
+                for build_input in map(Path, f.read().split()):
+                    if build_input not in found_paths:
+                        found_paths[build_input] = store_path
+                        queue.append(build_input)
+
+
+find_packages(out_path, site_packages_path)
 
 # print all duplicates
 for name, store_paths in packages.items():
     if len(store_paths) > 1:
         do_abort = True
         print("Found duplicated packages in closure for dependency '{}': ".format(name))
-        for store_path, candidate in store_paths.items():
-            print(f"  {name} {candidate['version']} ({store_path})")
-            print(describe_parents(candidate['parents']))
+        for store_path, dist_info in store_paths.items():
+            print(f"  {name} {PathDistribution(dist_info).version} ({store_path})")
+            print(describe_parents(get_parents(store_path)))
 
 # fail if duplicates were found
 if do_abort:
@@ -0,0 +1,86 @@
+"""
+Precompute what `sitecustomize.py` does with `NIX_PYTHONPATH` at startup.
+
+For every directory on the path this records what `site.addsitedir` would do: add
+the directory itself, then go through its `.pth` files in order and add the paths
+they list or run their import lines. Wrapped programs then read this one file
+instead of listing every site-packages directory and parsing every `.pth` file on
+each start.
+
+Usage: make_path_cache.py PYTHON-VERSION NIX_PYTHONPATH CACHE
+
+If something can't be cached, no cache is written and wrapped programs fall back
+to processing `NIX_PYTHONPATH` themselves.
+
+The cache is a text file with one record per line, a one letter kind followed by
+a space and the value:
+
+    nix-python-path-cache 1      header and format version
+    v 3.11                       Python version the cache is for
+    n /nix/store/...:/nix/...    NIX_PYTHONPATH the cache is for
+    s /nix/store/.../site-pkgs   a site directory, always added
+    f /nix/store/.../foo.pth     a .pth file, for error messages
+    p /nix/store/.../dir         a path from the last .pth file, known to exist
+    c /some/dir                  a path outside the store, checked at startup
+    x 3 import foo               an import line of the last .pth file, with its line number
+
+This has to work with every Python we build environments for, including 2.7.
+"""
+import io
+import os
+import sys
+
+FORMAT = "nix-python-path-cache 1"
+
+
+def makepath(*paths):
+    # like site.makepath
+    dir = os.path.join(*paths)
+    try:
+        dir = os.path.abspath(dir)
+    except OSError:
+        pass
+    return dir
+
+
+def records(sitedir, store_dir):
+    sitedir = makepath(sitedir)
+    yield "s", sitedir
+    try:
+        names = os.listdir(sitedir)
+    except OSError:
+        return
+    names = [name for name in names if name.endswith(".pth") and not name.startswith(".")]
+    for name in sorted(names):
+        fullname = os.path.join(sitedir, name)
+        yield "f", fullname
+        with io.open(fullname, encoding="utf-8", errors="surrogateescape" if sys.version_info[0] > 2 else "strict") as f:
+            for n, line in enumerate(f):
+                if line.startswith("#") or line.strip() == "":
+                    continue
+                if line.startswith(("import ", "import\t")):
+                    yield "x", "%d %s" % (n + 1, line.rstrip("\n"))
+                    continue
+                dir = makepath(sitedir, line.rstrip())
+                if not dir.startswith(store_dir):
+                    yield "c", dir
+                elif os.path.exists(dir):
+                    yield "p", dir
+
+
+def main():
+    version, pythonpath, out = sys.argv[1:]
+    store_dir = os.environ.get("NIX_STORE", "/nix/store") + "/"
+    lines = [FORMAT, "v " + version, "n " + pythonpath]
+    for sitedir in pythonpath.split(":"):
+        for kind, value in records(sitedir, store_dir):
+            if "\n" in value or "\r" in value:
+                sys.stderr.write("cannot cache %r, not writing %s\n" % (value, out))
+                return
+            lines.append(kind + " " + value)
+    with io.open(out, "w", encoding="utf-8", errors="surrogateescape" if sys.version_info[0] > 2 else "strict") as f:
+        f.write(u"\n".join(lines) + u"\n")
+
+
+if __name__ == "__main__":
+    main()
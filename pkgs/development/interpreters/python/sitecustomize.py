@@ -7,7 +7,13 @@ order to process possible `.pth` files `site.addsitedir` is used.
 The paths listed in `PYTHONPATH` are added to `sys.path` afterwards, but they
 will be added before the entries we add here and thus take precedence.
 
-Note the `NIX_PYTHONPATH` environment variable is unset in order to prevent leakage.
+If `NIX_PYTHONPATHCACHE` points to a cache written by `make_path_cache.py` for the
+same `NIX_PYTHONPATH`, the paths and `.pth` import lines recorded there are used
+instead, so the site directories and `.pth` files don't have to be read again on
+every start.
+
+Note the `NIX_PYTHONPATH` and `NIX_PYTHONPATHCACHE` environment variables are unset in
+order to prevent leakage.
 
 Similarly, this module listens to the environment variable `NIX_PYTHONEXECUTABLE`
 and sets `sys.executable` to its value.
@@ -17,8 +23,69 @@ import sys
 import os
 import functools
 
+
+def exec_pth_line(sitedir, name, known_paths, line):
+    """Run an import line of a `.pth` file like `site.addpackage` does.
+
+    The locals of this frame match those of `site.addpackage`, setuptools'
+    `*-nspkg.pth` files look up `sitedir` with `sys._getframe(1).f_locals`.
+    """
+    exec(line, vars(site), locals())
+
+
+def load_path_cache(cache, paths):
+    """Apply a path cache, returns whether it could be used.
+
+    Does the same as `site.addsitedir` for each of `paths`, see `make_path_cache.py`.
+    """
+    try:
+        with open(cache) as f:
+            records = f.read().split('\n')
+    except (IOError, OSError):
+        return False
+    version = '%d.%d' % sys.version_info[:2]
+    if records[:3] != ['nix-python-path-cache 1', 'v ' + version, 'n ' + paths]:
+        return False
+
+    known_paths = site._init_pathinfo()
+
+    def add_path(path):
+        case = os.path.normcase(path)
+        if case not in known_paths:
+            sys.path.append(path)
+            known_paths.add(case)
+
+    sitedir = pth = None
+    skip = False
+    for record in records[3:]:
+        kind, _, value = record.partition(' ')
+        if kind == 's':
+            sitedir, pth, skip = value, None, False
+            add_path(value)
+        elif kind == 'f':
+            pth, skip = value, False
+        elif skip:
+            # like site.addpackage, ignore the rest of a .pth file after an error
+            continue
+        elif kind == 'p' or (kind == 'c' and os.path.exists(value)):
+            add_path(value)
+        elif kind == 'x':
+            n, _, line = value.partition(' ')
+            try:
+                exec_pth_line(sitedir, os.path.basename(pth), known_paths, line)
+            except Exception:
+                import traceback
+                sys.stderr.write('Error processing line %s of %s:\n\n' % (n, pth))
+                for exc_record in traceback.format_exception(*sys.exc_info()):
+                    for exc_line in exc_record.splitlines():
+                        sys.stderr.write('  ' + exc_line + '\n')
+                sys.stderr.write('\nRemainder of file ignored\n')
+                skip = True
+    return True
+
 paths = os.environ.pop('NIX_PYTHONPATH', None)
-if paths:
+cache = os.environ.pop('NIX_PYTHONPATHCACHE', None)
+if paths and not (cache and load_path_cache(cache, paths)):
     functools.reduce(lambda k, p: site.addsitedir(p, k), paths.split(':'), site._init_pathinfo())
 
 # Check whether we are in a venv or virtualenv.
@@ -119,6 +119,10 @@ let
       tkinter = callPackage ./tests/test_tkinter {
         interpreter = python;
       };
+      # Wrapped programs must start the same with and without the cached site path
+      path-cache = callPackage ./tests/test_path_cache {
+        interpreter = python;
+      };
     }
   );
 
@@ -0,0 +1,9 @@
+{ interpreter, runCommand }:
+
+runCommand "${interpreter.name}-path-cache-test" {
+  SITECUSTOMIZE = ../../sitecustomize.py;
+  MAKE_PATH_CACHE = ../../make_path_cache.py;
+} ''
+  ${interpreter.interpreter} ${./test_path_cache.py} --verbose
+  touch $out
+''
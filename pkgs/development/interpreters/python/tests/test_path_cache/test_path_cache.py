@@ -0,0 +1,112 @@
+# Tests for make_path_cache.py and the cache support of sitecustomize.py, run by
+# `python3.tests.path-cache`.
+#
+# Builds site directories with .pth files in a temporary directory and checks that
+# starting Python with the cache sets up the same sys.path and modules as without.
+# The scripts under test are taken from the interpreter directory, unless set with
+# the SITECUSTOMIZE and MAKE_PATH_CACHE environment variables:
+#
+#   python test_path_cache.py
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SITECUSTOMIZE = os.environ.get(
+    "SITECUSTOMIZE", os.path.join(HERE, "..", "..", "sitecustomize.py")
+)
+MAKE_PATH_CACHE = os.environ.get(
+    "MAKE_PATH_CACHE", os.path.join(HERE, "..", "..", "make_path_cache.py")
+)
+
+# What setuptools writes for a namespace package installed with
+# `setup.py install --single-version-externally-managed`.
+NSPKG_LINE = (
+    "import sys, types, os;has_mfs = sys.version_info > (3, 5);"
+    "p = os.path.join(sys._getframe(1).f_locals['sitedir'], *('ns',));"
+    "importlib = has_mfs and __import__('importlib.util');"
+    "has_mfs and __import__('importlib.machinery');"
+    "m = has_mfs and sys.modules.setdefault('ns', importlib.util.module_from_spec("
+    "importlib.machinery.PathFinder.find_spec('ns', [os.path.dirname(p)])));"
+    "m = m or sys.modules.setdefault('ns', types.ModuleType('ns'));"
+    "mp = (m or []) and m.__dict__.setdefault('__path__',[]);"
+    "(p not in mp) and mp.append(p)\n"
+)
+
+# Applies sitecustomize.py and reports what it did.
+PROBE = """
+import json, runpy, sys
+runpy.run_path(sys.argv[1])
+ns = sys.modules.get('ns')
+print(json.dumps({
+    'path': sys.path,
+    'ns': list(ns.__path__) if ns is not None else None,
+}))
+"""
+
+
+class PathCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sitedirs = []
+        for n in range(2):
+            sitedir = os.path.join(self.tmp.name, "site%d" % n)
+            os.makedirs(os.path.join(sitedir, "ns", "part%d" % n))
+            with open(os.path.join(sitedir, "ns", "part%d" % n, "__init__.py"), "w") as f:
+                f.write("")
+            with open(os.path.join(sitedir, "ns_part%d-nspkg.pth" % n), "w") as f:
+                f.write(NSPKG_LINE)
+            self.sitedirs.append(sitedir)
+        os.makedirs(os.path.join(self.sitedirs[0], "extra"))
+        with open(os.path.join(self.sitedirs[0], "extra.pth"), "w") as f:
+            f.write("# a comment\nextra\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def start(self, cache):
+        env = dict(os.environ, NIX_PYTHONPATH=":".join(self.sitedirs))
+        if cache is not None:
+            env["NIX_PYTHONPATHCACHE"] = cache
+        process = subprocess.run(
+            [sys.executable, "-S", "-c", PROBE, SITECUSTOMIZE],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return json.loads(process.stdout), process.stderr
+
+    def make_cache(self):
+        cache = os.path.join(self.tmp.name, "cache")
+        version = "%d.%d" % sys.version_info[:2]
+        subprocess.run(
+            [sys.executable, MAKE_PATH_CACHE, version, ":".join(self.sitedirs), cache],
+            env=dict(os.environ, NIX_STORE=self.tmp.name),
+            check=True,
+        )
+        return cache
+
+    def test_nspkg(self):
+        result, stderr = self.start(self.make_cache())
+        self.assertEqual(stderr, "")
+        self.assertEqual(
+            result["ns"],
+            [os.path.join(sitedir, "ns") for sitedir in self.sitedirs],
+        )
+
+    def test_same_as_without_cache(self):
+        self.assertEqual(self.start(self.make_cache()), self.start(None))
+
+    def test_other_pythonpath(self):
+        cache = self.make_cache()
+        self.sitedirs.pop()
+        self.assertEqual(self.start(cache), self.start(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+# Tests for the HTTP cache of update-python-libraries.py. Not used by the build.
+#
+# A local server stands in for PyPI and the GitHub API, so this runs offline:
+#
+#   python test-http-cache.py
+
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+spec = importlib.util.spec_from_file_location(
+    "update_python_libraries",
+    os.path.join(os.path.dirname(__file__), "update-python-libraries.py"),
+)
+upl = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(upl)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves fixed documents, with ETags for PyPI and Last-Modified for GitHub."""
+
+    documents = {
+        "/pypi/foo/json": {"info": {"version": "1.0"}, "releases": {"1.0": []}},
+        "/repos/owner/foo/releases": [{"tag_name": "v1.0", "draft": False}],
+    }
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append((self.path, dict(self.headers)))
+        document = self.documents.get(self.path)
+        if document is None:
+            self.send_error(404)
+            return
+
+        if self.path.startswith("/pypi/"):
+            validator = ("ETag", f'"{hash(json.dumps(document))}"')
+            fresh = self.headers.get("If-None-Match") == validator[1]
+        else:
+            validator = ("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+            fresh = self.headers.get("If-Modified-Since") == validator[1]
+
+        if fresh:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = json.dumps(document).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header(*validator)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        upl.INDEX = f"{base}/pypi"
+        upl.GITHUB_API = base
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        Handler.requests = []
+        upl.HTTP_CACHE = upl.HttpCache(self.tmp.name, ttl=0)
+
+    def tearDown(self):
+        upl.HTTP_CACHE = None
+        self.tmp.cleanup()
+
+    def test_revalidates_with_etag(self):
+        first = upl._fetch_page(f"{upl.INDEX}/foo/json")
+        second = upl._fetch_page(f"{upl.INDEX}/foo/json")
+        self.assertEqual(first, second)
+        self.assertEqual(first["info"]["version"], "1.0")
+        self.assertEqual(len(Handler.requests), 2)
+        self.assertNotIn("If-None-Match", Handler.requests[0][1])
+        self.assertIn("If-None-Match", Handler.requests[1][1])
+
+    def test_revalidates_with_last_modified(self):
+        url = f"{upl.GITHUB_API}/repos/owner/foo/releases"
+        first = upl._fetch_github(url)
+        second = upl._fetch_github(url)
+        self.assertEqual(first, second)
+        self.assertEqual(len(Handler.requests), 2)
+        self.assertIn("If-Modified-Since", Handler.requests[1][1])
+
+    def test_ttl(self):
+        upl.HTTP_CACHE.ttl = 3600
+        for _ in range(3):
+            upl._fetch_page(f"{upl.INDEX}/foo/json")
+        self.assertEqual(len(Handler.requests), 1)
+
+    def test_changed_document(self):
+        url = f"{upl.INDEX}/foo/json"
+        upl._fetch_page(url)
+        old = Handler.documents["/pypi/foo/json"]
+        new = {"info": {"version": "2.0"}, "releases": {"2.0": []}}
+        Handler.documents["/pypi/foo/json"] = new
+        try:
+            self.assertEqual(upl._fetch_page(url), new)
+            self.assertEqual(upl._fetch_page(url), new)
+        finally:
+            Handler.documents["/pypi/foo/json"] = old
+
+    def test_errors_are_not_cached(self):
+        with self.assertRaises(ValueError):
+            upl._fetch_page(f"{upl.INDEX}/missing/json")
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_without_cache(self):
+        upl.HTTP_CACHE = None
+        upl._fetch_page(f"{upl.INDEX}/foo/json")
+        upl._fetch_page(f"{upl.INDEX}/foo/json")
+        self.assertEqual(len(Handler.requests), 2)
+        self.assertNotIn("If-None-Match", Handler.requests[1][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
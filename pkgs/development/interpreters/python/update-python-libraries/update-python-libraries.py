@@ -13,15 +13,20 @@ to update all non-pinned libraries in that folder.
 
 import argparse
 import collections
+import hashlib
 import json
 import logging
 import os
 import re
 import subprocess
+import tempfile
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor as Pool
 from typing import Any, Optional
 
 import requests
+import requests.adapters
 from packaging.specifiers import SpecifierSet
 from packaging.version import InvalidVersion
 from packaging.version import Version as _Version
@@ -29,6 +34,9 @@ from packaging.version import Version as _Version
 INDEX = "https://pypi.io/pypi"
 """url of PyPI"""
 
+GITHUB_API = "https://api.github.com"
+"""url of the GitHub API"""
+
 EXTENSIONS = ["tar.gz", "tar.bz2", "tar", "zip", ".whl"]
 """Permitted file extensions. These are evaluated from left to right and the first occurance is returned."""
 
@@ -38,6 +46,9 @@ BULK_UPDATE = False
 
 GIT = "git"
 
+JOBS = min(32, (os.cpu_count() or 1) + 4)
+"""Number of packages updated concurrently"""
+
 NIXPKGS_ROOT = (
     subprocess.check_output(["git", "rev-parse", "--show-toplevel"])
     .decode("utf-8")
@@ -75,7 +86,75 @@ def _get_values(attribute, text):
     return values
 
 
+# Attributes of each package that the update may need. These are evaluated for all
+# packages at once by `_prefetch_attr_values`, instead of running a separate
+# evaluation of nixpkgs for each of them.
+PREFETCHED_ATTRS = {
+    "skipBulkUpdate": "pkg.skipBulkUpdate or null",
+    # only whether there are any, evaluating the derivation is not needed
+    "cargoDeps": "if (pkg.cargoDeps or null) != null then true else null",
+    "src.fetchSubmodules": "pkg.src.fetchSubmodules or null",
+    "src.fetchLFS": "pkg.src.fetchLFS or null",
+    "src.leaveDotGit": "pkg.src.leaveDotGit or null",
+    "src.meta.homepage": "pkg.src.meta.homepage or null",
+    "src.outputHash": "pkg.src.outputHash or null",
+}
+
+_attr_values: dict[str, Any] = {}
+"""Prefetched attribute values, by their full attribute path"""
+
+
+def _prefetch_attr_values(attr_paths: list[str]) -> None:
+    """Evaluate `PREFETCHED_ATTRS` for all of `attr_paths` in a single evaluation.
+
+    Values that can't be evaluated are null, like `_get_attr_value` returns None
+    for them. If the evaluation fails as a whole, nothing is prefetched and
+    `_get_attr_value` evaluates each attribute on its own.
+    """
+    attrs = " ".join(
+        f'"{name}" = try ({expr});' for name, expr in PREFETCHED_ATTRS.items()
+    )
+    expr = f"""
+      let
+        pkgs = import (builtins.getEnv "NIXPKGS_ROOT") {{ }};
+        inherit (pkgs) lib;
+        try = v: let r = builtins.tryEval (builtins.deepSeq v v); in if r.success then r.value else null;
+        attrPaths = builtins.fromJSON (builtins.readFile (builtins.getEnv "ATTR_PATHS"));
+        values = pkg: {{ {attrs} }};
+      in
+        lib.genAttrs attrPaths (attrPath:
+          values (lib.attrByPath (lib.splitString "." attrPath) null pkgs))
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(sorted(set(attr_paths)), f)
+        f.flush()
+        try:
+            response = subprocess.check_output(
+                [
+                    "nix",
+                    "--extra-experimental-features",
+                    "nix-command",
+                    "eval",
+                    "--impure",
+                    "--json",
+                    "--expr",
+                    expr,
+                ],
+                env={**os.environ, "NIXPKGS_ROOT": NIXPKGS_ROOT, "ATTR_PATHS": f.name},
+            )
+            values = json.loads(response.decode())
+        except (subprocess.CalledProcessError, ValueError) as e:
+            logging.warning(f"Unable to prefetch attributes, evaluating them one by one: {e}")
+            return
+
+    for attr_path, attrs in values.items():
+        for name, value in attrs.items():
+            _attr_values[f"{attr_path}.{name}"] = value
+
+
 def _get_attr_value(attr_path: str) -> Optional[Any]:
+    if attr_path in _attr_values:
+        return _attr_values[attr_path]
     try:
         response = subprocess.check_output(
             [
@@ -138,25 +217,114 @@ def _replace_value(attribute, value, text, oldvalue=None):
     return new_text
 
 
-def _fetch_page(url):
-    r = requests.get(url)
+def _make_session(pool_size):
+    """A session shared by all workers, keeping up to `pool_size` connections per host."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HttpCache:
+    """On-disk cache of JSON responses.
+
+    Responses younger than `ttl` seconds are used without asking the server.
+    Older ones are revalidated with a conditional request using their ETag or
+    Last-Modified date, so unchanged documents are not downloaded again, and don't
+    count against GitHub's rate limit.
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, url):
+        return os.path.join(
+            self.directory, hashlib.sha256(url.encode()).hexdigest() + ".json"
+        )
+
+    def _load(self, url):
+        try:
+            with open(self._path(url), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def _store(self, url, entry):
+        path = self._path(url)
+        # workers may fetch the same url concurrently, never leave a partial file
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+    def get(self, session, url, headers):
+        entry = self._load(url)
+        if entry is not None and time.time() - entry["fetched"] < self.ttl:
+            return entry["body"]
+
+        headers = dict(headers)
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        r = session.get(url, headers=headers)
+        if r.status_code == requests.codes.not_modified and entry is not None:
+            entry["fetched"] = time.time()
+            self._store(url, entry)
+            return entry["body"]
+        elif r.status_code != requests.codes.ok:
+            raise ValueError("request for {} failed".format(url))
+
+        body = r.json()
+        self._store(
+            url,
+            {
+                "url": url,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "fetched": time.time(),
+                "body": body,
+            },
+        )
+        return body
+
+
+SESSION = _make_session(JOBS)
+"""Shared HTTP session, so connections are reused across packages"""
+
+HTTP_CACHE: Optional[HttpCache] = None
+"""Cache of fetched documents, if enabled"""
+
+
+def _fetch_json(url, headers={}):
+    if HTTP_CACHE is not None:
+        return HTTP_CACHE.get(SESSION, url, headers)
+
+    r = SESSION.get(url, headers=headers)
     if r.status_code == requests.codes.ok:
         return r.json()
     else:
         raise ValueError("request for {} failed".format(url))
 
 
+def _fetch_page(url):
+    return _fetch_json(url)
+
+
 def _fetch_github(url):
     headers = {}
     token = os.environ.get("GITHUB_API_TOKEN")
     if token:
         headers["Authorization"] = f"token {token}"
-    r = requests.get(url, headers=headers)
-
-    if r.status_code == requests.codes.ok:
-        return r.json()
-    else:
-        raise ValueError("request for {} failed".format(url))
+    return _fetch_json(url, headers)
 
 
 def _hash_to_sri(algorithm, value):
@@ -246,23 +414,13 @@ def _get_latest_version_github(attr_path, package, extension, current_version, t
         matches = re.findall(r"^([^0-9]*)", string)
         return next(iter(matches), "")
 
-    try:
-        homepage = subprocess.check_output(
-            [
-                "nix",
-                "eval",
-                "-f",
-                f"{NIXPKGS_ROOT}/default.nix",
-                "--raw",
-                f"{attr_path}.src.meta.homepage",
-            ]
-        ).decode("utf-8")
-    except Exception as e:
-        raise ValueError(f"Unable to determine homepage: {e}")
+    homepage = _get_attr_value(f"{attr_path}.src.meta.homepage")
+    if not isinstance(homepage, str):
+        raise ValueError(f"Unable to determine homepage of {attr_path}")
     owner_repo = homepage[len("https://github.com/") :]  # remove prefix
     owner, repo = owner_repo.split("/")
 
-    url = f"https://api.github.com/repos/{owner}/{repo}/releases"
+    url = f"{GITHUB_API}/repos/{owner}/{repo}/releases"
     all_releases = _fetch_github(url)
     releases = list(filter(lambda x: not x["prerelease"], all_releases))
 
@@ -403,6 +561,24 @@ def _determine_extension(text, fetcher):
     return extension
 
 
+def _get_attr_path(pname):
+    # when invoked as an updateScript, UPDATE_NIX_ATTR_PATH will be set
+    # this allows us to work with packages which live outside of python-modules
+    return os.environ.get("UPDATE_NIX_ATTR_PATH", f"python3Packages.{pname}")
+
+
+def _get_attr_paths(path):
+    """All attribute paths `_update_package` may look at for `path`."""
+    if os.path.isdir(path):
+        path = os.path.join(path, "default.nix")
+    try:
+        with open(path, "r") as f:
+            text = f.read()
+    except OSError:
+        return []
+    return [_get_attr_path(pname) for pname in _get_values("pname", text)]
+
+
 def _update_package(path, target):
     # Read the expression
     with open(path, "r") as f:
@@ -422,9 +598,7 @@ def _update_package(path, target):
     # Attempt a fetch using each pname, e.g. backports-zoneinfo vs backports.zoneinfo
     successful_fetch = False
     for pname in pnames:
-        # when invoked as an updateScript, UPDATE_NIX_ATTR_PATH will be set
-        # this allows us to work with packages which live outside of python-modules
-        attr_path = os.environ.get("UPDATE_NIX_ATTR_PATH", f"python3Packages.{pname}")
+        attr_path = _get_attr_path(pname)
 
         if BULK_UPDATE and _skip_bulk_update(attr_path):
             raise ValueError(f"Bulk update skipped for {pname}")
@@ -557,6 +731,23 @@ environment variables:
     parser.add_argument(
         "--commit", action="store_true", help="Create a commit for each package update"
     )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "update-python-libraries",
+        ),
+        help="Directory to cache PyPI and GitHub responses in (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=0,
+        help="Use cached responses younger than this many seconds without revalidating them (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Don't cache PyPI and GitHub responses"
+    )
     parser.add_argument(
         "--use-pkgs-prefix",
         action="store_true",
@@ -568,14 +759,23 @@ environment variables:
 
     packages = list(map(os.path.abspath, args.package))
 
+    if not args.no_cache:
+        global HTTP_CACHE
+        HTTP_CACHE = HttpCache(args.cache_dir, args.cache_ttl)
+
     if len(packages) > 1:
         global BULK_UPDATE
         BULK_UPDATE = True
 
+    logging.info("Evaluating packages...")
+    _prefetch_attr_values(
+        [attr_path for path in packages for attr_path in _get_attr_paths(path)]
+    )
+
     logging.info("Updating packages...")
 
     # Use threads to update packages concurrently
-    with Pool() as p:
+    with Pool(JOBS) as p:
         results = list(filter(bool, p.map(lambda pkg: _update(pkg, target), packages)))
 
     logging.info("Finished updating packages.")
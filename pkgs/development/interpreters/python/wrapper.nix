@@ -20,6 +20,7 @@ let
     paths = requiredPythonModules (extraLibs ++ [ python ] ) ;
     pythonPath = "${placeholder "out"}/${python.sitePackages}";
     pythonExecutable = "${placeholder "out"}/bin/${python.executable}";
+    pathCache = "${placeholder "out"}/nix-support/python-path-cache";
   in buildEnv {
     name = "${python.name}-env";
 
@@ -42,13 +43,30 @@ let
             if [ -f "$prg" ]; then
               rm -f "$out/bin/$prg"
               if [ -x "$prg" ]; then
-                makeWrapper "$path/bin/$prg" "$out/bin/$prg" --set NIX_PYTHONPREFIX "$out" --set NIX_PYTHONEXECUTABLE ${pythonExecutable} --set NIX_PYTHONPATH ${pythonPath} ${lib.optionalString (!permitUserSite) ''--set PYTHONNOUSERSITE "true"''} ${lib.concatStringsSep " " makeWrapperArgs}
+                makeWrapper "$path/bin/$prg" "$out/bin/$prg" --set NIX_PYTHONPREFIX "$out" --set NIX_PYTHONEXECUTABLE ${pythonExecutable} --set NIX_PYTHONPATH ${pythonPath} --set NIX_PYTHONPATHCACHE ${pathCache} ${lib.optionalString (!permitUserSite) ''--set PYTHONNOUSERSITE "true"''} ${lib.concatStringsSep " " makeWrapperArgs}
               fi
             fi
           done
         fi
       done
-    '' + postBuild;
+    '' + postBuild + ''
+
+      # Record what the wrappers' sitecustomize would otherwise work out from
+      # NIX_PYTHONPATH on every start. This runs last, so that it sees the
+      # site-packages as changed by postBuild.
+      if [ -L "$out/nix-support" ]; then
+          nixSupport=$(readlink -f "$out/nix-support")
+          unlink "$out/nix-support"
+          mkdir "$out/nix-support"
+          for f in "$nixSupport"/*; do
+              [ -e "$f" ] || continue
+              ln -s "$f" "$out/nix-support/"
+          done
+      fi
+      mkdir -p "$out/nix-support"
+      ${python.pythonOnBuildForHost.interpreter} ${./make_path_cache.py} \
+          ${python.pythonVersion} ${pythonPath} ${pathCache}
+    '';
 
     inherit (python) meta;
 
@@ -36,6 +36,7 @@ buildPythonApplication {
     python3Packages.wrapPython
   ];
   propagatedBuildInputs = [
+    python3Packages.aiohttp
     python3Packages.gitpython
   ];
 
@@ -22,24 +22,29 @@ flag to automatically commit the changes for you.
 The `update` and `update-all` commands accept optional `--bin-only`
 and `--source-only` flags to restict the update to binary or source
 releases.
+
+Source dependencies of all updated releases are prefetched on one pool
+of `--jobs` workers, each distinct dependency only once. Results are
+kept in the `cache` directory next to this script.
 """
 import base64
 import csv
 import json
 import logging
 import os
-import random
 import re
 import subprocess
 import sys
 import tempfile
+import threading
 import traceback
 import urllib.request
 
 from abc import ABC
 from codecs import iterdecode
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import Iterable, Optional, Tuple
+from typing import Callable, Iterable, List, Optional, Tuple
 from urllib.request import urlopen
 
 import click
@@ -76,6 +81,9 @@ BINARY_INFO_JSON = "binary/info.json"
 # Number of spaces used for each indentation level
 JSON_INDENT = 4
 
+# Default number of prefetches to run at once
+PREFETCH_JOBS = 8
+
 os.chdir(os.path.dirname(__file__))
 
 memory: Memory = Memory("cache", verbose=0)
@@ -121,13 +129,10 @@ class Repo:
             if dep_path in self.deps and dep_path != "src/third_party/squirrel.mac":
                 self.deps[dep_path].get_deps(repo_vars, dep_path)
 
-    def prefetch(self) -> None:
-        self.hash = get_repo_hash(self.fetcher, self.args)
-
-    def prefetch_all(self) -> int:
+    def prefetch_all(self, prefetcher: "Prefetcher") -> List[Tuple["Repo", Future]]:
         return sum(
-            [dep.prefetch_all() for [_, dep] in self.deps.items()],
-            [delayed(self.prefetch)()],
+            [dep.prefetch_all(prefetcher) for [_, dep] in self.deps.items()],
+            [(self, prefetcher.prefetch(self))],
         )
 
     def flatten_repr(self) -> dict:
@@ -314,6 +319,35 @@ def get_repo_hash(fetcher: str, args: dict) -> str:
     return out.decode("utf-8").strip()
 
 
+class Prefetcher:
+    """Runs prefetches on a bounded pool of threads
+
+    Releases share most of their Chromium dependencies, so a repo that is
+    already being prefetched for one release is not prefetched again for
+    another, the second caller waits for the first one instead.
+    """
+
+    def __init__(self, jobs: int = PREFETCH_JOBS) -> None:
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        self.repos: dict = {}
+
+    def prefetch(self, repo: Repo) -> Future:
+        key = json.dumps([repo.fetcher, repo.args], sort_keys=True)
+        with self.lock:
+            if key not in self.repos:
+                self.repos[key] = self.pool.submit(
+                    get_repo_hash, repo.fetcher, repo.args
+                )
+            return self.repos[key]
+
+    def submit(self, fn: Callable, *args) -> Future:
+        return self.pool.submit(fn, *args)
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(cancel_futures=True)
+
+
 @memory.cache
 def _get_yarn_hash(path: str) -> str:
     print(f"prefetch-yarn-deps", file=sys.stderr)
@@ -426,28 +460,18 @@ def get_electron_info(major_version: str) -> Tuple[str, str, GitHubRepo]:
     return (major_version, m, electron_repo)
 
 
-def get_update(repo: Tuple[str, str, Repo]) -> Tuple[str, dict]:
+def get_update(repo: Tuple[str, str, Repo], prefetcher: Prefetcher) -> Tuple[str, dict]:
     (major_version, m, electron_repo) = repo
 
-    tasks = electron_repo.prefetch_all()
-    a = lambda: (("electron_yarn_hash", get_yarn_hash(electron_repo)))
-    tasks.append(delayed(a)())
-    a = lambda: (
-        (
-            "chromium_npm_hash",
-            get_npm_hash(
-                electron_repo.deps["src"], "third_party/node/package-lock.json"
-            ),
-        )
+    prefetches = electron_repo.prefetch_all(prefetcher)
+    yarn_hash = prefetcher.submit(get_yarn_hash, electron_repo)
+    npm_hash = prefetcher.submit(
+        get_npm_hash, electron_repo.deps["src"], "third_party/node/package-lock.json"
     )
-    tasks.append(delayed(a)())
-    random.shuffle(tasks)
+    gn_source = prefetcher.submit(get_gn_source, electron_repo.deps["src"])
 
-    task_results = {
-        n[0]: n[1]
-        for n in Parallel(n_jobs=3, require="sharedmem", return_as="generator")(tasks)
-        if n != None
-    }
+    for dep, future in prefetches:
+        dep.hash = future.result()
 
     tree = electron_repo.flatten("src/electron")
 
@@ -458,9 +482,10 @@ def get_update(repo: Tuple[str, str, Repo]) -> Tuple[str, dict]:
             **{key: m[key] for key in ["version", "modules", "chrome", "node"]},
             "chromium": {
                 "version": m["chrome"],
-                "deps": get_gn_source(electron_repo.deps["src"]),
+                "deps": gn_source.result(),
             },
-            **task_results,
+            "electron_yarn_hash": yarn_hash.result(),
+            "chromium_npm_hash": npm_hash.result(),
         },
     )
 
@@ -522,46 +547,63 @@ def update_bin(major_version: str, commit: bool) -> None:
         commit_result(package_name, old_version, new_version, BINARY_INFO_JSON)
 
 
-def update_source(major_version: str, commit: bool) -> None:
-    """Update a given electron-source release
+def save_source_update(major_version: str, info: dict, commit: bool) -> None:
+    """Saves the updated info of a given electron-source release
 
     Args:
         major_version: The major version number, e.g. '27'
+        info: The new info of the release
         commit: Whether the updater should commit the result
     """
+    # info.json is keyed by strings, releases may be given as numbers
+    major_version = str(major_version)
     package_name = f"electron-source.electron_{major_version}"
-    print(f"Updating electron-source.electron_{major_version}")
 
     old_info = load_info_json(SOURCE_INFO_JSON)
     old_version = (
-        old_info[str(major_version)]["version"]
-        if str(major_version) in old_info
-        else None
+        old_info[major_version]["version"] if major_version in old_info else None
     )
 
-    electron_source_info = get_electron_info(major_version)
-    new_info = get_update(electron_source_info)
-    out = old_info | {new_info[0]: new_info[1]}
+    save_info_json(SOURCE_INFO_JSON, old_info | {major_version: info})
 
-    save_info_json(SOURCE_INFO_JSON, out)
-
-    new_version = new_info[1]["version"]
+    new_version = info["version"]
     if old_version == new_version:
         print(f"{package_name} is up-to-date")
     elif commit:
         commit_result(package_name, old_version, new_version, SOURCE_INFO_JSON)
 
 
+def update_source(major_version: str, commit: bool, jobs: int) -> None:
+    """Update a given electron-source release
+
+    Args:
+        major_version: The major version number, e.g. '27'
+        commit: Whether the updater should commit the result
+        jobs: The number of prefetches to run at once
+    """
+    print(f"Updating electron-source.electron_{major_version}")
+
+    prefetcher = Prefetcher(jobs)
+    try:
+        electron_source_info = get_electron_info(major_version)
+        new_info = get_update(electron_source_info, prefetcher)
+    finally:
+        prefetcher.shutdown()
+
+    save_source_update(new_info[0], new_info[1], commit)
+
+
 def non_eol_releases(releases: Iterable[int]) -> Iterable[int]:
     """Returns a list of releases that have not reached end-of-life yet."""
     return tuple(filter(lambda x: x in supported_version_range(), releases))
 
 
-def update_all_source(commit: bool) -> None:
+def update_all_source(commit: bool, jobs: int) -> None:
     """Update all eletron-source releases at once
 
     Args:
         commit: Whether to commit the result
+        jobs: The number of prefetches to run at once
     """
     old_info = load_info_json(SOURCE_INFO_JSON)
 
@@ -571,21 +613,22 @@ def update_all_source(commit: bool) -> None:
     repos = Parallel(n_jobs=2, require="sharedmem")(
         delayed(get_electron_info)(major_version) for major_version in filtered_releases
     )
-    new_info = {
-        n[0]: n[1]
-        for n in Parallel(n_jobs=2, require="sharedmem")(
-            delayed(get_update)(repo) for repo in repos
-        )
-    }
 
-    if commit:
-        for major_version in filtered_releases:
-            # Since the sources have been fetched at this point already,
-            # fetching them again will be much faster.
-            update_source(str(major_version), commit)
-    else:
-        out = old_info | {new_info[0]: new_info[1]}
-        save_info_json(SOURCE_INFO_JSON, out)
+    # All releases are prefetched at once on the same pool, which does not
+    # run more than `jobs` prefetches and fetches shared dependencies once.
+    prefetcher = Prefetcher(jobs)
+    try:
+        new_info = {
+            n[0]: n[1]
+            for n in Parallel(n_jobs=len(repos) or 1, require="sharedmem")(
+                delayed(get_update)(repo, prefetcher) for repo in repos
+            )
+        }
+    finally:
+        prefetcher.shutdown()
+
+    for major_version, info in new_info.items():
+        save_source_update(major_version, info, commit)
 
 
 def parse_cve_numbers(tag_name: str) -> Iterable[str]:
@@ -698,7 +741,17 @@ def eval(version):
     help="Only update electron-source packages",
 )
 @click.option("-c", "--commit", is_flag=True, default=False, help="Commit the result")
-def update(version: str, bin_only: bool, source_only: bool, commit: bool) -> None:
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=PREFETCH_JOBS,
+    show_default=True,
+    help="Number of prefetches to run at once",
+)
+def update(
+    version: str, bin_only: bool, source_only: bool, commit: bool, jobs: int
+) -> None:
     assert isinstance(version, str) and len(version) > 0, "version must be non-empty"
 
     if bin_only and source_only:
@@ -712,11 +765,11 @@ def update(version: str, bin_only: bool, source_only: bool, commit: bool) -> Non
         update_bin(version, commit)
 
     elif source_only:
-        update_source(version, commit)
+        update_source(version, commit, jobs)
 
     else:
         update_bin(version, commit)
-        update_source(version, commit)
+        update_source(version, commit, jobs)
 
 
 @cli.command("update-all", help="Update all releases at once")
@@ -735,7 +788,15 @@ def update(version: str, bin_only: bool, source_only: bool, commit: bool) -> Non
     help="Only update electron-source packages",
 )
 @click.option("-c", "--commit", is_flag=True, default=False, help="Commit the result")
-def update_all(bin_only: bool, source_only: bool, commit: bool) -> None:
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=PREFETCH_JOBS,
+    show_default=True,
+    help="Number of prefetches to run at once",
+)
+def update_all(bin_only: bool, source_only: bool, commit: bool, jobs: int) -> None:
     # Filter out releases that have reached end-of-life
     filtered_bin_info = dict(
         filter(
@@ -756,13 +817,13 @@ def update_all(bin_only: bool, source_only: bool, commit: bool) -> None:
             update_bin(major_version, commit)
 
     elif source_only:
-        update_all_source(commit)
+        update_all_source(commit, jobs)
 
     else:
         for major_version, _ in filtered_bin_info.items():
             update_bin(major_version, commit)
 
-        update_all_source(commit)
+        update_all_source(commit, jobs)
 
 
 if __name__ == "__main__":
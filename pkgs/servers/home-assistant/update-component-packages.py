@@ -25,7 +25,7 @@ import tarfile
 import tempfile
 from functools import reduce
 from io import BytesIO
-from typing import Any, Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 from urllib.request import urlopen
 
 from packaging import version as Version
@@ -153,6 +153,47 @@ def has_extra(package: str, extra: str):
     return True
 
 
+# Check all (package attribute, extra) pairs at once, in a single evaluation
+# of nixpkgs instead of one nix-instantiate per pair
+def find_extras(queries: List[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+    if not queries:
+        return set()
+    expr = """
+      { root, queries }:
+      let
+        pkgs = import root { };
+        inherit (pkgs) lib;
+      in
+      map ({ package, extra }:
+        let
+          deps = lib.attrByPath (lib.splitString "." package ++ [ "optional-dependencies" extra ]) null pkgs;
+        in
+        deps != null && (builtins.tryEval (builtins.deepSeq (map (dep: dep.drvPath) deps) true)).value
+      ) (builtins.fromJSON queries)
+    """
+    cmd = [
+        "nix-instantiate",
+        "--eval",
+        "--strict",
+        "--json",
+        "--expr",
+        expr,
+        "--argstr",
+        "root",
+        repository_root(),
+        "--argstr",
+        "queries",
+        json.dumps([{"package": package, "extra": extra} for package, extra in queries]),
+    ]
+    try:
+        results = json.loads(subprocess.check_output(cmd, stderr=subprocess.DEVNULL))
+    except subprocess.CalledProcessError:
+        # Some errors can't be caught inside the evaluation, check the pairs one by one then
+        print("Batched evaluation of extras failed, checking them one by one", file=sys.stderr)
+        return {query for query in queries if has_extra(*query)}
+    return {query for query, found in zip(queries, results) if found}
+
+
 def dump_packages() -> Dict[str, Dict[str, str]]:
     # Store a JSON dump of Nixpkgs' python3Packages
     output = subprocess.check_output(
@@ -170,7 +211,36 @@ def dump_packages() -> Dict[str, Dict[str, str]]:
     return json.loads(output)
 
 
-def name_to_attr_path(req: str, packages: Dict[str, Dict[str, str]]) -> Optional[str]:
+# treat "-", "_" and "." equally, like pip does
+def normalize_name(name: str) -> str:
+    return re.sub("[-_.]+", "-", name).lower()
+
+
+# Map normalized package names to attribute paths, so that looking up a
+# requirement doesn't have to go through all packages
+def index_packages(packages: Dict[str, Dict[str, str]]) -> Dict[str, List[str]]:
+    index: Dict[str, List[str]] = {}
+    prefix = re.compile("^python\\d+\\.\\d+-", re.I)
+    # the name ends at a dash followed by the version or unstable-date,
+    # we need that qualifier, or we'll have multiple matches (e.g. pyserial
+    # and pyserial-asyncio when looking for pyserial)
+    end = re.compile("-(?=\\d|unstable-)", re.I)
+    for attr_path, package in packages.items():
+        # python(minor).(major)-(pname)-(version or unstable-date)
+        match = prefix.match(package["name"])
+        if not match:
+            continue
+        rest = package["name"][match.end() :]
+        # the pname itself may contain a dash followed by a digit, so every
+        # position it could end at is indexed
+        for name_end in end.finditer(rest):
+            attr_paths = index.setdefault(normalize_name(rest[: name_end.start()]), [])
+            if attr_path not in attr_paths:
+                attr_paths.append(attr_path)
+    return index
+
+
+def name_to_attr_path(req: str, index: Dict[str, List[str]]) -> Optional[str]:
     if req in PKG_PREFERENCES:
         return f"{PKG_SET}.{PKG_PREFERENCES[req]}"
     attr_paths = []
@@ -180,15 +250,7 @@ def name_to_attr_path(req: str, packages: Dict[str, Dict[str, str]]) -> Optional
     if req.startswith("python-") or req.startswith("python_"):
         names.append(req[len("python-") :])
     for name in names:
-        # treat "-" and "_" equally
-        name = re.sub("[-_]", "[-_]", name)
-        # python(minor).(major)-(pname)-(version or unstable-date)
-        # we need the version qualifier, or we'll have multiple matches
-        # (e.g. pyserial and pyserial-asyncio when looking for pyserial)
-        pattern = re.compile(f"^python\\d+\\.\\d+-{name}-(?:\\d|unstable-.*)", re.I)
-        for attr_path, package in packages.items():
-            if pattern.match(package["name"]):
-                attr_paths.append(attr_path)
+        attr_paths.extend(index.get(normalize_name(name), []))
     # Let's hope there's only one derivation with a matching name
     assert len(attr_paths) <= 1, f"{req} matches more than one derivation: {attr_paths}"
     if attr_paths:
@@ -206,15 +268,18 @@ def get_pkg_version(attr_path: str, packages: Dict[str, Dict[str, str]]) -> Opti
 
 def main() -> None:
     packages = dump_packages()
+    index = index_packages(packages)
     version = get_version()
     print("Generating component-packages.nix for version {}".format(version))
     components, components_with_tests = parse_components(version=version)
     build_inputs = {}
+    extra_queries: Dict[str, List[Tuple[str, str]]] = {}
     outdated = {}
     for component in sorted(components.keys()):
         attr_paths = []
         extra_attrs = []
         missing_reqs = []
+        extra_queries[component] = []
         reqs = sorted(get_reqs(components, component, set()))
         for req in reqs:
             # Some requirements are specified by url, e.g. https://example.org/foobar#xyz==1.0.0
@@ -228,7 +293,7 @@ def main() -> None:
             if name.endswith("]"):
                 extras = name[name.find("[")+1:name.find("]")].split(",")
                 name = name[:name.find("[")]
-            attr_path = name_to_attr_path(name, packages)
+            attr_path = name_to_attr_path(name, index)
             if attr_path:
                 if our_version := get_pkg_version(attr_path, packages):
                     attr_name = attr_path.split(".")[-1]
@@ -256,18 +321,24 @@ def main() -> None:
                 pname = attr_path[len(PKG_SET + "."):]
                 attr_paths.append(pname)
                 for extra in extras:
-                    # Check if package advertises extra requirements
-                    extra_attr = f"{pname}.optional-dependencies.{extra}"
-                    if has_extra(attr_path, extra):
-                        extra_attrs.append(extra_attr)
-                    else:
-                        missing_reqs.append(extra_attr)
+                    extra_queries[component].append((attr_path, extra))
 
             else:
                 missing_reqs.append(name)
         else:
             build_inputs[component] = (attr_paths, extra_attrs, missing_reqs)
 
+    # Check if packages advertise extra requirements
+    found_extras = find_extras(sorted({query for queries in extra_queries.values() for query in queries}))
+    for component, queries in extra_queries.items():
+        _, extra_attrs, missing_reqs = build_inputs[component]
+        for attr_path, extra in queries:
+            extra_attr = f"{attr_path[len(PKG_SET + '.'):]}.optional-dependencies.{extra}"
+            if (attr_path, extra) in found_extras:
+                extra_attrs.append(extra_attr)
+            else:
+                missing_reqs.append(extra_attr)
+
     with open(os.path.dirname(sys.argv[0]) + "/component-packages.nix", "w") as f:
         f.write("# Generated by update-component-packages.py\n")
         f.write("# Do not edit!\n\n")
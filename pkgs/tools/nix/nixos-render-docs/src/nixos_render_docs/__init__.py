@@ -3,11 +3,13 @@ import sys
 import textwrap
 import traceback
 from io import StringIO
+from pathlib import Path
 from pprint import pprint
 
 from . import manual
 from . import options
 from . import parallel
+from . import profiling
 
 def pretty_print_exc(e: BaseException, *, _desc_text: str = "error") -> None:
     print(f"\x1b[1;31m{_desc_text}:\x1b[0m", file=sys.stderr)
@@ -34,6 +36,11 @@ def pretty_print_exc(e: BaseException, *, _desc_text: str = "error") -> None:
 def main() -> None:
     parser = argparse.ArgumentParser(description='render nixos manual bits')
     parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--timings', action='store_true',
+                        help='print wall time and peak memory of each phase to stderr')
+    parser.add_argument('--profile', type=Path, default=None,
+                        help='write a profile of the run to this file (implies --timings)')
+    parser.add_argument('--profile-format', choices=['cprofile', 'speedscope'], default='cprofile')
 
     commands = parser.add_subparsers(dest='command', required=True)
 
@@ -43,12 +50,14 @@ def main() -> None:
     args = parser.parse_args()
     try:
         parallel.pool_processes = args.jobs
+        profiling.start(with_timings=args.timings, profile=args.profile, fmt=args.profile_format)
         if args.command == 'options':
             options.run_cli(args)
         elif args.command == 'manual':
             manual.run_cli(args)
         else:
             raise RuntimeError('command not hooked up', args)
+        profiling.finish()
     except Exception as e:
         traceback.print_exc()
         pretty_print_exc(e)
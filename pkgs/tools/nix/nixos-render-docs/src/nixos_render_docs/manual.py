@@ -3,19 +3,22 @@ import hashlib
 import html
 import json
 import re
+import shutil
 import xml.sax.saxutils as xml
 
 from abc import abstractmethod
 from collections.abc import Mapping, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Callable, cast, ClassVar, Generic, get_args, NamedTuple
 
 from markdown_it.token import Token
 
-from . import md, options
-from .html import HTMLRenderer, UnresolvedXrefError
+from . import md, options, profiling
+from .html import HTMLRenderer
 from .manual_structure import check_structure, FragmentType, is_include, make_xml_id, TocEntry, TocEntryType, XrefTarget
 from .md import Converter, Renderer
+from .search import SearchIndex
 
 class BaseConverter(Converter[md.TR], Generic[md.TR]):
     # per-converter configuration for ns:arg=value arguments to include blocks, following
@@ -33,10 +36,14 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
         self._base_paths = [ infile ]
         self._current_type = ['book']
         try:
-            tokens = self._parse(infile.read_text())
-            self._postprocess(infile, outfile, tokens)
-            converted = self._renderer.render(tokens)
-            outfile.write_text(converted)
+            with profiling.phase('parse', infile):
+                tokens = self._parse(infile.read_text())
+            with profiling.phase('postprocess'):
+                self._postprocess(infile, outfile, tokens)
+            with profiling.phase('render'):
+                converted = self._renderer.render(tokens)
+            with profiling.phase('write', outfile):
+                outfile.write_text(converted)
         except Exception as e:
             raise RuntimeError(f"failed to render manual {infile}") from e
 
@@ -77,7 +84,8 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
             self._handle_headings(tokens, on_heading=set_token_ident)
 
 
-        check_structure(self._current_type[-1], tokens)
+        with profiling.phase('check structure'):
+            check_structure(self._current_type[-1], tokens)
         for token in tokens:
             if not is_include(token):
                 continue
@@ -119,7 +127,7 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
                 raise RuntimeError(f"circular include found in line {lnum}")
             try:
                 self._base_paths.append(path)
-                with open(path, 'r') as f:
+                with profiling.phase('parse', path), open(path, 'r') as f:
                     prefix = None
                     if "auto-id-prefix" in block_args:
                         # include the current file number to prevent duplicate ids within include blocks
@@ -154,7 +162,7 @@ class BaseConverter(Converter[md.TR], Generic[md.TR]):
                 " ".join(items.keys()))
 
         try:
-            with open(self._base_paths[-1].parent / source, 'r') as f:
+            with profiling.phase('load options', source), open(self._base_paths[-1].parent / source, 'r') as f:
                 token.meta['id-prefix'] = id_prefix
                 token.meta['list-id'] = varlist_id
                 token.meta['source'] = json.load(f)
@@ -211,11 +219,44 @@ class HTMLParameters(NamedTuple):
     chunk_toc_depth: int
     section_toc_depth: int
     media_dir: Path
+    # directory (relative to the output directory) to write a search index to, if any.
+    search_index_dir: Path | None = None
+
+def _copy_media(src: Path, dst: Path, size: int) -> None:
+    # targets are content-addressed, so an existing target of the right size was
+    # written by an earlier run (or an earlier reference) and can be left alone.
+    try:
+        if dst.stat().st_size == size:
+            return
+    except FileNotFoundError:
+        pass
+    shutil.copyfile(src, dst)
+
+class NavLink(NamedTuple):
+    href: str
+    title: str | None
+
+class NavLinks(NamedTuple):
+    home: NavLink
+    prev: NavLink | None
+    up: NavLink | None
+    next: NavLink | None
+    # the parent entry again, but only if it is not the book itself.
+    part: NavLink | None
+    up_is_not_home: bool
 
 class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
     _base_path: Path
     _in_dir: Path
     _html_params: HTMLParameters
+    _head_links: str
+    _nav_cache: dict[str, NavLinks]
+    _toc_item_cache: dict[str, str]
+    # (source path, size, mtime) -> content-addressed name in the media dir
+    _media_names: dict[tuple[Path, int, int], str]
+    _media_targets: set[str]
+    _media_copies: list[Future[None]]
+    _media_pool: ThreadPoolExecutor | None
 
     def __init__(self, toplevel_tag: str, revision: str, html_params: HTMLParameters,
                  manpage_urls: Mapping[str, str], xref_targets: dict[str, XrefTarget],
@@ -224,20 +265,55 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         self._in_dir = in_dir
         self._base_path = base_path.absolute()
         self._html_params = html_params
+        self._head_links = "\n".join([
+            "".join((f'<link rel="stylesheet" type="text/css" href="{html.escape(style, True)}" />'
+                     for style in html_params.stylesheets)),
+            "".join((f'<script src="{html.escape(script, True)}" type="text/javascript"></script>'
+                     for script in html_params.scripts)),
+            f' <meta name="generator" content="{html.escape(html_params.generator, True)}" />',
+        ])
+        self._nav_cache = {}
+        self._toc_item_cache = {}
+        self._media_names = {}
+        self._media_targets = set()
+        self._media_copies = []
+        self._media_pool = None
 
     def _pull_image(self, src: str) -> str:
         src_path = Path(src)
-        content = (self._in_dir / src_path).read_bytes()
+        in_path = self._in_dir / src_path
         # images may be used more than once, but we want to store them only once and
         # in an easily accessible (ie, not input-file-path-dependent) location without
         # having to maintain a mapping structure. hashing the file and using the hash
-        # as both the path of the final image provides both.
-        content_hash = hashlib.sha3_256(content).hexdigest()
-        target_name = f"{content_hash}{src_path.suffix}"
-        target_path = self._base_path / self._html_params.media_dir / target_name
-        target_path.write_bytes(content)
+        # as both the path of the final image provides both. we still remember which
+        # inputs we have already seen so each file is read and hashed only once, and
+        # copy the file to its final location in the background while rendering goes on.
+        stat = in_path.stat()
+        key = (in_path, stat.st_size, stat.st_mtime_ns)
+        if (target_name := self._media_names.get(key)) is None:
+            with open(in_path, 'rb') as f:
+                content_hash = hashlib.file_digest(f, hashlib.sha3_256).hexdigest()
+            target_name = self._media_names[key] = f"{content_hash}{src_path.suffix}"
+            if target_name not in self._media_targets:
+                self._media_targets.add(target_name)
+                target_path = self._base_path / self._html_params.media_dir / target_name
+                if self._media_pool is None:
+                    self._media_pool = ThreadPoolExecutor(thread_name_prefix="media")
+                self._media_copies.append(
+                    self._media_pool.submit(_copy_media, in_path, target_path, stat.st_size))
         return f"./{self._html_params.media_dir}/{target_name}"
 
+    def finish_media(self) -> None:
+        """wait for all media files pulled by `_pull_image` to be written."""
+        try:
+            for copy in self._media_copies:
+                copy.result()
+        finally:
+            self._media_copies = []
+            if self._media_pool is not None:
+                self._media_pool.shutdown(cancel_futures=True)
+                self._media_pool = None
+
     def _push(self, tag: str, hlevel_offset: int) -> Any:
         result = (self._toplevel_tag, self._headings, self._attrspans, self._hlevel_offset, self._in_dir)
         self._hlevel_offset += hlevel_offset
@@ -271,26 +347,44 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
             self._file_footer(toc),
         ])
 
+    def _nav_links(self, toc: TocEntry) -> NavLinks:
+        # headers and footers of a chunk both need the same set of links, and toc entries
+        # are frozen by the time we render. compute everything once per entry.
+        if (nav := self._nav_cache.get(toc.target.id)) is not None:
+            return nav
+        def link(entry: TocEntry | None) -> NavLink | None:
+            return NavLink(entry.target.href(), entry.target.title) if entry else None
+        home = toc.root
+        nav = self._nav_cache[toc.target.id] = NavLinks(
+            cast(NavLink, link(home)),
+            link(toc.prev),
+            link(toc.parent),
+            link(toc.next),
+            link(toc.parent) if toc.parent and toc.parent.kind != 'book' else None,
+            toc.parent is not None and toc.parent is not home,
+        )
+        return nav
+
     def _file_header(self, toc: TocEntry) -> str:
         prev_link, up_link, next_link = "", "", ""
         prev_a, next_a, parent_title = "", "", "&nbsp;"
         nav_html = ""
-        home = toc.root
-        if toc.prev:
-            prev_link = f'<link rel="prev" href="{toc.prev.target.href()}" title="{toc.prev.target.title}" />'
-            prev_a = f'<a accesskey="p" href="{toc.prev.target.href()}">Prev</a>'
-        if toc.parent:
+        nav = self._nav_links(toc)
+        if nav.prev:
+            prev_link = f'<link rel="prev" href="{nav.prev.href}" title="{nav.prev.title}" />'
+            prev_a = f'<a accesskey="p" href="{nav.prev.href}">Prev</a>'
+        if nav.up:
             up_link = (
-                f'<link rel="up" href="{toc.parent.target.href()}" '
-                f'title="{toc.parent.target.title}" />'
+                f'<link rel="up" href="{nav.up.href}" '
+                f'title="{nav.up.title}" />'
             )
-            if (part := toc.parent) and part.kind != 'book':
-                assert part.target.title
-                parent_title = part.target.title
-        if toc.next:
-            next_link = f'<link rel="next" href="{toc.next.target.href()}" title="{toc.next.target.title}" />'
-            next_a = f'<a accesskey="n" href="{toc.next.target.href()}">Next</a>'
-        if toc.prev or toc.parent or toc.next:
+            if nav.part:
+                assert nav.part.title
+                parent_title = nav.part.title
+        if nav.next:
+            next_link = f'<link rel="next" href="{nav.next.href}" title="{nav.next.title}" />'
+            next_a = f'<a accesskey="n" href="{nav.next.href}">Next</a>'
+        if nav.prev or nav.up or nav.next:
             nav_html = "\n".join([
                 '  <div class="navheader">',
                 '   <table width="100%" summary="Navigation header">',
@@ -314,12 +408,8 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
             ' <head>',
             '  <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />',
             f' <title>{toc.target.title}</title>',
-            "".join((f'<link rel="stylesheet" type="text/css" href="{html.escape(style, True)}" />'
-                     for style in self._html_params.stylesheets)),
-            "".join((f'<script src="{html.escape(script, True)}" type="text/javascript"></script>'
-                     for script in self._html_params.scripts)),
-            f' <meta name="generator" content="{html.escape(self._html_params.generator, True)}" />',
-            f' <link rel="home" href="{home.target.href()}" title="{home.target.title}" />' if home.target.href() else "",
+            self._head_links,
+            f' <link rel="home" href="{nav.home.href}" title="{nav.home.title}" />' if nav.home.href else "",
             f' {up_link}{prev_link}{next_link}',
             ' </head>',
             ' <body>',
@@ -327,24 +417,23 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         ])
 
     def _file_footer(self, toc: TocEntry) -> str:
-        # prev, next = self._get_prev_and_next()
         prev_a, up_a, home_a, next_a = "", "&nbsp;", "&nbsp;", ""
         prev_text, up_text, next_text = "", "", ""
         nav_html = ""
-        home = toc.root
-        if toc.prev:
-            prev_a = f'<a accesskey="p" href="{toc.prev.target.href()}">Prev</a>'
-            assert toc.prev.target.title
-            prev_text = toc.prev.target.title
-        if toc.parent:
-            home_a = f'<a accesskey="h" href="{home.target.href()}">Home</a>'
-            if toc.parent != home:
-                up_a = f'<a accesskey="u" href="{toc.parent.target.href()}">Up</a>'
-        if toc.next:
-            next_a = f'<a accesskey="n" href="{toc.next.target.href()}">Next</a>'
-            assert toc.next.target.title
-            next_text = toc.next.target.title
-        if toc.prev or toc.parent or toc.next:
+        nav = self._nav_links(toc)
+        if nav.prev:
+            prev_a = f'<a accesskey="p" href="{nav.prev.href}">Prev</a>'
+            assert nav.prev.title
+            prev_text = nav.prev.title
+        if nav.up:
+            home_a = f'<a accesskey="h" href="{nav.home.href}">Home</a>'
+            if nav.up_is_not_home:
+                up_a = f'<a accesskey="u" href="{nav.up.href}">Up</a>'
+        if nav.next:
+            next_a = f'<a accesskey="n" href="{nav.next.href}">Next</a>'
+            assert nav.next.title
+            next_text = nav.next.title
+        if nav.prev or nav.up or nav.next:
             nav_html = "\n".join([
                 '  <div class="navfooter">',
                 '   <hr />',
@@ -381,13 +470,15 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
                 return []
             result = []
             for child in toc.children:
-                result.append(
-                    f'<dt>'
-                    f' <span class="{html.escape(child.kind, True)}">'
-                    f'  <a href="{child.target.href()}">{child.target.toc_html}</a>'
-                    f' </span>'
-                    f'</dt>'
-                )
+                if (item := self._toc_item_cache.get(child.target.id)) is None:
+                    item = self._toc_item_cache[child.target.id] = (
+                        f'<dt>'
+                        f' <span class="{html.escape(child.kind, True)}">'
+                        f'  <a href="{child.target.href()}">{child.target.toc_html}</a>'
+                        f' </span>'
+                        f'</dt>'
+                    )
+                result.append(item)
                 # we want to look straight through parts because docbook-xsl did too, but it
                 # also makes for more uesful top-level tocs.
                 next_level = walk_and_emit(child, depth - (0 if child.kind == 'part' else 1))
@@ -475,21 +566,24 @@ class ManualHTMLRenderer(RendererMixin, HTMLRenderer):
         for included, path in fragments:
             try:
                 self._in_dir = (in_dir / path).parent
-                inner.append(self.render(included))
+                with profiling.phase('render', path):
+                    inner.append(self.render(included))
             except Exception as e:
                 raise RuntimeError(f"rendering {path}") from e
         if into:
             inner.append(self._file_footer(toc))
-            (self._base_path / into).write_text("".join(inner))
+            with profiling.phase('write', into):
+                (self._base_path / into).write_text("".join(inner))
         self._pop(state)
         return "".join(outer)
 
     def included_options(self, token: Token, tokens: Sequence[Token], i: int) -> str:
-        conv = options.HTMLConverter(self._manpage_urls, self._revision,
-                                     token.meta['list-id'], token.meta['id-prefix'],
-                                     self._xref_targets)
-        conv.add_options(token.meta['source'])
-        return conv.finalize()
+        with profiling.phase('render options', token.meta['list-id']):
+            conv = options.HTMLConverter(self._manpage_urls, self._revision,
+                                         token.meta['list-id'], token.meta['id-prefix'],
+                                         self._xref_targets)
+            conv.add_options(token.meta['source'])
+            return conv.finalize()
 
 def _to_base26(n: int) -> str:
     return (_to_base26(n // 26) if n > 26 else "") + chr(ord("A") + n % 26)
@@ -504,6 +598,7 @@ class HTMLConverter(BaseConverter[ManualHTMLRenderer]):
     _xref_targets: dict[str, XrefTarget]
     _redirection_targets: set[str]
     _appendix_count: int = 0
+    _search_index: SearchIndex | None = None
 
     def _next_appendix_id(self) -> str:
         self._appendix_count += 1
@@ -520,7 +615,15 @@ class HTMLConverter(BaseConverter[ManualHTMLRenderer]):
         self._renderer = ManualHTMLRenderer(
             'book', self._revision, self._html_params, self._manpage_urls, self._xref_targets,
             infile.parent, outfile.parent)
-        super().convert(infile, outfile)
+        try:
+            super().convert(infile, outfile)
+        finally:
+            with profiling.phase('wait for media'):
+                self._renderer.finish_media()
+        if self._search_index is not None:
+            assert self._html_params.search_index_dir is not None
+            with profiling.phase('write search index'):
+                self._search_index.write(outfile.parent / self._html_params.search_index_dir)
 
     def _parse(self, src: str, *, auto_id_prefix: None | str = None) -> list[Token]:
         tokens = super()._parse(src,auto_id_prefix=auto_id_prefix)
@@ -629,29 +732,60 @@ class HTMLConverter(BaseConverter[ManualHTMLRenderer]):
             )
         return XrefTarget(id, title_html, toc_html, re.sub('<.*?>', '', title), path, drop_fragment)
 
+    def _resolve_xrefs(self, xref_queue: Sequence[XrefTarget | tuple[str, str, Token, str, bool]]) -> None:
+        # titles may link to ids that are defined later in the document. instead of
+        # rendering everything over and over until nothing changes we look at the local
+        # links in each title up front and render a title only once all the ids it links
+        # to are known. items without such dependencies are resolved in document order.
+        all_ids = { item.id if isinstance(item, XrefTarget) else item[0] for item in xref_queue }
+        waiting: dict[str, list[tuple[str, str, Token, str, bool]]] = {}
+        missing: dict[int, int] = {}
+        blocked: list[tuple[str, str, Token, str, bool]] = []
+
+        def add(target: XrefTarget) -> None:
+            if target.id in self._xref_targets:
+                raise RuntimeError(f"found duplicate id #{target.id}")
+            self._xref_targets[target.id] = target
+            for waiter in waiting.pop(target.id, []):
+                missing[id(waiter)] -= 1
+                if missing[id(waiter)] == 0:
+                    add(self._render_xref(*waiter))
+
+        for item in xref_queue:
+            if isinstance(item, XrefTarget):
+                add(item)
+                continue
+            assert item[2].children is not None
+            deps = {
+                href[1:] for t in item[2].children
+                if t.type == 'link_open'
+                and (href := cast(str, t.attrs.get('href', ''))).startswith('#')
+                and href[1:] in all_ids
+                and href[1:] not in self._xref_targets
+            }
+            if not deps:
+                add(self._render_xref(*item))
+                continue
+            missing[id(item)] = len(deps)
+            blocked.append(item)
+            for dep in deps:
+                waiting.setdefault(dep, []).append(item)
+
+        # anything still blocked is part of a reference cycle. rendering it will report
+        # the first unresolvable reference.
+        for item in blocked:
+            if missing[id(item)] > 0:
+                self._render_xref(*item)
+                raise RuntimeError("unreachable: xref cycle did not fail to render", item[0])
+
     def _postprocess(self, infile: Path, outfile: Path, tokens: Sequence[Token]) -> None:
-        self._number_block('example', "Example", tokens)
-        self._number_block('figure', "Figure", tokens)
-        xref_queue = self._collect_ids(tokens, outfile.name, 'book', True)
-
-        failed = False
-        deferred = []
-        while xref_queue:
-            for item in xref_queue:
-                try:
-                    target = item if isinstance(item, XrefTarget) else self._render_xref(*item)
-                except UnresolvedXrefError:
-                    if failed:
-                        raise
-                    deferred.append(item)
-                    continue
-
-                if target.id in self._xref_targets:
-                    raise RuntimeError(f"found duplicate id #{target.id}")
-                self._xref_targets[target.id] = target
-            if len(deferred) == len(xref_queue):
-                failed = True # do another round and report the first error
-            xref_queue = deferred
+        with profiling.phase('number blocks'):
+            self._number_block('example', "Example", tokens)
+            self._number_block('figure', "Figure", tokens)
+        with profiling.phase('collect xrefs'):
+            xref_queue = self._collect_ids(tokens, outfile.name, 'book', True)
+        with profiling.phase('resolve xrefs'):
+            self._resolve_xrefs(xref_queue)
 
         paths_seen = set()
         for t in self._xref_targets.values():
@@ -669,7 +803,13 @@ class HTMLConverter(BaseConverter[ManualHTMLRenderer]):
                     drop_target=True
                 )
 
-        TocEntry.collect_and_link(self._xref_targets, tokens)
+        with profiling.phase('build toc'):
+            TocEntry.collect_and_link(self._xref_targets, tokens)
+
+        if self._html_params.search_index_dir is not None:
+            with profiling.phase('collect search index'):
+                self._search_index = SearchIndex(self._xref_targets)
+                self._search_index.collect(tokens)
 
 
 
@@ -683,6 +823,7 @@ def _build_cli_html(p: argparse.ArgumentParser) -> None:
     p.add_argument('--chunk-toc-depth', default=1, type=int)
     p.add_argument('--section-toc-depth', default=0, type=int)
     p.add_argument('--media-dir', default="media", type=Path)
+    p.add_argument('--search-index-dir', default=None, type=Path)
     p.add_argument('infile', type=Path)
     p.add_argument('outfile', type=Path)
 
@@ -691,7 +832,8 @@ def _run_cli_html(args: argparse.Namespace) -> None:
         md = HTMLConverter(
             args.revision,
             HTMLParameters(args.generator, args.stylesheet, args.script, args.toc_depth,
-                           args.chunk_toc_depth, args.section_toc_depth, args.media_dir),
+                           args.chunk_toc_depth, args.section_toc_depth, args.media_dir,
+                           args.search_index_dir),
             json.load(manpage_urls))
         md.convert(args.infile, args.outfile)
 
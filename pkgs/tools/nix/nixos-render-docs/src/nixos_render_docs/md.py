@@ -137,23 +137,35 @@ class Renderer:
     def admonition_close(self, token: Token, tokens: Sequence[Token], i: int) -> str:
         return self._admonitions[self._admonition_stack.pop()][1](token, tokens, i)
 
+    # render and renderInline run for every token in every document we produce, so
+    # they are written as plain loops with the rules table bound to a local instead
+    # of building a closure per call and dispatching through map. rules may still be
+    # replaced or extended by subclasses at any time, we only ever read self.rules
+    # once per call.
     def render(self, tokens: Sequence[Token]) -> str:
-        def do_one(i: int, token: Token) -> str:
+        rules = self.rules
+        renderInline = self.renderInline
+        result: list[str] = []
+        append = result.append
+        for i, token in enumerate(tokens):
             if token.type == "inline":
                 assert token.children is not None
-                return self.renderInline(token.children)
-            elif token.type in self.rules:
-                return self.rules[token.type](tokens[i], tokens, i)
+                append(renderInline(token.children))
+            elif (rule := rules.get(token.type)) is not None:
+                append(rule(token, tokens, i))
             else:
                 raise NotImplementedError("md token not supported yet", token)
-        return self._join_block(map(lambda arg: do_one(*arg), enumerate(tokens)))
+        return self._join_block(result)
     def renderInline(self, tokens: Sequence[Token]) -> str:
-        def do_one(i: int, token: Token) -> str:
-            if token.type in self.rules:
-                return self.rules[token.type](tokens[i], tokens, i)
+        rules = self.rules
+        result: list[str] = []
+        append = result.append
+        for i, token in enumerate(tokens):
+            if (rule := rules.get(token.type)) is not None:
+                append(rule(token, tokens, i))
             else:
                 raise NotImplementedError("md token not supported yet", token)
-        return self._join_inline(map(lambda arg: do_one(*arg), enumerate(tokens)))
+        return self._join_inline(result)
 
     def text(self, token: Token, tokens: Sequence[Token], i: int) -> str:
         raise RuntimeError("md token not supported", token)
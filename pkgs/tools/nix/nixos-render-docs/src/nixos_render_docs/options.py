@@ -15,6 +15,7 @@ from urllib.parse import quote
 
 from . import md
 from . import parallel
+from . import profiling
 from .asciidoc import AsciiDocRenderer, asciidoc_escape
 from .commonmark import CommonMarkRenderer
 from .html import HTMLRenderer
@@ -520,27 +521,33 @@ def _run_cli_manpage(args: argparse.Namespace) -> None:
         footer = footer,
     )
 
-    with open(args.infile, 'r') as f:
-        md.add_options(json.load(f))
-    with open(args.outfile, 'w') as f:
+    with profiling.phase('load', args.infile), open(args.infile, 'r') as f:
+        options = json.load(f)
+    with profiling.phase('render'):
+        md.add_options(options)
+    with profiling.phase('write', args.outfile), open(args.outfile, 'w') as f:
         f.write(md.finalize())
 
 def _run_cli_commonmark(args: argparse.Namespace) -> None:
     with open(args.manpage_urls, 'r') as manpage_urls:
         md = CommonMarkConverter(json.load(manpage_urls), revision = args.revision)
 
-        with open(args.infile, 'r') as f:
-            md.add_options(json.load(f))
-        with open(args.outfile, 'w') as f:
+        with profiling.phase('load', args.infile), open(args.infile, 'r') as f:
+            options = json.load(f)
+        with profiling.phase('render'):
+            md.add_options(options)
+        with profiling.phase('write', args.outfile), open(args.outfile, 'w') as f:
             f.write(md.finalize())
 
 def _run_cli_asciidoc(args: argparse.Namespace) -> None:
     with open(args.manpage_urls, 'r') as manpage_urls:
         md = AsciiDocConverter(json.load(manpage_urls), revision = args.revision)
 
-        with open(args.infile, 'r') as f:
-            md.add_options(json.load(f))
-        with open(args.outfile, 'w') as f:
+        with profiling.phase('load', args.infile), open(args.infile, 'r') as f:
+            options = json.load(f)
+        with profiling.phase('render'):
+            md.add_options(options)
+        with profiling.phase('write', args.outfile), open(args.outfile, 'w') as f:
             f.write(md.finalize())
 
 def build_cli(p: argparse.ArgumentParser) -> None:
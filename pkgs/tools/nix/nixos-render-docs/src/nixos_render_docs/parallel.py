@@ -6,6 +6,8 @@ import multiprocessing
 
 from typing import Any, Callable, Iterable, Optional, TypeVar
 
+from . import profiling
+
 R = TypeVar('R')
 S = TypeVar('S')
 T = TypeVar('T')
@@ -20,10 +22,11 @@ pool_processes: Optional[int] = None
 _map_worker_fn: Any = None
 _map_worker_state_fn: Any = None
 _map_worker_state_arg: Any = None
+_map_worker_profiling: Any = None
 
 def _map_worker_init(*args: Any) -> None:
-    global _map_worker_fn, _map_worker_state_fn, _map_worker_state_arg
-    (_map_worker_fn, _map_worker_state_fn, _map_worker_state_arg) = args
+    global _map_worker_fn, _map_worker_state_fn, _map_worker_state_arg, _map_worker_profiling
+    (_map_worker_fn, _map_worker_state_fn, _map_worker_state_arg, _map_worker_profiling) = args
 
 # NOTE: the state argument is never passed by any caller, we only use it as a localized
 # cache for the created state in lieu of another global. it is effectively a global though.
@@ -32,7 +35,10 @@ def _map_worker_step(arg: Any, state: Any = []) -> Any:
     # if a Pool initializer throws it'll just be retried, leading to endless loops.
     # doing the proper initialization only on first use avoids this.
     if not state:
+        profiling.worker_start(_map_worker_profiling)
         state.append(_map_worker_state_fn(_map_worker_state_arg))
+    if profiling.timings:
+        return profiling.measure(_map_worker_fn, state[0], arg)
     return _map_worker_fn(state[0], arg)
 
 def map(fn: Callable[[S, T], R], d: Iterable[T], chunk_size: int,
@@ -54,5 +60,15 @@ def map(fn: Callable[[S, T], R], d: Iterable[T], chunk_size: int,
     if pool_processes is None:
         state = state_fn(state_arg)
         return [ fn(state, i) for i in d ]
-    with multiprocessing.Pool(pool_processes, _map_worker_init, (fn, state_fn, state_arg)) as p:
-        return list(p.imap(_map_worker_step, d, chunk_size))
+    init_args = (fn, state_fn, state_arg, profiling.worker_config())
+    with multiprocessing.Pool(pool_processes, _map_worker_init, init_args) as p:
+        if not profiling.timings:
+            return list(p.imap(_map_worker_step, d, chunk_size))
+        result = []
+        for (r, seconds, peak_memory) in p.imap(_map_worker_step, d, chunk_size):
+            profiling.record_worker(fn.__qualname__, seconds, peak_memory)
+            result.append(r)
+        # let workers exit normally so they can write their profiles
+        p.close()
+        p.join()
+        return result
@@ -0,0 +1,205 @@
+# optional instrumentation for finding out where a docs build spends its time. all of
+# this is off by default and phases are very cheap while it is, so they may be placed
+# liberally throughout the converters.
+#
+# --timings records wall time and peak traced memory for each phase (parsing, structure
+# checks, xref collection, rendering, writing) and each included file, and prints a
+# summary to stderr when done. memory tracking uses tracemalloc and slows everything
+# down noticeably, so wall times with --timings are only useful relative to each other.
+#
+# --profile additionally runs everything under cProfile and writes a pstats dump that
+# includes all parallel.map worker processes, or a speedscope trace of the phase tree.
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Optional, TypeVar
+
+R = TypeVar('R')
+
+@dataclass
+class Phase:
+    name: str
+    file: Optional[str]
+    start: float
+    end: float = 0.0
+    peak_memory: int = 0
+    children: list['Phase'] = field(default_factory=list)
+
+@dataclass
+class WorkerStats:
+    items: int = 0
+    seconds: float = 0.0
+    peak_memory: int = 0
+
+timings: bool = False
+profile_path: Optional[Path] = None
+profile_format: str = 'cprofile'
+
+_root: Optional[Phase] = None
+_stack: list[Phase] = []
+_workers: dict[str, WorkerStats] = {}
+_profiler: Optional[cProfile.Profile] = None
+
+def _now() -> float:
+    return time.perf_counter()
+
+def start(*, with_timings: bool, profile: Optional[Path], fmt: str = 'cprofile') -> None:
+    global timings, profile_path, profile_format, _root, _profiler
+    timings = with_timings or profile is not None
+    profile_path, profile_format = profile, fmt
+    if not timings:
+        return
+    tracemalloc.start()
+    _root = Phase('total', None, _now())
+    _stack[:] = [ _root ]
+    if profile_path is not None and profile_format == 'cprofile':
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+@contextlib.contextmanager
+def phase(name: str, file: Optional[Path | str] = None) -> Iterator[None]:
+    if not timings:
+        yield
+        return
+    parent = _stack[-1]
+    # tracemalloc only knows one peak, so fold the current peak into the parent before
+    # resetting it and fold ours back in when we're done.
+    parent.peak_memory = max(parent.peak_memory, tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    p = Phase(name, str(file) if file is not None else None, _now())
+    parent.children.append(p)
+    _stack.append(p)
+    try:
+        yield
+    finally:
+        p.end = _now()
+        p.peak_memory = max(p.peak_memory, tracemalloc.get_traced_memory()[1])
+        _stack.pop()
+        parent.peak_memory = max(parent.peak_memory, p.peak_memory)
+
+def record_worker(name: str, seconds: float, peak_memory: int) -> None:
+    stats = _workers.setdefault(name, WorkerStats())
+    stats.items += 1
+    stats.seconds += seconds
+    stats.peak_memory = max(stats.peak_memory, peak_memory)
+
+# parallel.map workers are separate processes, they get their configuration passed
+# explicitly so this also works when processes are spawned instead of forked.
+def worker_config() -> Any:
+    return (timings, profile_path if _profiler is not None else None)
+
+def worker_start(config: Any) -> None:
+    global timings, _profiler
+    (timings, path) = config
+    if timings and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if path is not None:
+        # forked workers inherit the parent profiler, which would never be dumped.
+        if _profiler is not None:
+            _profiler.disable()
+        # pool workers exit through multiprocessing's exit handlers when the pool is
+        # closed and joined (not when it is terminated), so we can dump stats from there.
+        from multiprocessing.util import Finalize
+        profiler = _profiler = cProfile.Profile()
+        Finalize(None, profiler.dump_stats, args=(f"{path}.worker-{os.getpid()}",), exitpriority=10)
+        profiler.enable()
+
+def measure(fn: Callable[..., R], *args: Any) -> tuple[R, float, int]:
+    """run `fn(*args)` in a worker, returning its result, the elapsed wall time,
+    and the peak traced memory."""
+    tracemalloc.reset_peak()
+    start = _now()
+    result = fn(*args)
+    return (result, _now() - start, tracemalloc.get_traced_memory()[1])
+
+def finish() -> None:
+    global _root
+    if not timings or _root is None:
+        return
+    _root.end = _now()
+    _root.peak_memory = max(_root.peak_memory, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    if _profiler is not None:
+        _profiler.disable()
+    _print_report(_root)
+    if profile_path is not None:
+        if profile_format == 'speedscope':
+            _write_speedscope(_root, profile_path)
+        else:
+            _write_cprofile(profile_path)
+    _root = None
+
+def _mb(n: int) -> str:
+    return f"{n / 2**20:.1f}M"
+
+def _print_report(root: Phase) -> None:
+    # group identical phases by name below their parent, per-file phases are listed on
+    # their own so slow includes stand out.
+    lines: list[tuple[str, float, int, int]] = []
+    def walk(p: Phase, depth: int) -> None:
+        groups: dict[tuple[str, Optional[str]], list[Phase]] = {}
+        for c in p.children:
+            groups.setdefault((c.name, c.file), []).append(c)
+        for (name, file), ps in groups.items():
+            label = "  " * depth + (f"{name} {file}" if file else name)
+            lines.append((label, sum(c.end - c.start for c in ps), max(c.peak_memory for c in ps), len(ps)))
+            merged = Phase(name, file, 0, children=[ cc for c in ps for cc in c.children ])
+            walk(merged, depth + 1)
+    lines.append(("total", root.end - root.start, root.peak_memory, 1))
+    walk(root, 1)
+    for name, stats in _workers.items():
+        lines.append((f"  workers {name}", stats.seconds, stats.peak_memory, stats.items))
+
+    width = max(len(l[0]) for l in lines)
+    print(f"{'phase':<{width}} {'wall':>9} {'peak mem':>9} {'count':>6}", file=sys.stderr)
+    for label, seconds, peak, count in lines:
+        print(f"{label:<{width}} {seconds:>8.3f}s {_mb(peak):>9} {count:>6}", file=sys.stderr)
+
+def _write_cprofile(path: Path) -> None:
+    assert _profiler is not None
+    stats = pstats.Stats(_profiler)
+    worker_dumps = sorted(path.parent.glob(f"{path.name}.worker-*"))
+    for dump in worker_dumps:
+        stats.add(str(dump))
+        dump.unlink()
+    stats.dump_stats(path)
+
+def _write_speedscope(root: Phase, path: Path) -> None:
+    frames: list[dict[str, str]] = []
+    frame_ids: dict[str, int] = {}
+    events: list[dict[str, Any]] = []
+    def frame(p: Phase) -> int:
+        name = f"{p.name} {p.file}" if p.file else p.name
+        if (id := frame_ids.get(name)) is None:
+            id = frame_ids[name] = len(frames)
+            frames.append({ 'name': name })
+        return id
+    def walk(p: Phase) -> None:
+        f = frame(p)
+        events.append({ 'type': 'O', 'frame': f, 'at': p.start - root.start })
+        for c in p.children:
+            walk(c)
+        events.append({ 'type': 'C', 'frame': f, 'at': p.end - root.start })
+    walk(root)
+    path.write_text(json.dumps({
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'shared': { 'frames': frames },
+        'profiles': [{
+            'type': 'evented',
+            'name': 'nixos-render-docs',
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': root.end - root.start,
+            'events': events,
+        }],
+    }))
@@ -0,0 +1,142 @@
+import dataclasses as dc
+import html
+import json
+import re
+
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from typing import Any, cast
+
+from markdown_it.token import Token
+
+from .manual_structure import make_xml_id, XrefTarget
+
+# the index is written as a small manifest, one document table, and a number of term
+# shards keyed by the first character of each term. a browser loads the manifest and the
+# document table once and fetches only the shards needed for the terms it looks up.
+#
+#   index.json     { "version": 1, "documents": "documents.json", "shards": { "a": "terms-a.json", ... } }
+#   documents.json [ [ id, href, title, snippet ], ... ]
+#   terms-a.json   { "apache": [ 12, 40, ... ], ... }
+#
+# posting lists hold document indices in document order, but documents whose titles contain
+# a term are listed before documents which only mention it in their text.
+
+FORMAT_VERSION = 1
+
+_SNIPPET_LENGTH = 160
+
+_term_re = re.compile(r"[^\W_]{2,}")
+# just enough markdown stripping to make option descriptions readable as snippets. we do
+# not want to parse tens of thousands of descriptions just for this.
+_md_role_re = re.compile(r"\{(\w+)\}`")
+_md_link_re = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+_md_markup_re = re.compile(r"[`*_]+|^#+\s*|^\s*:::.*$", re.MULTILINE)
+
+def _terms(s: str) -> Iterable[str]:
+    return _term_re.findall(s.lower())
+
+def _make_snippet(text: str) -> str:
+    text = " ".join(text.split())
+    if len(text) <= _SNIPPET_LENGTH:
+        return text
+    cut = text.rfind(" ", 0, _SNIPPET_LENGTH)
+    return text[:cut if cut > 0 else _SNIPPET_LENGTH] + "…"
+
+def _strip_md(text: str) -> str:
+    text = _md_role_re.sub("`", text)
+    text = _md_link_re.sub(r"\1", text)
+    return _md_markup_re.sub("", text)
+
+def _inline_text(token: Token) -> str:
+    assert token.children is not None
+    return "".join(c.content for c in token.children if c.type in ('text', 'code_inline', 'myst_role'))
+
+@dc.dataclass
+class _Document:
+    id: str
+    href: str
+    title: str
+    text: list[str] = dc.field(default_factory=list)
+
+class SearchIndex:
+    _documents: list[_Document]
+    _xref_targets: dict[str, XrefTarget]
+
+    def __init__(self, xref_targets: dict[str, XrefTarget]):
+        self._documents = []
+        self._xref_targets = xref_targets
+
+    def _add(self, id: str, title: str | None = None) -> _Document:
+        target = self._xref_targets[id]
+        # xref targets are html-escaped, the index is consumed as plain data.
+        title = title if title is not None else html.unescape(target.title or id)
+        doc = _Document(id, html.unescape(target.href()), title)
+        self._documents.append(doc)
+        return doc
+
+    def collect(self, tokens: Sequence[Token]) -> None:
+        """add all headings and options in `tokens` (and included fragments) to the index.
+        xref targets must have been resolved already."""
+        current: _Document | None = None
+        for (i, token) in enumerate(tokens):
+            if token.type == 'heading_open' and (id := cast(str, token.attrs.get('id', ''))):
+                current = self._add(id)
+            elif token.type == 'included_options':
+                self._collect_options(token)
+            elif token.type.startswith('included_'):
+                for sub, _path in token.meta['included']:
+                    self.collect(sub)
+            elif token.type == 'inline' and current is not None \
+                 and (i == 0 or tokens[i - 1].type != 'heading_open'):
+                current.text.append(_inline_text(token))
+            elif token.type in ('fence', 'code_block') and current is not None:
+                current.text.append(token.content)
+
+    def _collect_options(self, token: Token) -> None:
+        id_prefix = token.meta['id-prefix']
+        source: dict[str, Any] = token.meta['source']
+        for name, option in source.items():
+            doc = self._add(make_xml_id(f"{id_prefix}{name}"), name)
+            desc = option.get('description', '')
+            if isinstance(desc, dict):
+                desc = desc.get('text', '')
+            doc.text.append(_strip_md(desc))
+
+    def write(self, out_dir: Path) -> None:
+        documents = []
+        postings: dict[str, tuple[list[int], list[int]]] = {}
+        for (n, doc) in enumerate(self._documents):
+            text = " ".join(doc.text)
+            documents.append([ doc.id, doc.href, doc.title, _make_snippet(text) ])
+            title_terms = set(_terms(doc.title))
+            # option names are searched for in full as well as by their components
+            if not any(c.isspace() for c in doc.title):
+                title_terms.add(doc.title.lower())
+            for term in title_terms:
+                postings.setdefault(term, ([], []))[0].append(n)
+            for term in set(_terms(text)) - title_terms:
+                postings.setdefault(term, ([], []))[1].append(n)
+
+        shards: dict[str, dict[str, list[int]]] = {}
+        for term in sorted(postings):
+            in_title, in_text = postings[term]
+            shards.setdefault(term[0], {})[term] = in_title + in_text
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        manifest: dict[str, Any] = {
+            'version': FORMAT_VERSION,
+            'documents': 'documents.json',
+            'shards': {},
+        }
+        for key, terms in shards.items():
+            # shard keys are single characters of arbitrary scripts, but file names
+            # should be boring. code points are both stable and boring.
+            name = f"terms-{key if key.isascii() and key.isalnum() else f'u{ord(key):x}'}.json"
+            manifest['shards'][key] = name
+            self._write_json(out_dir / name, terms)
+        self._write_json(out_dir / 'documents.json', documents)
+        self._write_json(out_dir / 'index.json', manifest)
+
+    def _write_json(self, path: Path, data: Any) -> None:
+        path.write_text(json.dumps(data, ensure_ascii=False, separators=(',', ':')))
@@ -0,0 +1,96 @@
+"""
+micro-benchmark for the token dispatch loop of all renderers. this is not a test and
+is not collected by pytest, run it from the src directory with
+
+    PYTHONPATH=.:tests python tests/bench_render.py [--rounds N] [--copies N]
+
+each renderer is run over the shared sample document and over a synthetic large document
+made from many copies of a mixed block. parsing is done once up front and not counted.
+"""
+
+import argparse
+import time
+
+from collections.abc import Callable, Sequence
+from typing import Any
+
+import nixos_render_docs as nrd
+
+from markdown_it.token import Token
+
+from sample_md import sample1
+
+_synthetic_block = """\
+some *emphasized* text with `inline code`, a [link](https://example.com) and
+a {manpage}`nix.conf(5)` reference, plus **strong text** and more *nested **markup***.
+
+- item one with `code`
+- item two with [a link](https://nixos.org)
+  1. nested ordered
+  2. another one
+
+```nix
+{ pkgs, ... }:
+{
+  environment.systemPackages = [ pkgs.hello ];
+}
+```
+
+> a quote with a paragraph
+> that spans two lines
+
+term
+: definition with {option}`services.foo.enable`
+
+"""
+
+class _HTMLRenderer(nrd.html.HTMLRenderer):
+    def _pull_image(self, src: str) -> str:
+        return src
+
+class _Converter(nrd.md.Converter[Any]):
+    def __init__(self, make_renderer: Callable[[], Any]):
+        super().__init__()
+        self._renderer = make_renderer()
+
+_renderers: dict[str, Callable[[], Any]] = {
+    'html': lambda: _HTMLRenderer({}, {}),
+    'manpage': lambda: nrd.manpage.ManpageRenderer({}, {}),
+    'commonmark': lambda: nrd.commonmark.CommonMarkRenderer({}),
+    'asciidoc': lambda: nrd.asciidoc.AsciiDocRenderer({}),
+}
+
+def _count_tokens(tokens: Sequence[Token]) -> int:
+    return sum(1 + (_count_tokens(t.children) if t.children else 0) for t in tokens)
+
+def _bench(make_renderer: Callable[[], Any], src: str, rounds: int) -> tuple[int, float]:
+    conv = _Converter(make_renderer)
+    tokens = conv._parse(src)
+    total = 0.0
+    for _ in range(rounds):
+        # renderers carry state between calls, so each round gets a fresh one.
+        renderer = make_renderer()
+        start = time.perf_counter()
+        renderer.render(tokens)
+        total += time.perf_counter() - start
+    return _count_tokens(tokens), total
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='benchmark nixos-render-docs renderers')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--copies', type=int, default=500)
+    args = parser.parse_args()
+
+    documents = {
+        'sample': sample1,
+        'synthetic': _synthetic_block * args.copies,
+    }
+    print(f"{'renderer':<12} {'document':<10} {'tokens':>8} {'tokens/s':>12}")
+    for name, make_renderer in _renderers.items():
+        for doc_name, src in documents.items():
+            ntokens, elapsed = _bench(make_renderer, src, args.rounds)
+            rate = ntokens * args.rounds / elapsed if elapsed else float('inf')
+            print(f"{name:<12} {doc_name:<10} {ntokens:>8} {rate:>12.0f}")
+
+if __name__ == '__main__':
+    main()
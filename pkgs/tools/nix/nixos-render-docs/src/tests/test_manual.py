@@ -0,0 +1,108 @@
+import json
+import nixos_render_docs as nrd
+import pytest
+
+from pathlib import Path
+
+def _params() -> nrd.manual.HTMLParameters:
+    return nrd.manual.HTMLParameters("test", [], [], 1, 1, 0, Path("media"))
+
+def _write_book(d: Path, chapters: dict[str, str]) -> Path:
+    includes = "\n\n".join(
+        f"```{{=include=}} chapters html:into-file=//{name}.html\n{name}.md\n```"
+        for name in chapters
+    )
+    (d / "index.md").write_text(f"# Book {{#book}}\n## Subtitle\n\n{includes}\n")
+    for name, text in chapters.items():
+        (d / f"{name}.md").write_text(text)
+    return d / "index.md"
+
+def test_forward_xrefs_in_titles(tmp_path: Path) -> None:
+    infile = _write_book(tmp_path, {
+        'a': "# A [](#b) {#a}\n## A1 [](#c) {#a1}\n",
+        'b': "# B [](#c1) {#b}\n",
+        'c': "# C {#c}\n## C1 {#c1}\n",
+    })
+    c = nrd.manual.HTMLConverter("1", _params(), {})
+    c.convert(infile, tmp_path / "index.html")
+    assert c._xref_targets['c1'].title == "C1"
+    assert c._xref_targets['b'].title == "B the section called “C1”"
+    assert c._xref_targets['a'].title == "A B the section called “C1”"
+    assert c._xref_targets['a1'].title == "A1 C"
+
+def test_xref_cycle_in_titles(tmp_path: Path) -> None:
+    infile = _write_book(tmp_path, {
+        'a': "# A [](#b) {#a}\n",
+        'b': "# B [](#a) {#b}\n",
+    })
+    c = nrd.manual.HTMLConverter("1", _params(), {})
+    with pytest.raises(RuntimeError) as exc:
+        c.convert(infile, tmp_path / "index.html")
+    assert isinstance(exc.value.__cause__, nrd.html.UnresolvedXrefError)
+    assert exc.value.__cause__.args[0] == 'bad local reference, id #b not known'
+
+def test_navigation_links(tmp_path: Path) -> None:
+    infile = _write_book(tmp_path, {
+        'a': "# A {#a}\n",
+        'b': "# B {#b}\n",
+    })
+    c = nrd.manual.HTMLConverter("1", _params(), {})
+    c.convert(infile, tmp_path / "index.html")
+    b = (tmp_path / "b.html").read_text()
+    assert '<link rel="prev" href="a.html" title="A" />' in b
+    assert '<link rel="up" href="index.html" title="Book" />' in b
+    assert '<link rel="home" href="index.html" title="Book" />' in b
+    assert 'rel="next"' not in b
+
+def test_media_deduplicated(tmp_path: Path) -> None:
+    (tmp_path / "out" / "media").mkdir(parents=True)
+    (tmp_path / "img").mkdir()
+    (tmp_path / "img" / "a.png").write_bytes(b"image")
+    (tmp_path / "img" / "b.png").write_bytes(b"image")
+    (tmp_path / "img" / "c.png").write_bytes(b"other")
+    infile = _write_book(tmp_path, {
+        'a': "# A {#a}\n![](img/a.png) ![](img/a.png) ![](img/b.png) ![](img/c.png)\n",
+    })
+    c = nrd.manual.HTMLConverter("1", _params(), {})
+    c.convert(infile, tmp_path / "out" / "index.html")
+    media = sorted((tmp_path / "out" / "media").iterdir())
+    assert sorted(m.read_bytes() for m in media) == [b"image", b"other"]
+    html = (tmp_path / "out" / "a.html").read_text()
+    assert sum(html.count(f'src="./media/{m.name}"') for m in media) == 4
+
+def test_search_index(tmp_path: Path) -> None:
+    (tmp_path / "opts.json").write_text(json.dumps({
+        "services.foo.enable": {
+            "description": "Whether to enable the {command}`foo` daemon.",
+            "loc": ["services", "foo", "enable"],
+        },
+    }))
+    infile = _write_book(tmp_path, {
+        'a': "# Alpha & omega {#a}\nsome text about daemons\n\n## Options {#a-opts}\n"
+             "```{=include=} options\nid-prefix: opt-\nlist-id: opts\nsource: opts.json\n```\n",
+    })
+    params = _params()._replace(search_index_dir=Path("search"))
+    c = nrd.manual.HTMLConverter("1", params, {})
+    c.convert(infile, tmp_path / "index.html")
+
+    out = tmp_path / "search"
+    manifest = json.loads((out / "index.json").read_text())
+    assert manifest['version'] == 1
+    documents = json.loads((out / manifest['documents']).read_text())
+    assert documents == [
+        [ 'book', 'index.html', 'Book', '' ],
+        [ 'a', 'a.html', 'Alpha & omega', 'some text about daemons' ],
+        [ 'a-opts', 'a.html#a-opts', 'Options', '' ],
+        [ 'opt-services.foo.enable', 'a.html#opt-services.foo.enable', 'services.foo.enable',
+          'Whether to enable the foo daemon.' ],
+    ]
+    def lookup(term: str) -> list[int]:
+        if (shard := manifest['shards'].get(term[0])) is None:
+            return []
+        return list(json.loads((out / shard).read_text()).get(term, []))
+    assert lookup('alpha') == [1]
+    assert lookup('daemon') == [3]
+    assert lookup('services.foo.enable') == [3]
+    assert lookup('enable') == [3]
+    assert lookup('missing') == []
+    assert lookup('zzz') == []
@@ -0,0 +1,34 @@
+import json
+import nixos_render_docs as nrd
+import pytest
+
+from pathlib import Path
+
+def test_phases_speedscope(tmp_path: Path, capsys: pytest.CaptureFixture[str]) -> None:
+    p = nrd.profiling
+    p.start(with_timings=True, profile=tmp_path / "trace.json", fmt='speedscope')
+    try:
+        with p.phase('parse', 'a.md'):
+            with p.phase('check structure'):
+                pass
+        with p.phase('render'):
+            pass
+    finally:
+        p.finish()
+        p.timings = False
+
+    report = capsys.readouterr().err
+    assert "  parse a.md " in report
+    assert "    check structure " in report
+    assert "  render " in report
+
+    trace = json.loads((tmp_path / "trace.json").read_text())
+    frames = [ f['name'] for f in trace['shared']['frames'] ]
+    assert frames == [ 'total', 'parse a.md', 'check structure', 'render' ]
+    events = [ (e['type'], frames[e['frame']]) for e in trace['profiles'][0]['events'] ]
+    assert events == [
+        ('O', 'total'),
+        ('O', 'parse a.md'), ('O', 'check structure'), ('C', 'check structure'), ('C', 'parse a.md'),
+        ('O', 'render'), ('C', 'render'),
+        ('C', 'total'),
+    ]